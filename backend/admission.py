@@ -0,0 +1,141 @@
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+from fastapi import HTTPException
+
+CRITICAL = 0
+STANDARD = 1
+LOW = 2
+
+# Pressure at which each priority starts being shed; critical work never is.
+SHED_PRESSURE = {CRITICAL: None, STANDARD: 2.0, LOW: 1.0}
+
+
+@dataclass
+class RouteClass:
+    name: str
+    priority: int
+    concurrency: int
+    queue_timeout: float
+    cost: float = 1.0
+
+
+class TokenBucket:
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}
+
+    def take(self, key, cost=1.0):
+        # Returns 0 when the request may proceed, otherwise seconds until it could.
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= cost:
+            self.buckets[key] = (tokens - cost, now)
+            return 0.0
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self._prune(now)
+        return (cost - tokens) / self.rate
+
+    def _prune(self, now):
+        full_after = self.burst / self.rate
+        for key, (_, updated) in list(self.buckets.items()):
+            if now - updated >= full_after:
+                del self.buckets[key]
+
+
+class AdmissionController:
+    def __init__(self, classes, rate, burst, lag_source, pool_wait_source,
+                 shed_lag_ms=200, shed_pool_wait_ms=100, enabled=True):
+        self.classes = {route_class.name: route_class for route_class in classes}
+        self.bucket = TokenBucket(rate, burst)
+        self.lag_source = lag_source
+        self.pool_wait_source = pool_wait_source
+        self.shed_lag = shed_lag_ms / 1000
+        self.shed_pool_wait = shed_pool_wait_ms / 1000
+        self.enabled = enabled
+        self.semaphores = {}
+        self.in_flight = {}
+        self.rejected = {"rate_limited": 0, "shed": 0, "queue_timeout": 0}
+
+    @classmethod
+    def from_env(cls, lag_source, pool_wait_source):
+        def env(name, default):
+            return float(os.environ.get(name, default))
+
+        classes = [
+            RouteClass("critical", CRITICAL, int(env("ADMISSION_CRITICAL_CONCURRENCY", 64)),
+                       env("ADMISSION_CRITICAL_QUEUE_TIMEOUT", 10)),
+            RouteClass("standard", STANDARD, int(env("ADMISSION_STANDARD_CONCURRENCY", 32)),
+                       env("ADMISSION_STANDARD_QUEUE_TIMEOUT", 5)),
+            RouteClass("reports", LOW, int(env("ADMISSION_REPORTS_CONCURRENCY", 4)),
+                       env("ADMISSION_REPORTS_QUEUE_TIMEOUT", 2), cost=env("ADMISSION_REPORTS_COST", 5)),
+        ]
+        return cls(
+            classes,
+            rate=env("RATE_LIMIT_PER_SECOND", 10),
+            burst=env("RATE_LIMIT_BURST", 40),
+            lag_source=lag_source,
+            pool_wait_source=pool_wait_source,
+            shed_lag_ms=env("ADMISSION_SHED_LAG_MS", 200),
+            shed_pool_wait_ms=env("ADMISSION_SHED_POOL_WAIT_MS", 100),
+            enabled=os.environ.get("ADMISSION_CONTROL", "1") != "0",
+        )
+
+    def pressure(self):
+        # 1.0 means a threshold has been reached; 2.0 means twice over it.
+        return max(self.lag_source() / self.shed_lag, self.pool_wait_source() / self.shed_pool_wait)
+
+    def _reject(self, reason, status_code, retry_after, detail):
+        self.rejected[reason] += 1
+        raise HTTPException(
+            status_code=status_code,
+            detail=detail,
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    @asynccontextmanager
+    async def admit(self, class_name, route, user_id):
+        if not self.enabled:
+            yield
+            return
+        route_class = self.classes[class_name]
+
+        retry_after = self.bucket.take(user_id, route_class.cost)
+        if retry_after:
+            self._reject("rate_limited", 429, retry_after, "Too many requests")
+
+        shed_at = SHED_PRESSURE[route_class.priority]
+        if shed_at is not None:
+            pressure = self.pressure()
+            if pressure >= shed_at:
+                self._reject("shed", 503, pressure, "Server is busy, please retry")
+
+        semaphore = self.semaphores.get(route)
+        if semaphore is None:
+            semaphore = self.semaphores[route] = asyncio.Semaphore(route_class.concurrency)
+        try:
+            await asyncio.wait_for(semaphore.acquire(), route_class.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject("queue_timeout", 503, route_class.queue_timeout, "Server is busy, please retry")
+        self.in_flight[route] = self.in_flight.get(route, 0) + 1
+        try:
+            yield
+        finally:
+            self.in_flight[route] -= 1
+            semaphore.release()
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "pressure": round(self.pressure(), 2),
+            "in_flight": {route: count for route, count in self.in_flight.items() if count},
+            "rejected": dict(self.rejected),
+        }
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+# Per collection: the date that ages a record out, which records are finished
+# with, and whether the patient has to have paid in full first.
+RULES = {
+    "appointments": {"field": "date", "query": {"status": {"$in": ["done", "cancelled"]}}, "settled": False},
+    "payments": {"field": "payment_date", "query": {}, "settled": True},
+    "patient_history": {"field": "date", "query": {}, "settled": True},
+}
+
+
+def archive_name(name):
+    return f"{name}_archive"
+
+
+def date_range(date_from=None, date_to=None):
+    # Dates are stored as ISO strings, so a day range is a string range that
+    # matches both "YYYY-MM-DD" and full timestamps within those days.
+    bounds = {}
+    try:
+        if date_from:
+            bounds["$gte"] = datetime.strptime(date_from, "%Y-%m-%d").strftime("%Y-%m-%d")
+        if date_to:
+            bounds["$lt"] = (datetime.strptime(date_to, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates must be YYYY-MM-DD")
+    return bounds
+
+
+class Archiver:
+    # Closed appointments, and payments and history of patients with nothing
+    # left to pay, move to `<collection>_archive` once they're older than
+    # `after_days`, so the hot collections and their indexes stay small.
+    #
+    # archive_state records, per collection, the date before which records may
+    # be archived (the watermark). Reads only look in the archive when asked
+    # to, or when the range they ask for starts before it; without a range
+    # they see only the hot collection. Readers cache the watermark for
+    # `watermark_ttl` seconds, so a run raises it and waits that long before
+    # moving anything; no reader can be skipping the archive for a range whose
+    # records are already there.
+    def __init__(self, db, after_days=365, batch_size=500, interval_hours=24, archive_db_name=None, watermark_ttl=60):
+        self.db = db
+        self.state = db.archive_state
+        self.after_days = after_days
+        self.batch_size = batch_size
+        self.interval_hours = interval_hours
+        self.archive_db_name = archive_db_name
+        self.watermark_ttl = watermark_ttl
+        self.watermarks = {}
+
+    @classmethod
+    def from_env(cls, db):
+        return cls(
+            db,
+            after_days=int(os.environ.get("ARCHIVE_AFTER_DAYS", "365")),
+            batch_size=int(os.environ.get("ARCHIVE_BATCH_SIZE", "500")),
+            interval_hours=float(os.environ.get("ARCHIVE_INTERVAL_HOURS", "24")),
+            archive_db_name=os.environ.get("ARCHIVE_DB_NAME") or None,
+        )
+
+    def archive(self, db, name):
+        # The archive of `name` as seen through `db`, keeping its read
+        # preference when the archive lives in a database of its own.
+        if self.archive_db_name:
+            db = db.client.get_database(self.archive_db_name, read_preference=db.read_preference)
+        return db[archive_name(name)]
+
+    async def ensure_indexes(self):
+        for name, rule in RULES.items():
+            archive = self.archive(self.db, name)
+            await archive.create_index("id")
+            await archive.create_index([("patient_id", 1), (rule["field"], -1)])
+            await archive.create_index([("version", 1), ("id", 1)])
+        await self.archive(self.db, "appointments").create_index([("doctor_id", 1), ("date", -1)])
+        await self.archive(self.db, "payments").create_index("payment_date")
+
+    async def watermark(self, name):
+        cached = self.watermarks.get(name)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        state = await self.state.find_one({"_id": name})
+        value = state["before"] if state else None
+        self.watermarks[name] = (time.monotonic() + self.watermark_ttl, value)
+        return value
+
+    async def find(self, db, name, query, fields, date_from=None, date_to=None, sort=None, limit=1000, include_archived=False):
+        # Reads `name` through `db` like a plain find, adding archived records
+        # when `include_archived` is set or the requested range starts before
+        # the watermark. A record caught mid-move can be in both; the hot copy
+        # wins. `sort` is 1 or -1 on the collection's date field.
+        field = RULES[name]["field"]
+        bounds = date_range(date_from, date_to)
+        if bounds:
+            query = {**query, field: bounds}
+        watermark = await self.watermark(name) if include_archived or date_from else None
+        if watermark is None or (not include_archived and date_from >= watermark):
+            cursor = db[name].find(query, fields)
+            return await (cursor.sort(field, sort) if sort else cursor).to_list(limit)
+
+        if any(value == 1 for value in fields.values()):
+            fields = {**fields, "id": 1, field: 1}
+            archive_fields = fields
+        else:
+            archive_fields = {**fields, "archived_at": 0}
+        reads = [db[name].find(query, fields), self.archive(db, name).find(query, archive_fields)]
+        hot, archived = await asyncio.gather(*(
+            (cursor.sort(field, sort) if sort else cursor).to_list(limit) for cursor in reads
+        ))
+        ids = {doc["id"] for doc in hot}
+        docs = hot + [doc for doc in archived if doc["id"] not in ids]
+        if sort:
+            docs.sort(key=lambda doc: str(doc.get(field) or ""), reverse=sort < 0)
+        return docs[:limit]
+
+    async def run(self):
+        if not self.after_days:
+            return {}
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.after_days)).strftime("%Y-%m-%d")
+        raised = False
+        for name in RULES:
+            previous = await self.state.find_one_and_update(
+                {"_id": name}, {"$max": {"before": cutoff}}, upsert=True, return_document=ReturnDocument.BEFORE
+            )
+            raised = raised or not previous or previous.get("before", "") < cutoff
+        if raised:
+            await asyncio.sleep(self.watermark_ttl)
+        return {name: await self.move(name, cutoff) for name in RULES}
+
+    async def move(self, name, cutoff):
+        rule = RULES[name]
+        hot = self.db[name]
+        archive = self.archive(self.db, name)
+        query = {**rule["query"], rule["field"]: {"$lt": cutoff}}
+        moved = 0
+        last_id = None
+        while True:
+            batch = await hot.find(
+                {**query, "_id": {"$gt": last_id}} if last_id is not None else query
+            ).sort("_id", 1).to_list(self.batch_size)
+            if not batch:
+                logger.info("Archived %d %s older than %s", moved, name, cutoff)
+                return moved
+            last_id = batch[-1]["_id"]
+            if rule["settled"]:
+                settled = await self.settled_patients({doc.get("patient_id") for doc in batch})
+                batch = [doc for doc in batch if doc.get("patient_id") in settled]
+                if not batch:
+                    continue
+            archived_at = datetime.now(timezone.utc)
+            await archive.bulk_write([
+                ReplaceOne({"_id": doc["_id"]}, {**doc, "archived_at": archived_at}, upsert=True) for doc in batch
+            ], ordered=False)
+            # Only deleted if unchanged since it was read; a record updated in
+            # between stays hot, and the next run archives the new version.
+            result = await hot.bulk_write([
+                DeleteOne({"_id": doc["_id"], "version": doc.get("version")}) for doc in batch
+            ], ordered=False)
+            moved += result.deleted_count
+
+    async def settled_patients(self, patient_ids):
+        patients = await self.db.patients.find(
+            {"id": {"$in": list(patient_ids)}, "balance": {"$lte": 0}}, {"_id": 0, "id": 1}
+        ).to_list(None)
+        return {patient["id"] for patient in patients}
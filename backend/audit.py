@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+from pymongo.errors import BulkWriteError, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+
+def partition_name(prefix, when):
+    return f"{prefix}_{when:%Y%m}"
+
+
+class AuditLogger:
+    # Audit events are queued in memory and written by one background task in
+    # batches, so a PHI read costs a queue put instead of a database round
+    # trip. Events go to one collection per month (audit_log_YYYYMM), which
+    # keeps each collection bounded and lets old months be dropped wholesale.
+    def __init__(self, db, flush_interval_ms=200, batch_size=500, max_queue=10000,
+                 prefix="audit_log", enabled=True, max_retries=5):
+        self.db = db
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.prefix = prefix
+        self.enabled = enabled
+        self.max_retries = max_retries
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.indexed = set()
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.backpressured = 0
+        self._task = None
+
+    @classmethod
+    def from_env(cls, db):
+        return cls(
+            db,
+            flush_interval_ms=int(os.environ.get("AUDIT_FLUSH_INTERVAL_MS", "200")),
+            batch_size=int(os.environ.get("AUDIT_BATCH_SIZE", "500")),
+            max_queue=int(os.environ.get("AUDIT_QUEUE_SIZE", "10000")),
+            enabled=os.environ.get("AUDIT_LOG", "1") != "0",
+        )
+
+    def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # The sentinel is queued behind pending events, so everything already
+        # logged is flushed before the writer exits.
+        if self._task is None:
+            return
+        await self.queue.put(None)
+        await self._task
+        self._task = None
+
+    async def record(self, user, action, resource, patient_id, **details):
+        if not self.enabled:
+            return
+        event = {
+            "ts": datetime.now(timezone.utc),
+            "user_id": user.id,
+            "user_name": user.name,
+            "role": user.role,
+            "action": action,
+            "resource": resource,
+            "patient_id": patient_id,
+            **details,
+        }
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Backpressure: when the writer falls behind, callers wait for
+            # room rather than events being dropped.
+            self.backpressured += 1
+            await self.queue.put(event)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            event = await self.queue.get()
+            if event is None:
+                break
+            batch = [event]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            try:
+                await self._flush(batch)
+            except Exception:
+                # The writer must survive, or a full queue would stall requests.
+                self.dropped += len(batch)
+                logger.exception("Dropping %d audit events", len(batch))
+
+    async def _flush(self, batch):
+        partitions = {}
+        for event in batch:
+            partitions.setdefault(partition_name(self.prefix, event["ts"]), []).append(event)
+        for name, events in partitions.items():
+            for attempt in range(self.max_retries):
+                try:
+                    await self._ensure_indexes(name)
+                    await self.db[name].insert_many(events, ordered=False)
+                    self.written += len(events)
+                    break
+                except BulkWriteError as error:
+                    # Duplicate keys are events a previous attempt already wrote.
+                    failed = sorted({e["index"] for e in error.details["writeErrors"] if e["code"] != 11000})
+                    self.written += len(events) - len(failed)
+                    events = [events[index] for index in failed]
+                    if not events:
+                        break
+                    if attempt == self.max_retries - 1:
+                        self.dropped += len(events)
+                        logger.error("Dropping %d audit events for %s", len(events), name)
+                    else:
+                        await asyncio.sleep(min(5.0, 0.1 * 2 ** attempt))
+                except PyMongoError:
+                    if attempt == self.max_retries - 1:
+                        self.dropped += len(events)
+                        logger.exception("Dropping %d audit events for %s", len(events), name)
+                    else:
+                        await asyncio.sleep(min(5.0, 0.1 * 2 ** attempt))
+        self.flushes += 1
+
+    async def _ensure_indexes(self, name):
+        if name in self.indexed:
+            return
+        await self.db[name].create_index([("patient_id", 1), ("ts", -1)])
+        await self.db[name].create_index([("user_id", 1), ("ts", -1)])
+        self.indexed.add(name)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "queued": self.queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "backpressured": self.backpressured,
+        }
@@ -0,0 +1,409 @@
+"""Back up and restore the clinic database.
+
+Usage (from the backend/ directory):
+
+    python backup.py create --dest /backups                  # full backup
+    python backup.py create --dest /backups --incremental    # changes since the latest backup
+    python backup.py list --dest /backups
+    python backup.py restore --dest /backups                 # latest backup, into an empty database
+    python backup.py restore --dest /backups --backup 20260101T020000Z --drop
+
+Collections are dumped in parallel as zstd-compressed BSON, one file per
+collection under <dest>/<backup id>/, with a manifest.json that records
+document counts and index definitions. X-ray files are stored once under
+<dest>/blobs/, named by their SHA-256, and shared by every backup; only files
+not stored yet are copied. Inline base64 images on old X-ray records are
+moved there too.
+
+An incremental backup holds the documents created or updated since the
+backup before it started (small collections without timestamps are always
+copied whole). Deletions are only picked up by the next full backup.
+Restoring a backup replays its chain, from the full backup it builds on,
+with parallel insert_many batches; indexes are built once at the end and
+X-ray files are put back into GridFS. Stop the API while restoring.
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import bson
+import zstandard
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorGridFSBucket
+from pymongo import ReplaceOne
+
+logger = logging.getLogger("backup")
+
+RAW = CodecOptions(document_class=RawBSONDocument)
+BLOB_COLLECTION = "xray_blobs"
+# Lock leases and unfinished uploads are useless after a restore; GridFS
+# data is backed up as blobs instead.
+EXCLUDED = {"startup_locks", "xray_upload_sessions",
+            f"{BLOB_COLLECTION}_data.files", f"{BLOB_COLLECTION}_data.chunks"}
+# Field that tells an incremental backup a document changed.
+INCREMENTAL_FIELDS = {
+    "patients": "updated_at",
+    "appointments": "updated_at",
+    "payments": "updated_at",
+    "procedures": "updated_at",
+    "users": "updated_at",
+    "patient_history": "updated_at",
+    "ledger": "created_at",
+    "ledger_snapshots": "created_at",
+    "appointments_archive": "archived_at",
+    "payments_archive": "archived_at",
+    "patient_history_archive": "archived_at",
+}
+# Incremental backups start this long before the previous backup started, so
+# writes that were in flight during it aren't missed.
+OVERLAP = timedelta(minutes=5)
+WRITE_BUFFER_BYTES = 4 * 1024 * 1024
+
+
+def incremental_field(name):
+    if name.startswith("audit_log_"):
+        return "ts"
+    return INCREMENTAL_FIELDS.get(name)
+
+
+def blob_path(dest, sha):
+    return os.path.join(dest, "blobs", sha[:2], f"{sha}.zst")
+
+
+def read_manifest(dest, backup_id):
+    with open(os.path.join(dest, backup_id, "manifest.json")) as f:
+        return json_util.loads(f.read(), json_options=json_util.JSONOptions(tz_aware=True))
+
+
+def list_backups(dest):
+    # Oldest first; a directory without a manifest is an unfinished backup.
+    if not os.path.isdir(dest):
+        return []
+    return [
+        read_manifest(dest, name) for name in sorted(os.listdir(dest))
+        if os.path.isfile(os.path.join(dest, name, "manifest.json"))
+    ]
+
+
+def backup_chain(dest, backup_id):
+    chain = [read_manifest(dest, backup_id)]
+    while chain[0]["base"]:
+        chain.insert(0, read_manifest(dest, chain[0]["base"]))
+    return chain
+
+
+def read_batches(path, batch_size, codec_options):
+    with open(path, "rb") as f, zstandard.ZstdDecompressor().stream_reader(f) as reader:
+        batch = []
+        for doc in bson.decode_file_iter(reader, codec_options):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+class BackupWriter:
+    def __init__(self, db, args, base=None):
+        self.db = db
+        self.args = args
+        self.base = base
+        self.started_at = datetime.now(timezone.utc)
+        self.id = f"{self.started_at:%Y%m%dT%H%M%SZ}"
+        self.directory = os.path.join(args.dest, self.id)
+        self.since = base["started_at"] - OVERLAP if base else None
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=f"{BLOB_COLLECTION}_data")
+        self.blobs_stored = 0
+        self.blobs_skipped = 0
+
+    async def create(self):
+        os.makedirs(self.directory)
+        names = [
+            name for name in sorted(await self.db.list_collection_names())
+            if name not in EXCLUDED and not name.startswith("system.")
+        ]
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def dump(name):
+            async with semaphore:
+                return name, await self.dump_collection(name)
+
+        collections = dict(await asyncio.gather(*(dump(name) for name in names)))
+        # After the collections, so every blob they reference gets copied.
+        await self.dump_blobs()
+        manifest = {
+            "id": self.id,
+            "type": "incremental" if self.base else "full",
+            "base": self.base["id"] if self.base else None,
+            "since": self.since,
+            "started_at": self.started_at,
+            "finished_at": datetime.now(timezone.utc),
+            "collections": collections,
+            "blobs": {"stored": self.blobs_stored, "already_stored": self.blobs_skipped},
+        }
+        # The manifest is written last; without it the backup doesn't count.
+        with open(os.path.join(self.directory, "manifest.json"), "w") as f:
+            f.write(json_util.dumps(manifest, indent=2))
+        return manifest
+
+    async def dump_collection(self, name):
+        field = incremental_field(name)
+        query = {}
+        if self.since and field:
+            # Timestamps are ISO strings on most collections and dates on others.
+            query = {"$or": [{field: {"$gt": self.since.isoformat()}}, {field: {"$gt": self.since}}]}
+        inline_images = name == "xray_images"
+        collection = self.db[name] if inline_images else self.db[name].with_options(codec_options=RAW)
+        indexes = [
+            {key: value for key, value in spec.items() if key not in ("v", "ns")}
+            async for spec in self.db[name].list_indexes() if spec["name"] != "_id_"
+        ]
+
+        started = time.monotonic()
+        count = 0
+        buffer = bytearray()
+        compressor = zstandard.ZstdCompressor(level=self.args.level)
+        with open(os.path.join(self.directory, f"{name}.bson.zst"), "wb") as f, compressor.stream_writer(f) as out:
+            async for doc in collection.find(query).batch_size(self.args.batch_size):
+                if inline_images:
+                    if isinstance(doc.get("image_data"), str):
+                        doc["image_data_blob"] = await self.store_bytes(doc.pop("image_data").encode())
+                    buffer += bson.encode(doc)
+                else:
+                    buffer += doc.raw
+                count += 1
+                if len(buffer) >= WRITE_BUFFER_BYTES:
+                    # zstd releases the GIL, so collections compress in parallel.
+                    await asyncio.to_thread(out.write, bytes(buffer))
+                    buffer.clear()
+            await asyncio.to_thread(out.write, bytes(buffer))
+        logger.info("Dumped %d %s documents in %.1fs", count, name, time.monotonic() - started)
+        return {"mode": "since" if query else "full", "documents": count, "indexes": indexes}
+
+    async def dump_blobs(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def copy(blob):
+            async with semaphore:
+                stream = await self.bucket.open_download_stream(blob["file_id"])
+                await self.write_blob(blob["_id"], stream)
+
+        tasks = []
+        async for blob in self.db[BLOB_COLLECTION].find({}, {"_id": 1, "file_id": 1}):
+            if os.path.exists(blob_path(self.args.dest, blob["_id"])):
+                self.blobs_skipped += 1
+            else:
+                tasks.append(asyncio.create_task(copy(blob)))
+        await asyncio.gather(*tasks)
+
+    async def store_bytes(self, data):
+        sha = hashlib.sha256(data).hexdigest()
+        if os.path.exists(blob_path(self.args.dest, sha)):
+            self.blobs_skipped += 1
+        else:
+            await self.write_blob(sha, data)
+        return sha
+
+    async def write_blob(self, sha, source):
+        # Written to a temporary name first, so an interrupted backup never
+        # leaves a truncated file that later backups would treat as stored.
+        path = blob_path(self.args.dest, sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp, "wb") as f, zstandard.ZstdCompressor(level=self.args.level).stream_writer(f) as out:
+            if isinstance(source, bytes):
+                await asyncio.to_thread(out.write, source)
+            else:
+                while chunk := await source.readchunk():
+                    await asyncio.to_thread(out.write, chunk)
+        os.replace(temp, path)
+        self.blobs_stored += 1
+
+
+class Restorer:
+    def __init__(self, db, args, chain):
+        self.db = db
+        self.args = args
+        self.chain = chain
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=f"{BLOB_COLLECTION}_data")
+        self.slots = asyncio.Semaphore(args.concurrency)
+        self.documents = 0
+
+    async def restore(self):
+        for position, manifest in enumerate(self.chain):
+            started = time.monotonic()
+            await asyncio.gather(*(
+                self.restore_collection(manifest, name, info, first=position == 0)
+                for name, info in manifest["collections"].items()
+            ))
+            logger.info("Restored backup %s in %.1fs", manifest["id"], time.monotonic() - started)
+        await self.restore_blobs()
+        await self.build_indexes()
+
+    async def restore_collection(self, manifest, name, info, first):
+        collection = self.db[name]
+        if info["mode"] == "full" and not first:
+            # A complete copy replaces whatever the earlier backups restored.
+            await collection.delete_many({})
+        upsert = info["mode"] == "since" and not first
+        inline_images = name == "xray_images"
+        path = os.path.join(self.args.dest, manifest["id"], f"{name}.bson.zst")
+        batches = read_batches(path, self.args.batch_size, CodecOptions() if inline_images else RAW)
+        tasks = []
+
+        async def write(batch):
+            try:
+                if upsert:
+                    await collection.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch],
+                                                ordered=False)
+                else:
+                    await collection.insert_many(batch, ordered=False)
+                self.documents += len(batch)
+            finally:
+                self.slots.release()
+
+        while True:
+            batch = await asyncio.to_thread(next, batches, None)
+            if batch is None:
+                break
+            if inline_images:
+                for doc in batch:
+                    if "image_data_blob" in doc:
+                        doc["image_data"] = (await self.read_blob(doc.pop("image_data_blob"))).decode()
+            # Acquiring before spawning bounds the batches in flight across
+            # all collections.
+            await self.slots.acquire()
+            tasks.append(asyncio.create_task(write(batch)))
+        # Raises the first failed batch, after the rest have finished.
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            raise errors[0]
+
+    async def read_blob(self, sha):
+        def read():
+            with open(blob_path(self.args.dest, sha), "rb") as f:
+                return zstandard.ZstdDecompressor().stream_reader(f).read()
+        return await asyncio.to_thread(read)
+
+    async def restore_blobs(self):
+        files = self.db[f"{BLOB_COLLECTION}_data.files"]
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def upload(blob):
+            async with semaphore:
+                path = blob_path(self.args.dest, blob["_id"])
+                if not os.path.exists(path):
+                    # Released and deleted while the backup was running.
+                    logger.warning("X-ray file %s is missing from the backup", blob["_id"])
+                    return
+                if await files.find_one({"_id": blob["file_id"]}, {"_id": 1}):
+                    return
+                grid_in = self.bucket.open_upload_stream_with_id(blob["file_id"], blob["_id"])
+                with open(path, "rb") as f, \
+                        zstandard.ZstdDecompressor().stream_reader(f) as reader:
+                    while chunk := await asyncio.to_thread(reader.read, 1024 * 1024):
+                        await grid_in.write(chunk)
+                await grid_in.close()
+
+        blobs = await self.db[BLOB_COLLECTION].find({}, {"_id": 1, "file_id": 1}).to_list(None)
+        await asyncio.gather(*(upload(blob) for blob in blobs))
+        logger.info("Restored %d X-ray files", len(blobs))
+
+    async def build_indexes(self):
+        # Building each index once over the restored data is much faster than
+        # maintaining it through every insert.
+        latest = {}
+        for manifest in self.chain:
+            for name, info in manifest["collections"].items():
+                latest[name] = info["indexes"]
+        await asyncio.gather(*(
+            self.db.command({"createIndexes": name, "indexes": indexes})
+            for name, indexes in latest.items() if indexes
+        ))
+        logger.info("Built indexes for %d collections", sum(1 for indexes in latest.values() if indexes))
+
+
+async def create(args):
+    client = AsyncIOMotorClient(args.mongo_url)
+    base = None
+    if args.incremental:
+        backups = list_backups(args.dest)
+        if not backups:
+            sys.exit("No earlier backup to build on; run a full backup first")
+        base = backups[-1]
+    writer = BackupWriter(client[args.db_name], args, base)
+    started = time.monotonic()
+    manifest = await writer.create()
+    logger.info(
+        "Created %s backup %s: %d documents, %d new X-ray files (%d already stored) in %.1fs",
+        manifest["type"], manifest["id"], sum(info["documents"] for info in manifest["collections"].values()),
+        writer.blobs_stored, writer.blobs_skipped, time.monotonic() - started,
+    )
+    client.close()
+
+
+async def restore(args):
+    backups = list_backups(args.dest)
+    if not backups:
+        sys.exit(f"No backups in {args.dest}")
+    chain = backup_chain(args.dest, args.backup or backups[-1]["id"])
+    client = AsyncIOMotorClient(args.mongo_url)
+    db = client[args.db_name]
+    names = {name for manifest in chain for name in manifest["collections"]}
+    names |= {f"{BLOB_COLLECTION}_data.files", f"{BLOB_COLLECTION}_data.chunks"}
+    existing = [name for name in await db.list_collection_names() if name in names]
+    if existing and not args.drop:
+        sys.exit(f"{args.db_name} already has {', '.join(sorted(existing))}; pass --drop to replace them")
+    for name in existing:
+        await db.drop_collection(name)
+
+    restorer = Restorer(db, args, chain)
+    started = time.monotonic()
+    await restorer.restore()
+    logger.info("Restored %d documents from %d backups in %.1fs",
+                restorer.documents, len(chain), time.monotonic() - started)
+    client.close()
+
+
+def show(args):
+    for manifest in list_backups(args.dest):
+        documents = sum(info["documents"] for info in manifest["collections"].values())
+        print(f"{manifest['id']}  {manifest['type']:<11}  base={manifest['base'] or '-':<16}  {documents} documents")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Back up and restore the clinic database.")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default=os.environ.get("DB_NAME", "test_database"))
+    parser.add_argument("--dest", required=True, help="backup directory")
+    parser.add_argument("--concurrency", type=int, default=8, help="collections or batches in flight")
+    parser.add_argument("--batch-size", type=int, default=1000, help="documents per cursor batch or insert")
+    commands = parser.add_subparsers(dest="command", required=True)
+    create_parser = commands.add_parser("create", help="take a backup")
+    create_parser.add_argument("--incremental", action="store_true",
+                               help="only documents changed since the latest backup")
+    create_parser.add_argument("--level", type=int, default=3, help="zstd compression level")
+    restore_parser = commands.add_parser("restore", help="restore a backup and the backups it builds on")
+    restore_parser.add_argument("--backup", help="backup id (default: the latest)")
+    restore_parser.add_argument("--drop", action="store_true", help="replace collections that already exist")
+    commands.add_parser("list", help="list backups")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args()
+    if args.command == "list":
+        show(args)
+    else:
+        asyncio.run(create(args) if args.command == "create" else restore(args))
@@ -0,0 +1,65 @@
+import json
+import logging
+from urllib.parse import urlsplit
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
+from starlette.exceptions import HTTPException as StarletteHTTPException
+
+logger = logging.getLogger(__name__)
+
+# Sub-requests carry only the caller's credentials, not their other headers.
+FORWARDED_HEADERS = {b"authorization", b"accept-language"}
+
+
+async def dispatch(router, request, path, state):
+    # Runs one GET through `router` in-process, as if it had arrived on its
+    # own connection, and returns (status, body). `state` becomes the
+    # sub-request's request.state. Errors that the app's exception handlers
+    # would normally turn into responses are mapped the same way here.
+    target = urlsplit(path)
+    scope = {
+        "type": "http",
+        "asgi": request.scope.get("asgi", {"version": "3.0"}),
+        "http_version": request.scope.get("http_version", "1.1"),
+        "method": "GET",
+        "scheme": request.url.scheme,
+        "server": request.scope.get("server"),
+        "client": request.scope.get("client"),
+        "root_path": request.scope.get("root_path", ""),
+        "path": target.path,
+        "raw_path": target.path.encode(),
+        "query_string": target.query.encode(),
+        "headers": [(name, value) for name, value in request.scope["headers"] if name in FORWARDED_HEADERS],
+        "app": request.scope.get("app"),
+        "state": dict(state),
+    }
+    start = {}
+    chunks = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            start.update(message)
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    try:
+        await router(scope, receive, send)
+    except StarletteHTTPException as exc:
+        return exc.status_code, {"detail": exc.detail}
+    except RequestValidationError as exc:
+        return 422, {"detail": jsonable_encoder(exc.errors())}
+    except Exception:
+        logger.exception("Batched request to %s failed", target.path)
+        return 500, {"detail": "Internal Server Error"}
+
+    headers = {name.lower(): value for name, value in start.get("headers", [])}
+    body = b"".join(chunks)
+    if not body:
+        return start.get("status", 500), None
+    if not headers.get(b"content-type", b"").startswith(b"application/json"):
+        return 415, {"detail": "Only JSON endpoints can be batched"}
+    return start["status"], json.loads(body)
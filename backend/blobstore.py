@@ -0,0 +1,245 @@
+import hashlib
+import os
+import uuid
+from datetime import datetime, timezone
+
+from fastapi import HTTPException
+from gridfs import DEFAULT_CHUNK_SIZE
+from gridfs.errors import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from pymongo import ReturnDocument
+
+READ_CHUNK_BYTES = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.environ.get("XRAY_MAX_UPLOAD_MB", "50")) * 1024 * 1024
+
+# Leading bytes of the formats we accept; DICOM files start with a 128-byte
+# preamble followed by "DICM".
+SIGNATURES = [
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (0, b"BM", "image/bmp"),
+    (128, b"DICM", "application/dicom"),
+]
+SNIFF_BYTES = 132
+
+
+def sniff_content_type(head):
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for offset, signature, content_type in SIGNATURES:
+        if head[offset:offset + len(signature)] == signature:
+            return content_type
+    return None
+
+
+def too_large(max_bytes):
+    return HTTPException(status_code=413, detail=f"File exceeds the {max_bytes // (1024 * 1024)} MB limit")
+
+
+class BlobWriter:
+    # Streams one upload into GridFS under a fresh file id while hashing it.
+    # commit() then either records the content as a new blob or, if the same
+    # bytes are already stored, drops this copy and adds a reference instead.
+    def __init__(self, store, max_bytes, filename=None):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.file_id = str(uuid.uuid4())
+        self.grid_in = store.bucket.open_upload_stream_with_id(self.file_id, filename or self.file_id)
+        self.hasher = hashlib.sha256()
+        self.head = b""
+        self.size = 0
+        self.content_type = None
+
+    async def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            await self.abort()
+            raise too_large(self.max_bytes)
+        if len(self.head) < SNIFF_BYTES:
+            self.head += chunk[:SNIFF_BYTES - len(self.head)]
+            if len(self.head) >= SNIFF_BYTES:
+                await self._check_type()
+        self.hasher.update(chunk)
+        await self.grid_in.write(chunk)
+
+    async def _check_type(self):
+        self.content_type = sniff_content_type(self.head)
+        if self.content_type is None:
+            await self.abort()
+            raise HTTPException(status_code=415, detail="Unsupported file type")
+
+    async def commit(self, refs=1):
+        if not self.size:
+            await self.abort()
+            raise HTTPException(status_code=400, detail="Empty file")
+        if self.content_type is None:
+            await self._check_type()
+        await self.grid_in.close()
+        return await self.store.keep(self.hasher.hexdigest(), self.file_id, self.size, self.content_type, refs)
+
+    async def abort(self):
+        # Drops whatever was written, also once close() has run.
+        if not self.grid_in.closed:
+            await self.grid_in.abort()
+            return
+        try:
+            await self.store.bucket.delete(self.file_id)
+        except NoFile:
+            pass
+
+
+class BlobStore:
+    # Content-addressed storage: `xray_blobs` holds one document per distinct
+    # SHA-256 with a reference count; the bytes live in a GridFS bucket.
+    #
+    # A file that arrives over several requests is written straight into the
+    # bucket's chunks with put_chunk() under an id chosen up front, and
+    # adopt() then adds the GridFS file document once all of it is there.
+    # Until then the chunks belong to no file and GridFS readers ignore them.
+    chunk_size = DEFAULT_CHUNK_SIZE
+
+    def __init__(self, db, collection="xray_blobs"):
+        self.blobs = db[collection]
+        self.bucket = AsyncIOMotorGridFSBucket(db, bucket_name=f"{collection}_data")
+        self.files = db[f"{collection}_data.files"]
+        self.chunks = db[f"{collection}_data.chunks"]
+
+    async def ensure_indexes(self):
+        # The indexes GridFS would create on its first write; chunks written
+        # with put_chunk() may come first.
+        await self.files.create_index([("filename", 1), ("uploadDate", 1)])
+        await self.chunks.create_index([("files_id", 1), ("n", 1)], unique=True)
+
+    def writer(self, max_bytes=MAX_UPLOAD_BYTES, filename=None):
+        return BlobWriter(self, max_bytes, filename)
+
+    async def put_upload(self, upload, max_bytes=MAX_UPLOAD_BYTES):
+        # Reads the upload a chunk at a time, so neither the size limit nor the
+        # type check needs the whole file in memory. The form is parsed before
+        # the route runs, so the part's length is already known and a file
+        # that is too big is refused before anything reaches GridFS. Whatever
+        # stops the upload part-way, including a cancelled request, the
+        # partial file is removed.
+        if upload.size is not None and upload.size > max_bytes:
+            raise too_large(max_bytes)
+        writer = self.writer(max_bytes, upload.filename)
+        try:
+            while True:
+                chunk = await upload.read(READ_CHUNK_BYTES)
+                if not chunk:
+                    break
+                await writer.write(chunk)
+            return await writer.commit()
+        except BaseException:
+            await writer.abort()
+            raise
+
+    async def put_bytes(self, data, refs=1, max_bytes=MAX_UPLOAD_BYTES):
+        if len(data) > max_bytes:
+            raise too_large(max_bytes)
+        writer = self.writer(max_bytes)
+        try:
+            for start in range(0, len(data), READ_CHUNK_BYTES):
+                await writer.write(data[start:start + READ_CHUNK_BYTES])
+            return await writer.commit(refs)
+        except BaseException:
+            await writer.abort()
+            raise
+
+    async def put_chunk(self, file_id, n, data):
+        await self.chunks.replace_one(
+            {"files_id": file_id, "n": n}, {"files_id": file_id, "n": n, "data": data}, upsert=True
+        )
+
+    async def get_chunk(self, file_id, n):
+        chunk = await self.chunks.find_one({"files_id": file_id, "n": n}, {"_id": 0, "data": 1})
+        return chunk["data"] if chunk else None
+
+    def iter_chunks(self, file_id):
+        return self.chunks.find({"files_id": file_id}, {"_id": 0, "n": 1, "data": 1}).sort("n", 1)
+
+    async def discard_chunks(self, file_id, from_n=0):
+        await self.chunks.delete_many({"files_id": file_id, "n": {"$gte": from_n}})
+
+    async def has_file(self, file_id):
+        return await self.files.find_one({"_id": file_id}, {"_id": 1}) is not None
+
+    async def adopt(self, file_id, size, content_type, blob_id, filename=None, refs=1):
+        # `blob_id` is the SHA-256 of the chunks, which the caller has read.
+        await self.files.replace_one({"_id": file_id}, {
+            "_id": file_id,
+            "length": size,
+            "chunkSize": self.chunk_size,
+            "uploadDate": datetime.now(timezone.utc),
+            "filename": filename or file_id,
+        }, upsert=True)
+        return await self.keep(blob_id, file_id, size, content_type, refs)
+
+    async def keep(self, blob_id, file_id, size, content_type, refs=1):
+        # Records a stored file as the blob for its hash, or drops it if those
+        # bytes are already stored.
+        created = await self.add_reference(blob_id, file_id, size, content_type, refs)
+        if not created:
+            await self.bucket.delete(file_id)
+        return {"blob_id": blob_id, "size": size, "content_type": content_type, "deduplicated": not created}
+
+    async def add_reference(self, blob_id, file_id, size, content_type, count=1):
+        # Upserting on the hash makes concurrent uploads of the same bytes agree
+        # on a single stored copy. Returns True when this call created the blob.
+        result = await self.blobs.update_one(
+            {"_id": blob_id},
+            {
+                "$inc": {"ref_count": count},
+                "$setOnInsert": {
+                    "file_id": file_id,
+                    "size": size,
+                    "content_type": content_type,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                },
+            },
+            upsert=True,
+        )
+        return result.upserted_id is not None
+
+    async def release(self, blob_id):
+        blob = await self.blobs.find_one_and_update(
+            {"_id": blob_id, "ref_count": {"$gt": 0}},
+            {"$inc": {"ref_count": -1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if blob is None or blob["ref_count"] > 0:
+            return False
+        # Only delete if nobody re-referenced the blob in the meantime.
+        deleted = await self.blobs.delete_one({"_id": blob_id, "ref_count": 0})
+        if deleted.deleted_count:
+            await self.bucket.delete(blob["file_id"])
+            if blob.get("preview_blob_id"):
+                await self.release(blob["preview_blob_id"])
+            return True
+        return False
+
+    async def set_metadata(self, blob_id, field, value):
+        await self.blobs.update_one({"_id": blob_id}, {"$set": {field: value}})
+
+    async def set_preview(self, blob_id, preview_blob_id):
+        # A blob owns one reference to its preview. Returns False if another
+        # worker attached a preview first.
+        result = await self.blobs.update_one(
+            {"_id": blob_id, "preview_blob_id": {"$exists": False}},
+            {"$set": {"preview_blob_id": preview_blob_id}},
+        )
+        return bool(result.modified_count)
+
+    async def get(self, blob_id):
+        return await self.blobs.find_one({"_id": blob_id})
+
+    async def open(self, blob):
+        return await self.bucket.open_download_stream(blob["file_id"])
+
+    async def read(self, blob, size=-1):
+        stream = await self.open(blob)
+        return await stream.read(size)
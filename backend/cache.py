@@ -0,0 +1,59 @@
+import asyncio
+import functools
+import time
+
+
+class SingleFlightCache:
+    # Concurrent callers asking for the same key share one in-flight computation,
+    # and the result is kept for `ttl` seconds. invalidate() drops cached values
+    # and detaches in-flight computations so they can't repopulate stale data.
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+        self.in_flight = {}
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_compute(self, key, compute):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        task = self.in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(compute())
+            self.in_flight[key] = task
+            task.add_done_callback(functools.partial(self._finished, key, self.generation))
+        else:
+            self.coalesced += 1
+        # shield() keeps one caller's disconnect from cancelling everyone's result.
+        return await asyncio.shield(task)
+
+    def _finished(self, key, generation, task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+        if task.cancelled() or task.exception() is not None or generation != self.generation:
+            return
+        now = time.monotonic()
+        if len(self.entries) >= self.max_entries:
+            self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+        self.entries[key] = (now + self.ttl, task.result())
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries.clear()
+        self.in_flight.clear()
+
+    def stats(self):
+        return {
+            "ttl_seconds": self.ttl,
+            "entries": len(self.entries),
+            "in_flight": len(self.in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
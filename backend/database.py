@@ -0,0 +1,227 @@
+import asyncio
+import importlib.util
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReadPreference, monitoring
+from pymongo.errors import DuplicateKeyError
+
+from db_calls import DbCallTracker
+
+logger = logging.getLogger(__name__)
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+# Wire compressors pymongo can only use when the matching package is installed.
+COMPRESSOR_MODULES = {"zstd": "zstandard", "snappy": "snappy", "zlib": None}
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+
+def available_compressors(names):
+    compressors = []
+    for name in [n.strip() for n in names.split(",") if n.strip()]:
+        if name not in COMPRESSOR_MODULES:
+            logger.warning("Ignoring unknown MongoDB compressor %r", name)
+            continue
+        module = COMPRESSOR_MODULES[name]
+        if module and importlib.util.find_spec(module) is None:
+            logger.info("MongoDB compressor %r disabled: %s is not installed", name, module)
+            continue
+        compressors.append(name)
+    return compressors
+
+
+class PoolWaitTracker(monitoring.ConnectionPoolListener):
+    # Checkout start and completion happen on the same (executor) thread, so a
+    # thread-local start time gives the wait for each checkout.
+    def __init__(self, smoothing=0.2, stale_after=5.0):
+        self.smoothing = smoothing
+        self.stale_after = stale_after
+        self.average_wait = 0.0
+        self.max_wait = 0.0
+        self.checkouts = 0
+        self.failures = 0
+        self.updated_at = 0.0
+        self._local = threading.local()
+
+    def _record(self, wait):
+        self.average_wait += self.smoothing * (wait - self.average_wait)
+        self.max_wait = max(self.max_wait, wait)
+        self.updated_at = time.monotonic()
+
+    def current(self):
+        if time.monotonic() - self.updated_at > self.stale_after:
+            return 0.0
+        return self.average_wait
+
+    def stats(self):
+        return {
+            "avg_wait_ms": round(self.current() * 1000, 2),
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "checkouts": self.checkouts,
+            "checkout_failures": self.failures,
+        }
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.monotonic()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            self.checkouts += 1
+            self._record(time.monotonic() - started)
+            self._local.started = None
+
+    def connection_check_out_failed(self, event):
+        started = getattr(self._local, "started", None)
+        if started is not None:
+            self.failures += 1
+            self._record(time.monotonic() - started)
+            self._local.started = None
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+class MongoManager:
+    def __init__(self, url, db_name, reporting_read_preference="secondaryPreferred", **options):
+        if reporting_read_preference not in READ_PREFERENCES:
+            raise ValueError(f"Unknown read preference: {reporting_read_preference}")
+        self.url = url
+        self.db_name = db_name
+        self.options = options
+        self.pool_waits = PoolWaitTracker()
+        self.db_calls = DbCallTracker.from_env()
+        self.client = AsyncIOMotorClient(url, event_listeners=[self.pool_waits, self.db_calls], **options)
+        self.db = self.client[db_name]
+        # Reporting and list reads tolerate replication lag; booking and payment
+        # paths keep using self.db, which always reads from the primary.
+        self.reporting_db = self.client.get_database(
+            db_name, read_preference=READ_PREFERENCES[reporting_read_preference]
+        )
+
+    @classmethod
+    def from_env(cls, **overrides):
+        options = {
+            "maxPoolSize": _env_int("MONGO_MAX_POOL_SIZE", 100),
+            "minPoolSize": _env_int("MONGO_MIN_POOL_SIZE", 10),
+            "maxIdleTimeMS": _env_int("MONGO_MAX_IDLE_TIME_MS", 300000),
+            "serverSelectionTimeoutMS": _env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+            "connectTimeoutMS": _env_int("MONGO_CONNECT_TIMEOUT_MS", 5000),
+            "socketTimeoutMS": _env_int("MONGO_SOCKET_TIMEOUT_MS", 60000),
+            "waitQueueTimeoutMS": _env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000),
+            "appname": os.environ.get("MONGO_APP_NAME", "dental-clinic-api"),
+        }
+        compressors = available_compressors(os.environ.get("MONGO_COMPRESSORS", "zstd,snappy,zlib"))
+        if compressors:
+            options["compressors"] = ",".join(compressors)
+        options.update(overrides)
+        return cls(
+            os.environ["MONGO_URL"],
+            os.environ["DB_NAME"],
+            reporting_read_preference=os.environ.get("MONGO_REPORTING_READ_PREFERENCE", "secondaryPreferred"),
+            **options,
+        )
+
+    async def warm_up(self):
+        # Concurrent pings force the driver to open minPoolSize sockets now
+        # instead of on the first requests after a deploy.
+        connections = max(1, self.options.get("minPoolSize", 1))
+        await asyncio.gather(*[self.db.command("ping") for _ in range(connections)])
+        if self.reporting_db.read_preference != ReadPreference.PRIMARY:
+            read_preference = self.reporting_db.read_preference
+            await asyncio.gather(*[
+                self.reporting_db.command("ping", read_preference=read_preference) for _ in range(connections)
+            ])
+        logger.info("MongoDB connection pool warmed up (%d connections)", connections)
+
+    async def ping(self, timeout=2.0):
+        await asyncio.wait_for(self.db.command("ping"), timeout)
+
+    def close(self):
+        self.client.close()
+
+
+@asynccontextmanager
+async def startup_lock(db, name, ttl_seconds=60, wait_seconds=0, poll_interval=0.5):
+    # Serializes a startup step across worker processes and hosts. Yields True
+    # to the process holding the lease, and False to the others once
+    # `wait_seconds` have passed; by default they skip the step rather than
+    # hold up their own startup (gunicorn kills workers that don't finish
+    # booting within its timeout). The lease is renewed while the step runs,
+    # and an expired one is taken over, so a worker that crashed mid-step
+    # can't block the next deploy.
+    owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    deadline = asyncio.get_running_loop().time() + wait_seconds
+    while True:
+        now = datetime.now(timezone.utc)
+        lease = {"owner": owner, "expires_at": now + timedelta(seconds=ttl_seconds)}
+        try:
+            await db.startup_locks.insert_one({"_id": name, **lease})
+            break
+        except DuplicateKeyError:
+            result = await db.startup_locks.update_one(
+                {"_id": name, "expires_at": {"$lt": now}}, {"$set": lease}
+            )
+            if result.modified_count:
+                break
+        if asyncio.get_running_loop().time() >= deadline:
+            yield False
+            return
+        await asyncio.sleep(poll_interval)
+
+    async def renew():
+        while True:
+            await asyncio.sleep(ttl_seconds / 3)
+            result = await db.startup_locks.update_one(
+                {"_id": name, "owner": owner},
+                {"$set": {"expires_at": datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)}},
+            )
+            if not result.modified_count:
+                logger.warning("Lost startup lock %r", name)
+                return
+
+    renewal = asyncio.create_task(renew())
+    try:
+        yield True
+    finally:
+        renewal.cancel()
+        await db.startup_locks.delete_one({"_id": name, "owner": owner})
@@ -0,0 +1,112 @@
+import contextvars
+import logging
+import os
+import threading
+
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar("db_calls", default=None)
+
+# Follow-up batches of a cursor that was already counted; many of them is a
+# big result, not a query in a loop.
+NOT_REPEATS = {"getMore", "endSessions"}
+
+
+class RequestCalls:
+    def __init__(self):
+        self.total = 0
+        self.duration_ms = 0.0
+        self.shapes = {}
+        self._lock = threading.Lock()
+
+    def record(self, command_name, collection):
+        with self._lock:
+            self.total += 1
+            if command_name not in NOT_REPEATS:
+                shape = (command_name, collection)
+                self.shapes[shape] = self.shapes.get(shape, 0) + 1
+
+    def add_duration(self, duration_micros):
+        with self._lock:
+            self.duration_ms += duration_micros / 1000
+
+    def repeats(self, threshold):
+        return {shape: count for shape, count in self.shapes.items() if count >= threshold}
+
+
+class DbCallTracker(monitoring.CommandListener):
+    # Counts the MongoDB commands each request sends. Motor runs commands on
+    # executor threads with a copy of the caller's context, so the listener
+    # finds the request's counter through a context variable. The same
+    # command against the same collection `repeat_threshold` times in one
+    # request is logged as a likely N+1 (a query per item of a list).
+    def __init__(self, enabled=False, budget=0, repeat_threshold=5):
+        self.enabled = enabled
+        self.budget = budget
+        self.repeat_threshold = repeat_threshold
+        self.endpoints = {}
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            enabled=os.environ.get("DB_CALL_DEBUG", "0") == "1",
+            budget=int(os.environ.get("DB_CALL_BUDGET", "0")),
+            repeat_threshold=int(os.environ.get("DB_CALL_REPEAT_THRESHOLD", "5")),
+        )
+
+    def start(self):
+        calls = RequestCalls()
+        return calls, _current.set(calls)
+
+    def finish(self, token, calls, endpoint):
+        _current.reset(token)
+        stats = self.endpoints.setdefault(
+            endpoint, {"requests": 0, "calls": 0, "max_calls": 0, "db_ms": 0.0, "over_budget": 0, "repeated": 0}
+        )
+        stats["requests"] += 1
+        stats["calls"] += calls.total
+        stats["max_calls"] = max(stats["max_calls"], calls.total)
+        stats["db_ms"] += calls.duration_ms
+        if self.budget and calls.total > self.budget:
+            stats["over_budget"] += 1
+            logger.warning("%s made %d database calls (budget %d)", endpoint, calls.total, self.budget)
+        repeats = calls.repeats(self.repeat_threshold)
+        if repeats:
+            stats["repeated"] += 1
+            logger.warning("%s repeated database calls, likely N+1: %s", endpoint, ", ".join(
+                f"{name} on {collection} x{count}" for (name, collection), count in repeats.items()
+            ))
+
+    def stats(self):
+        if not self.enabled:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            "budget": self.budget,
+            "endpoints": {
+                endpoint: {
+                    **stats,
+                    "avg_calls": round(stats["calls"] / stats["requests"], 2),
+                    "db_ms": round(stats["db_ms"], 2),
+                }
+                for endpoint, stats in sorted(self.endpoints.items())
+            },
+        }
+
+    def started(self, event):
+        calls = _current.get()
+        if calls is not None:
+            collection = event.command.get(event.command_name)
+            if not isinstance(collection, str):
+                collection = event.command.get("collection", "")
+            calls.record(event.command_name, collection)
+
+    def succeeded(self, event):
+        calls = _current.get()
+        if calls is not None:
+            calls.add_duration(event.duration_micros)
+
+    def failed(self, event):
+        self.succeeded(event)
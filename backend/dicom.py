@@ -0,0 +1,83 @@
+import io
+import logging
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    numpy = Image = None
+
+logger = logging.getLogger(__name__)
+
+DICOM_CONTENT_TYPE = "application/dicom"
+# Headers almost always fit in the first megabyte; pixel data follows them.
+HEADER_BYTES = 1024 * 1024
+PREVIEW_SIZE = (1024, 1024)
+
+# DICOM attribute -> field on the X-ray record.
+HEADER_FIELDS = {
+    "StudyDate": "study_date",
+    "Modality": "modality",
+    "BodyPartExamined": "body_part",
+    "StudyDescription": "study_description",
+}
+
+
+def header_available():
+    return pydicom is not None
+
+
+def preview_available():
+    return pydicom is not None and numpy is not None
+
+
+def parse_header(data):
+    # Reads the header only; stop_before_pixels means pixel data is never
+    # decoded, and a truncated file is fine as long as the header is complete.
+    dataset = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True, force=True)
+    metadata = {}
+    for keyword, field in HEADER_FIELDS.items():
+        value = dataset.get(keyword)
+        if value not in (None, ""):
+            metadata[field] = str(value).strip()
+    if len(metadata.get("study_date", "")) == 8:
+        raw = metadata["study_date"]
+        metadata["study_date"] = f"{raw[:4]}-{raw[4:6]}-{raw[6:]}"
+    device = " ".join(
+        str(dataset.get(keyword)).strip()
+        for keyword in ("Manufacturer", "ManufacturerModelName")
+        if dataset.get(keyword)
+    ) or dataset.get("StationName")
+    if device:
+        metadata["device"] = str(device)
+    if metadata.get("modality"):
+        metadata["modality"] = metadata["modality"].upper()
+    if metadata.get("body_part"):
+        metadata["body_part"] = metadata["body_part"].upper()
+    return metadata
+
+
+def render_preview(data):
+    # Decodes the first frame and scales it to an 8-bit PNG thumbnail.
+    dataset = pydicom.dcmread(io.BytesIO(data), force=True)
+    pixels = dataset.pixel_array
+    if pixels.ndim == 4 or (pixels.ndim == 3 and pixels.shape[-1] not in (3, 4)):
+        pixels = pixels[0]
+    pixels = pixels.astype("float64")
+    low, high = float(pixels.min()), float(pixels.max())
+    if high > low:
+        pixels = (pixels - low) / (high - low) * 255.0
+    else:
+        pixels = numpy.zeros_like(pixels)
+    if str(dataset.get("PhotometricInterpretation", "")) == "MONOCHROME1":
+        pixels = 255.0 - pixels
+    image = Image.fromarray(pixels.astype("uint8"))
+    image.thumbnail(PREVIEW_SIZE)
+    output = io.BytesIO()
+    image.save(output, format="PNG", optimize=True)
+    return output.getvalue()
@@ -0,0 +1,268 @@
+"""Export clinic data to partitioned Parquet files for offline analysis.
+
+Usage (from the backend/ directory):
+
+    python export_parquet.py --out /srv/analytics           # changes since the last run
+    python export_parquet.py --out /srv/analytics --full    # replace with everything
+
+patients, appointments, payments and patient_history are each written as a
+Hive-partitioned dataset with typed columns,
+
+    <out>/<collection>/month=YYYY-MM/doctor_id=<id>/part-<run>-<n>.parquet
+
+which pyarrow, pandas, DuckDB and Spark read directly. Names, phone numbers
+and clinical notes are left out; rows reference patients and doctors by id.
+
+Runs are incremental. <out>/_state.json keeps the highest sync version
+exported from each collection, and the next run exports only documents
+written after it. A document that changed is exported again, so readers
+should keep the row with the highest `version` for each `id`. Archived
+records are exported with the rest.
+
+Records from before delta sync have no version until the
+backfill_legacy_records job stamps them, which needs a job worker (see
+DEPLOYMENT.md). A first or --full run exports them anyway, with an empty
+version; incremental runs pick them up again once they are stamped.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from archive import RULES, Archiver
+from sync import parse_time
+
+logger = logging.getLogger("export_parquet")
+
+TIMESTAMP = pa.timestamp("us", tz="UTC")
+STRINGS = pa.list_(pa.string())
+
+# Per collection: the field that picks the month partition, and the columns.
+TABLES = {
+    "patients": {
+        "month": "created_at",
+        "columns": [
+            ("id", pa.string()), ("doctor_id", pa.string()), ("created_at", TIMESTAMP),
+            ("total_cost", pa.float64()), ("total_paid", pa.float64()), ("balance", pa.float64()),
+            ("ledger_seq", pa.int64()), ("version", pa.int64()), ("updated_at", TIMESTAMP),
+        ],
+    },
+    "appointments": {
+        "month": "date",
+        "columns": [
+            ("id", pa.string()), ("patient_id", pa.string()), ("doctor_id", pa.string()),
+            ("date", pa.date32()), ("time", pa.string()), ("status", pa.string()),
+            ("duration_minutes", pa.int32()), ("procedures", STRINGS), ("planned_procedures", STRINGS),
+            ("series_id", pa.string()), ("created_at", TIMESTAMP), ("version", pa.int64()), ("updated_at", TIMESTAMP),
+        ],
+    },
+    "payments": {
+        "month": "payment_date",
+        "columns": [
+            ("id", pa.string()), ("patient_id", pa.string()), ("doctor_id", pa.string()),
+            ("amount", pa.float64()), ("payment_date", TIMESTAMP), ("recorded_by", pa.string()),
+            ("version", pa.int64()), ("updated_at", TIMESTAMP),
+        ],
+    },
+    "patient_history": {
+        "month": "date",
+        "columns": [
+            ("id", pa.string()), ("patient_id", pa.string()), ("doctor_id", pa.string()),
+            ("date", TIMESTAMP), ("procedures", STRINGS), ("total_cost", pa.float64()),
+            ("version", pa.int64()), ("updated_at", TIMESTAMP),
+        ],
+    },
+}
+
+
+def convert(value, column_type):
+    # Coerces one Mongo value to the column's type; anything malformed is null.
+    if value is None:
+        return None
+    try:
+        if column_type == TIMESTAMP:
+            return parse_time(value)
+        if column_type == pa.date32():
+            return value.date() if isinstance(value, datetime) else date.fromisoformat(str(value)[:10])
+        if column_type == STRINGS:
+            return [str(item) for item in value]
+        if pa.types.is_floating(column_type):
+            return float(value)
+        if pa.types.is_integer(column_type):
+            return int(value)
+        return str(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def month_of(value):
+    if isinstance(value, str) and len(value) >= 7 and value[4] == "-":
+        return value[:7]
+    parsed = parse_time(value)
+    return f"{parsed:%Y-%m}" if parsed else "unknown"
+
+
+class DatasetWriter:
+    # One open ParquetWriter per (month, doctor) partition. Documents arrive
+    # sorted by month, so finished months are closed as the export moves on
+    # and only one month's writers are open at a time.
+    def __init__(self, root, schema, run_id, row_group_size):
+        self.root = root
+        self.schema = schema
+        self.run_id = run_id
+        self.row_group_size = row_group_size
+        self.open = {}
+        self.parts = {}
+        self.rows = 0
+        self.files = 0
+
+    def add(self, month, doctor_id, row):
+        key = (month, doctor_id)
+        if key not in self.open:
+            self.close(keep=month)
+            self.open[key] = (*self._writer(key), {name: [] for name in self.schema.names})
+        buffer = self.open[key][-1]
+        for name in self.schema.names:
+            buffer[name].append(row[name])
+        if len(buffer["id"]) >= self.row_group_size:
+            self._flush(key)
+
+    def close(self, keep=None):
+        for key in [key for key in self.open if key[0] != keep]:
+            self._flush(key)
+            writer, temp_path, final_path, _ = self.open.pop(key)
+            writer.close()
+            # Written under a dotted name and renamed when complete, so readers
+            # never see a half-written file.
+            os.replace(temp_path, final_path)
+
+    def _writer(self, key):
+        month, doctor_id = key
+        directory = os.path.join(self.root, f"month={month}", f"doctor_id={doctor_id}")
+        os.makedirs(directory, exist_ok=True)
+        part = self.parts.get(key, 0)
+        self.parts[key] = part + 1
+        name = f"part-{self.run_id}-{part}.parquet"
+        temp_path = os.path.join(directory, f".{name}.tmp")
+        self.files += 1
+        return pq.ParquetWriter(temp_path, self.schema, compression="zstd"), temp_path, os.path.join(directory, name)
+
+    def _flush(self, key):
+        writer, _, _, buffer = self.open[key]
+        if not buffer["id"]:
+            return
+        writer.write_table(pa.Table.from_pydict(buffer, schema=self.schema))
+        self.rows += len(buffer["id"])
+        for column in buffer.values():
+            column.clear()
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(path, state):
+    temp = f"{path}.tmp"
+    with open(temp, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(temp, path)
+
+
+async def export_collection(db, archiver, args, name, since, cutoff, doctors):
+    spec = TABLES[name]
+    schema = pa.schema(spec["columns"])
+    fields = [column for column, _ in spec["columns"]]
+    # Documents written within the settle window may still have lower-versioned
+    # writes in flight; they're left for the next run.
+    query = {"updated_at": {"$lte": cutoff}}
+    if since is not None:
+        query["version"] = {"$gt": since}
+    else:
+        # A first or full run also takes records the backfill hasn't stamped yet.
+        query = {"$or": [query, {"updated_at": {"$exists": False}}]}
+    collections = [db[name]]
+    if name in RULES:
+        # Archived records keep their version and are exported like the rest.
+        # One caught mid-move can be read from both; readers dedupe by id anyway.
+        collections.append(archiver.archive(db, name))
+
+    run_id = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}"
+    writer = DatasetWriter(os.path.join(args.out, name), schema, run_id, args.row_group_size)
+    highest = since or 0
+    try:
+        for collection in collections:
+            cursor = collection.find(
+                query, {"_id": 0, **{field: 1 for field in fields}}, allow_disk_use=True
+            ).sort(spec["month"], 1).batch_size(args.batch_size)
+            async for doc in cursor:
+                if name == "payments":
+                    doc["doctor_id"] = doctors.get(doc.get("patient_id"))
+                row = {column: convert(doc.get(column), column_type) for column, column_type in spec["columns"]}
+                writer.add(month_of(doc.get(spec["month"])), row["doctor_id"] or "unknown", row)
+                highest = max(highest, row["version"] or 0)
+            writer.close()
+    finally:
+        writer.close()
+    return highest, writer.rows, writer.files
+
+
+async def export(args):
+    client = AsyncIOMotorClient(args.mongo_url)
+    db = client[args.db_name]
+    archiver = Archiver.from_env(db)
+    os.makedirs(args.out, exist_ok=True)
+    state_path = os.path.join(args.out, "_state.json")
+    state = {} if args.full else load_state(state_path)
+    cutoff = (datetime.now(timezone.utc) - timedelta(seconds=args.settle_seconds)).isoformat()
+
+    doctors = {}
+    if "payments" in args.collection:
+        # Payments don't carry a doctor; they're partitioned by the patient's.
+        async for patient in db.patients.find({}, {"_id": 0, "id": 1, "doctor_id": 1}).batch_size(args.batch_size):
+            doctors[patient["id"]] = patient.get("doctor_id")
+
+    for name in args.collection:
+        started = time.monotonic()
+        since = state.get(name, {}).get("version")
+        if args.full:
+            shutil.rmtree(os.path.join(args.out, name), ignore_errors=True)
+        highest, rows, files = await export_collection(db, archiver, args, name, since, cutoff, doctors)
+        state[name] = {"version": highest, "exported_at": datetime.now(timezone.utc).isoformat()}
+        save_state(state_path, state)
+        logger.info("Exported %d %s rows to %d files in %.1fs", rows, name, files, time.monotonic() - started)
+    client.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export clinic data to partitioned Parquet files.")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default=os.environ.get("DB_NAME", "test_database"))
+    parser.add_argument("--out", default="analytics", help="output directory")
+    parser.add_argument("--collection", action="append", choices=sorted(TABLES),
+                        help="only export this collection (repeatable)")
+    parser.add_argument("--full", action="store_true", help="replace the exported data with a fresh export of everything")
+    parser.add_argument("--batch-size", type=int, default=5000, help="documents per cursor batch")
+    parser.add_argument("--row-group-size", type=int, default=50000, help="rows per Parquet row group")
+    parser.add_argument("--settle-seconds", type=float, default=60,
+                        help="skip documents written this recently; the next run picks them up")
+    args = parser.parse_args(argv)
+    args.collection = args.collection or list(TABLES)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(export(parse_args()))
@@ -0,0 +1,45 @@
+from functools import lru_cache
+from typing import List
+
+from fastapi import HTTPException, Response
+from pydantic import ConfigDict, TypeAdapter, create_model
+
+
+def parse_fields(fields, allowed):
+    # Turns "?fields=name,phone" into a tuple of field names, always including
+    # "id". Returns None when the caller didn't ask for a sparse response.
+    if fields is None:
+        return None
+    requested = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    invalid = [f for f in requested if f not in allowed]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Unknown or forbidden fields: {', '.join(invalid)}")
+    if "id" not in requested:
+        requested.insert(0, "id")
+    return tuple(requested)
+
+
+def projection(fields, extra=()):
+    return {"_id": 0, **{field: 1 for field in (*fields, *extra)}}
+
+
+@lru_cache(maxsize=256)
+def sparse_model(model, fields):
+    return create_model(
+        f"{model.__name__}Fields",
+        __config__=ConfigDict(extra="ignore"),
+        **{name: (model.model_fields[name].annotation, model.model_fields[name]) for name in fields},
+    )
+
+
+@lru_cache(maxsize=256)
+def _adapter(model, fields, many):
+    submodel = sparse_model(model, fields)
+    return TypeAdapter(List[submodel] if many else submodel)
+
+
+def sparse_response(model, fields, data, many=True):
+    # Validates and serializes only the selected fields, bypassing the route's
+    # full response_model.
+    adapter = _adapter(model, fields, many)
+    return Response(content=adapter.dump_json(adapter.validate_python(data)), media_type="application/json")
@@ -0,0 +1,366 @@
+"""Generate a synthetic clinic dataset for scale testing.
+
+Usage (from the backend/ directory):
+
+    python generate_dataset.py --doctors 20 --patients 100000 --seed 42
+
+The generated documents have the same shapes the API handlers in server.py
+write, and patient balances match the generated history, appointments and
+payments. The same --seed always produces the same dataset.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from blobstore import BlobStore
+from ledger import entries_from_sources, number_entries
+from schedule import DEFAULT_APPOINTMENT_MINUTES, appointment_interval
+from server import (
+    DEFAULT_PROCEDURES, Appointment, Patient, PatientHistory, Payment, User,
+    get_password_hash,
+)
+
+logger = logging.getLogger("generate_dataset")
+
+LATIN_FIRST_NAMES = [
+    "Omar", "Lina", "Sami", "Rania", "Khaled", "Nour", "Yousef", "Dana", "Ahmad", "Maya",
+    "Tariq", "Sara", "Hadi", "Leen", "Faris", "Hala", "Zaid", "Reem", "Karim", "Jana",
+]
+LATIN_LAST_NAMES = [
+    "Haddad", "Khoury", "Nasser", "Saleh", "Mansour", "Qasem", "Hamdan", "Azar", "Shami", "Odeh",
+    "Barakat", "Jaber", "Rashid", "Tamimi", "Zoubi", "Masri", "Halabi", "Kanaan", "Darwish", "Sabbagh",
+]
+ARABIC_FIRST_NAMES = [
+    "عمر", "لينا", "سامي", "رانيا", "خالد", "نور", "يوسف", "دانا", "أحمد", "مايا",
+    "طارق", "سارة", "هادي", "لين", "فارس", "هالة", "زيد", "ريم", "كريم", "جنى",
+]
+ARABIC_LAST_NAMES = [
+    "حداد", "خوري", "ناصر", "صالح", "منصور", "قاسم", "حمدان", "عازر", "شامي", "عودة",
+    "بركات", "جابر", "راشد", "تميمي", "زعبي", "مصري", "حلبي", "كنعان", "درويش", "صباغ",
+]
+HISTORY_NOTES = [
+    "Routine check-up, no issues found.",
+    "Patient reports sensitivity on lower left molar.",
+    "Signs of bruxism, night guard recommended.",
+    "Gum inflammation, advised improved flossing.",
+    "Follow-up after extraction, healing well.",
+    "Cavity detected on upper right premolar.",
+    "Orthodontic adjustment performed.",
+    "Crown fitted and bite checked.",
+]
+PAYMENT_NOTES = ["", "Cash", "Card", "Insurance co-pay", "Installment"]
+APPOINTMENT_TIMES = [f"{hour:02d}:{minute:02d}" for hour in range(9, 17) for minute in (0, 30)]
+
+# A 1x1 PNG; repeated to the requested size so X-ray payloads have realistic weight.
+PNG_HEADER = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=="
+)
+
+
+class BatchWriter:
+    def __init__(self, db, batch_size, concurrency):
+        self.db = db
+        self.batch_size = batch_size
+        self.buffers = {}
+        self.counts = {}
+        self.tasks = set()
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def add(self, collection, doc):
+        buffer = self.buffers.setdefault(collection, [])
+        buffer.append(doc)
+        if len(buffer) >= self.batch_size:
+            self.buffers[collection] = []
+            await self._submit(collection, buffer)
+
+    async def _submit(self, collection, docs):
+        # Acquiring before spawning the task bounds the number of in-flight batches,
+        # so generation never runs far ahead of the database.
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self._insert(collection, docs))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _insert(self, collection, docs):
+        try:
+            await self.db[collection].insert_many(docs, ordered=False)
+            self.counts[collection] = self.counts.get(collection, 0) + len(docs)
+        finally:
+            self.semaphore.release()
+
+    async def flush(self):
+        for collection, buffer in list(self.buffers.items()):
+            if buffer:
+                self.buffers[collection] = []
+                await self._submit(collection, buffer)
+        if self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+class ClinicGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.now = datetime(2026, 1, 1, tzinfo=timezone.utc) if args.fixed_clock else datetime.now(timezone.utc)
+        self.validated = set()
+        # Staff re-upload the same radiographs, so X-rays reference a small pool
+        # of distinct payloads; generate() stores each one once.
+        self.xray_pool = []
+        self.xray_refs = {}
+
+    def new_id(self):
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def timestamp_within(self, days_back, days_forward=0):
+        offset = self.rng.uniform(-days_back * 86400, days_forward * 86400)
+        return self.now + timedelta(seconds=offset)
+
+    def person_name(self):
+        if self.rng.random() < self.args.arabic_ratio:
+            return f"{self.rng.choice(ARABIC_FIRST_NAMES)} {self.rng.choice(ARABIC_LAST_NAMES)}"
+        return f"{self.rng.choice(LATIN_FIRST_NAMES)} {self.rng.choice(LATIN_LAST_NAMES)}"
+
+    def phone(self):
+        return f"+962-7{self.rng.randint(7, 9)}-{self.rng.randint(100, 999)}-{self.rng.randint(1000, 9999)}"
+
+    def validate(self, model, doc):
+        # Check the first document of every kind against the API models, so shape
+        # drift between this script and server.py fails fast instead of silently.
+        if model not in self.validated:
+            model(**doc)
+            self.validated.add(model)
+
+    def procedures(self):
+        return [{"id": self.new_id(), **proc} for proc in DEFAULT_PROCEDURES]
+
+    def doctors(self, password_hash):
+        doctors = []
+        for index in range(self.args.doctors):
+            doctor = {
+                "email": f"doctor{index + 1}@clinic.test",
+                "name": f"Dr. {self.person_name()}",
+                "phone": self.phone(),
+                "role": "doctor",
+                "id": self.new_id(),
+                "created_at": self.timestamp_within(self.args.days * 2).isoformat(),
+                "password_hash": password_hash,
+            }
+            self.validate(User, doctor)
+            doctors.append(doctor)
+        return doctors
+
+    def pick_procedures(self, catalog, max_count):
+        count = self.rng.randint(1, max_count)
+        return self.rng.sample(catalog, min(count, len(catalog)))
+
+    def xray_payload(self):
+        if len(self.xray_pool) < self.args.xray_distinct:
+            payload = PNG_HEADER + self.rng.randbytes(self.args.xray_bytes)
+            self.xray_pool.append((hashlib.sha256(payload).hexdigest(), payload))
+        blob_id, payload = self.rng.choice(self.xray_pool)
+        self.xray_refs[blob_id] = self.xray_refs.get(blob_id, 0) + 1
+        return blob_id, payload
+
+    def patient_records(self, doctor, catalog, staff):
+        patient_id = self.new_id()
+        patient_name = self.person_name()
+        created_at = self.timestamp_within(self.args.days)
+        total_cost = 0.0
+        records = []
+
+        appointment_count = self.rng.randint(0, self.args.appointments_per_patient * 2)
+        for _ in range(appointment_count):
+            when = self.timestamp_within(self.args.days, days_forward=30)
+            if when > self.now:
+                status = self.rng.choice(["confirmed", "confirmed", "cancelled"])
+            else:
+                status = self.rng.choice(["done", "done", "done", "cancelled", "confirmed"])
+            procedures = []
+            if status == "done":
+                procedures = self.pick_procedures(catalog, 2)
+                total_cost += sum(proc["price"] for proc in procedures)
+            day, slot = when.strftime("%Y-%m-%d"), self.rng.choice(APPOINTMENT_TIMES)
+            duration = sum(proc.get("duration_minutes", DEFAULT_APPOINTMENT_MINUTES) for proc in procedures) or DEFAULT_APPOINTMENT_MINUTES
+            start_at, end_at = appointment_interval(day, slot, duration)
+            appointment = {
+                "patient_id": patient_id,
+                "doctor_id": doctor["id"],
+                "date": day,
+                "time": slot,
+                "status": status,
+                "duration_minutes": duration,
+                "start_at": start_at,
+                "end_at": end_at,
+                "planned_procedures": [],
+                "id": self.new_id(),
+                "created_at": (when - timedelta(days=self.rng.randint(1, 30))).isoformat(),
+                "procedures": [proc["id"] for proc in procedures],
+                "notes": "",
+                "patient_name": patient_name,
+                "doctor_name": doctor["name"],
+            }
+            self.validate(Appointment, appointment)
+            records.append(("appointments", appointment))
+
+        history_ids = []
+        for _ in range(self.rng.randint(0, self.args.history_per_patient * 2)):
+            procedures = self.pick_procedures(catalog, 3)
+            cost = sum(proc["price"] for proc in procedures)
+            total_cost += cost
+            history = {
+                "patient_id": patient_id,
+                "notes": self.rng.choice(HISTORY_NOTES),
+                "procedures": [proc["id"] for proc in procedures],
+                "procedure_names": [name for proc in procedures for name in (proc["name_en"], proc["name_ar"])],
+                "id": self.new_id(),
+                "doctor_id": doctor["id"],
+                "date": self.timestamp_within(self.args.days).isoformat(),
+                "xray_images": [],
+                "total_cost": cost,
+            }
+            self.validate(PatientHistory, history)
+            history_ids.append(history["id"])
+            records.append(("patient_history", history))
+
+        total_paid = 0.0
+        remaining = total_cost
+        for _ in range(self.rng.randint(0, self.args.payments_per_patient * 2)):
+            if remaining <= 0:
+                break
+            amount = round(min(remaining, self.rng.choice([25.0, 50.0, 75.0, 100.0, 150.0, 200.0, 500.0])), 2)
+            remaining -= amount
+            total_paid += amount
+            recorder = self.rng.choice(staff)
+            payment = {
+                "patient_id": patient_id,
+                "amount": amount,
+                "notes": self.rng.choice(PAYMENT_NOTES),
+                "id": self.new_id(),
+                "payment_date": self.timestamp_within(self.args.days).isoformat(),
+                "recorded_by": recorder["id"],
+                "recorded_by_name": recorder["name"],
+                "patient_name": patient_name,
+            }
+            self.validate(Payment, payment)
+            records.append(("payments", payment))
+
+        if self.args.xray_ratio and self.rng.random() < self.args.xray_ratio:
+            blob_id, payload = self.xray_payload()
+            records.append(("xray_images", {
+                "id": self.new_id(),
+                "patient_id": patient_id,
+                "doctor_id": doctor["id"],
+                "blob_id": blob_id,
+                "content_type": "image/png",
+                "size": len(payload),
+                "filename": f"xray-{patient_id[:8]}.png",
+                "uploaded_at": self.timestamp_within(self.args.days).isoformat(),
+            }))
+
+        # The ledger is derived the same way rebuild_balances.py --from-source does.
+        sources = {"history": [], "appointments": [], "payments": []}
+        for collection, doc in records:
+            if collection == "patient_history":
+                sources["history"].append(doc)
+            elif collection in ("appointments", "payments"):
+                sources[collection].append(doc)
+        prices = {proc["id"]: proc["price"] for proc in catalog}
+        entries, snapshots, _ = number_entries(patient_id, entries_from_sources(prices=prices, **sources))
+        records.extend(("ledger", entry) for entry in entries)
+        records.extend(("ledger_snapshots", snapshot) for snapshot in snapshots)
+
+        patient = {
+            "name": patient_name,
+            "phone": self.phone(),
+            "doctor_id": doctor["id"],
+            "id": patient_id,
+            "created_at": created_at.isoformat(),
+            "total_cost": total_cost,
+            "total_paid": total_paid,
+            "balance": total_cost - total_paid,
+            "ledger_seq": len(entries),
+            "doctor_name": doctor["name"],
+        }
+        self.validate(Patient, patient)
+        records.append(("patients", patient))
+        return records
+
+
+async def generate(args):
+    client = AsyncIOMotorClient(args.mongo_url)
+    db = client[args.db_name]
+    generator = ClinicGenerator(args)
+
+    if args.drop:
+        for collection in ["users", "procedures", "patients", "appointments", "patient_history", "payments", "xray_images",
+                           "xray_blobs", "xray_blobs_data.files", "xray_blobs_data.chunks", "ledger", "ledger_snapshots"]:
+            await db[collection].drop()
+
+    catalog = await db.procedures.find({}, {"_id": 0}).to_list(1000)
+    if not catalog:
+        catalog = generator.procedures()
+        await db.procedures.insert_many([dict(proc) for proc in catalog])
+
+    # bcrypt is deliberately slow, so every generated staff account shares one hash.
+    password_hash = get_password_hash(args.password)
+    doctors = generator.doctors(password_hash)
+    await db.users.insert_many([dict(doctor) for doctor in doctors])
+    staff = await db.users.find({"role": {"$in": ["admin", "receptionist"]}}, {"_id": 0, "id": 1, "name": 1}).to_list(1000)
+    if not staff:
+        staff = doctors
+
+    writer = BatchWriter(db, args.batch_size, args.concurrency)
+    started = time.monotonic()
+    for index in range(args.patients):
+        doctor = doctors[index % len(doctors)]
+        for collection, doc in generator.patient_records(doctor, catalog, staff):
+            await writer.add(collection, doc)
+        if (index + 1) % 10000 == 0:
+            logger.info("Generated %d/%d patients (%.1fs)", index + 1, args.patients, time.monotonic() - started)
+    await writer.flush()
+
+    store = BlobStore(db)
+    for blob_id, payload in generator.xray_pool:
+        await store.put_bytes(payload, refs=generator.xray_refs[blob_id])
+
+    for collection, count in sorted(writer.counts.items()):
+        logger.info("Inserted %d documents into %s", count, collection)
+    logger.info("Generated %d doctors and %d patients in %.1fs", len(doctors), args.patients, time.monotonic() - started)
+    client.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic clinic dataset for scale testing.")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default=os.environ.get("DB_NAME", "test_database"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--doctors", type=int, default=10)
+    parser.add_argument("--patients", type=int, default=100000)
+    parser.add_argument("--appointments-per-patient", type=int, default=10, help="average; millions of appointments at 100k+ patients")
+    parser.add_argument("--history-per-patient", type=int, default=3, help="average")
+    parser.add_argument("--payments-per-patient", type=int, default=3, help="average")
+    parser.add_argument("--days", type=int, default=365, help="how far back generated activity goes")
+    parser.add_argument("--arabic-ratio", type=float, default=0.5)
+    parser.add_argument("--xray-ratio", type=float, default=0.0, help="fraction of patients that get an X-ray blob")
+    parser.add_argument("--xray-bytes", type=int, default=256 * 1024)
+    parser.add_argument("--xray-distinct", type=int, default=20, help="distinct X-ray payloads shared by all X-ray records")
+    parser.add_argument("--password", default="doctor123", help="password for every generated doctor")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=8, help="insert_many batches in flight")
+    parser.add_argument("--fixed-clock", action="store_true", help="anchor dates at 2026-01-01 for fully repeatable output")
+    parser.add_argument("--drop", action="store_true", help="drop the clinic collections first")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(generate(parse_args()))
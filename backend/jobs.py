@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+import traceback
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    # A durable queue in the `jobs` collection. Workers claim jobs with one
+    # atomic find_one_and_update, which also sets a lease ("visibility
+    # timeout"): if a worker dies mid-job, the lease runs out and another
+    # worker picks the job up again. Failures are retried with exponential
+    # backoff until max_attempts, after which the job stays as failed.
+    def __init__(self, db, collection="jobs", visibility_timeout=60, max_attempts=5,
+                 backoff_base=2.0, backoff_max=600, retention_hours=72):
+        self.jobs = db[collection]
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retention_hours = retention_hours
+        self.handlers = {}
+
+    @classmethod
+    def from_env(cls, db):
+        return cls(
+            db,
+            visibility_timeout=float(os.environ.get("JOB_VISIBILITY_TIMEOUT_SECONDS", "60")),
+            max_attempts=int(os.environ.get("JOB_MAX_ATTEMPTS", "5")),
+            retention_hours=float(os.environ.get("JOB_RETENTION_HOURS", "72")),
+        )
+
+    def handler(self, name):
+        def register(func):
+            self.handlers[name] = func
+            return func
+        return register
+
+    async def ensure_indexes(self):
+        await self.jobs.create_index("id", unique=True)
+        await self.jobs.create_index([("status", 1), ("run_at", 1)])
+        await self.jobs.create_index([("status", 1), ("lease_until", 1)])
+        # At most one queued job per dedupe key.
+        await self.jobs.create_index(
+            "dedupe_key", unique=True, name="queued_dedupe_key",
+            partialFilterExpression={"status": QUEUED, "dedupe_key": {"$type": "string"}},
+        )
+        await self.jobs.create_index("finished_at", expireAfterSeconds=int(self.retention_hours * 3600))
+
+    async def enqueue(self, name, payload=None, delay=0, dedupe_key=None, max_attempts=None):
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()),
+            "name": name,
+            "payload": payload or {},
+            "status": QUEUED,
+            "attempts": 0,
+            "max_attempts": max_attempts or self.max_attempts,
+            "run_at": now + timedelta(seconds=delay),
+            "created_at": now,
+        }
+        if dedupe_key is None:
+            await self.jobs.insert_one(job)
+            return job["id"]
+        # Coalesce with a job that is still waiting; it'll see the latest state.
+        job["dedupe_key"] = dedupe_key
+        try:
+            existing = await self.jobs.find_one_and_update(
+                {"dedupe_key": dedupe_key, "status": QUEUED},
+                {"$setOnInsert": job},
+                upsert=True,
+                projection={"_id": 0, "id": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            existing = await self.jobs.find_one({"dedupe_key": dedupe_key, "status": QUEUED}, {"_id": 0, "id": 1})
+        return existing["id"] if existing else job["id"]
+
+    async def claim(self, worker_id):
+        now = datetime.now(timezone.utc)
+        return await self.jobs.find_one_and_update(
+            {
+                "name": {"$in": list(self.handlers)},
+                "$or": [
+                    {"status": QUEUED, "run_at": {"$lte": now}},
+                    {"status": RUNNING, "lease_until": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "status": RUNNING,
+                    "worker": worker_id,
+                    "started_at": now,
+                    "lease_until": now + timedelta(seconds=self.visibility_timeout),
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("run_at", 1)],
+            projection={"_id": 0},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def extend_lease(self, job):
+        await self.jobs.update_one(
+            {"id": job["id"], "status": RUNNING, "worker": job["worker"]},
+            {"$set": {"lease_until": datetime.now(timezone.utc) + timedelta(seconds=self.visibility_timeout)}},
+        )
+
+    async def complete(self, job):
+        await self.jobs.update_one(
+            {"id": job["id"], "worker": job["worker"]},
+            {"$set": {"status": DONE, "finished_at": datetime.now(timezone.utc)}, "$unset": {"lease_until": ""}},
+        )
+
+    async def fail(self, job, error):
+        now = datetime.now(timezone.utc)
+        if job["attempts"] >= job.get("max_attempts", self.max_attempts):
+            update = {"$set": {"status": FAILED, "finished_at": now, "error": error}, "$unset": {"lease_until": ""}}
+        else:
+            delay = min(self.backoff_max, self.backoff_base ** job["attempts"]) * random.uniform(0.5, 1.0)
+            update = {
+                "$set": {"status": QUEUED, "run_at": now + timedelta(seconds=delay), "error": error},
+                "$unset": {"lease_until": "", "worker": ""},
+            }
+        await self.jobs.update_one({"id": job["id"], "worker": job["worker"]}, update)
+
+    async def retry(self, job_id):
+        result = await self.jobs.update_one(
+            {"id": job_id, "status": FAILED},
+            {
+                "$set": {"status": QUEUED, "run_at": datetime.now(timezone.utc), "attempts": 0},
+                "$unset": {"finished_at": "", "worker": ""},
+            },
+        )
+        return bool(result.modified_count)
+
+    async def stats(self):
+        counts = await self.jobs.aggregate([
+            {"$group": {"_id": {"name": "$name", "status": "$status"}, "count": {"$sum": 1}}}
+        ]).to_list(None)
+        stats = {}
+        for row in counts:
+            stats.setdefault(row["_id"]["name"], {})[row["_id"]["status"]] = row["count"]
+        return stats
+
+
+class Worker:
+    def __init__(self, queue, concurrency=4, poll_interval=1.0):
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = asyncio.Event()
+
+    async def run(self):
+        logger.info("Worker %s running %d slots for %s", self.worker_id, self.concurrency, sorted(self.queue.handlers))
+        await asyncio.gather(*(self._slot() for _ in range(self.concurrency)))
+
+    def stop(self):
+        self.stopping.set()
+
+    async def _slot(self):
+        while not self.stopping.is_set():
+            try:
+                job = await self.queue.claim(self.worker_id)
+                if job is not None:
+                    await self._execute(job)
+                    continue
+            except Exception:
+                logger.exception("Worker %s could not claim or settle a job", self.worker_id)
+            # Jittered polling keeps idle workers from querying in lockstep.
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.poll_interval * random.uniform(0.5, 1.5))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job):
+        if job["attempts"] > job.get("max_attempts", self.queue.max_attempts):
+            # Claimed again after its lease ran out too many times, e.g. a
+            # job that keeps crashing its worker.
+            await self.queue.fail(job, "Lease expired on every attempt")
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            await self.queue.handlers[job["name"]](**job["payload"])
+        except Exception:
+            logger.warning("Job %s (%s) failed on attempt %d", job["id"], job["name"], job["attempts"], exc_info=True)
+            await self.queue.fail(job, traceback.format_exc(limit=5))
+        else:
+            await self.queue.complete(job)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job):
+        # Long jobs keep their lease so they aren't handed to another worker.
+        while True:
+            await asyncio.sleep(self.queue.visibility_timeout / 3)
+            await self.queue.extend_lease(job)
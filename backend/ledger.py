@@ -0,0 +1,242 @@
+import asyncio
+import os
+import uuid
+from datetime import datetime, timezone
+
+from pymongo import ReturnDocument, UpdateOne
+
+SNAPSHOT_EVERY = int(os.environ.get("LEDGER_SNAPSHOT_EVERY", "50"))
+
+
+def ledger_entry(entry_type, cost=0.0, paid=0.0, source=None, source_id=None, note="", recorded_by=None, created_at=None):
+    # `cost` adds to what the patient owes and `paid` to what they've paid;
+    # an adjustment is a (usually negative) cost, e.g. a discount.
+    return {
+        "id": str(uuid.uuid4()),
+        "type": entry_type,
+        "cost": cost,
+        "paid": paid,
+        "source": source,
+        "source_id": source_id,
+        "note": note,
+        "recorded_by": recorded_by,
+        "created_at": created_at or datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def totals(entries, start=None):
+    total_cost = start["total_cost"] if start else 0.0
+    total_paid = start["total_paid"] if start else 0.0
+    for entry in entries:
+        total_cost += entry.get("cost", 0.0)
+        total_paid += entry.get("paid", 0.0)
+    return {"total_cost": total_cost, "total_paid": total_paid, "balance": total_cost - total_paid}
+
+
+def added(field, amount):
+    # $inc for an update pipeline, treating a missing field as 0.
+    return {"$add": [{"$ifNull": [f"${field}", 0]}, amount]}
+
+
+def opening_entry(patient_id, patient):
+    # What a patient from before the ledger already owed and had paid, as
+    # the first entry of their ledger.
+    return {
+        **ledger_entry("opening", cost=patient.get("total_cost") or 0.0, paid=patient.get("total_paid") or 0.0,
+                       source="opening", source_id=patient_id, note="Balance before the ledger"),
+        "id": source_entry_id("opening", patient_id),
+    }
+
+
+def source_entry_id(source, source_id):
+    # Stable ids, so rebuilding the ledger from the same records is repeatable.
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"ledger:{source}:{source_id}"))
+
+
+def entries_from_sources(history=(), appointments=(), payments=(), prices=None):
+    # Reconstructs the charge and payment entries the API would have written
+    # for these records, oldest first. Appointment charges use current prices.
+    prices = prices or {}
+    entries = []
+    for record in history:
+        if record.get("total_cost"):
+            entries.append(ledger_entry("charge", cost=record["total_cost"], source="history", source_id=record["id"],
+                                        recorded_by=record.get("doctor_id"), created_at=record.get("date")))
+    for appointment in appointments:
+        cost = sum(prices.get(proc_id, 0.0) for proc_id in appointment.get("procedures") or [])
+        if cost:
+            entries.append(ledger_entry("charge", cost=cost, source="appointment", source_id=appointment["id"],
+                                        created_at=appointment.get("created_at")))
+    for payment in payments:
+        entries.append(ledger_entry("payment", paid=payment["amount"], source="payment", source_id=payment["id"],
+                                    note=payment.get("notes") or "", recorded_by=payment.get("recorded_by"),
+                                    created_at=payment.get("payment_date")))
+    for entry in entries:
+        entry["id"] = source_entry_id(entry["source"], entry["source_id"])
+    entries.sort(key=lambda entry: (str(entry["created_at"]), entry["id"]))
+    return entries
+
+
+def number_entries(patient_id, entries, snapshot_every=SNAPSHOT_EVERY):
+    # Assigns seq numbers in order and computes the snapshots and final totals.
+    documents, snapshots = [], []
+    running = totals([])
+    now = datetime.now(timezone.utc).isoformat()
+    for seq, entry in enumerate(entries, 1):
+        document = {**entry, "patient_id": patient_id, "seq": seq}
+        documents.append(document)
+        running = totals([document], running)
+        if seq % snapshot_every == 0:
+            snapshots.append({"patient_id": patient_id, "seq": seq, **running, "created_at": now})
+    return documents, snapshots, running
+
+
+class Ledger:
+    # Append-only record of everything that moved a patient's balance. Each
+    # patient's entries are numbered by `patients.ledger_seq`, which is bumped
+    # in the same atomic update as the patient's running totals, so those
+    # totals stay a consistent cache of the ledger. Every SNAPSHOT_EVERY
+    # entries the totals are snapshotted, and a balance is the latest
+    # snapshot plus the short tail of entries after it. With a change feed,
+    # the patient's sync version is bumped in the same update.
+    #
+    # A patient from before the ledger has cached totals but no ledger_seq.
+    # Their first append also writes an opening entry (seq 1) carrying those
+    # totals, so the ledger adds up to the same balance from then on.
+    def __init__(self, db, change_feed=None, snapshot_every=SNAPSHOT_EVERY):
+        self.db = db
+        self.change_feed = change_feed
+        self.entries = db.ledger
+        self.snapshots = db.ledger_snapshots
+        self.snapshot_every = snapshot_every
+
+    async def ensure_indexes(self):
+        await self.entries.create_index([("patient_id", 1), ("seq", 1)], unique=True)
+        await self.entries.create_index([("source", 1), ("source_id", 1)])
+        await self.snapshots.create_index([("patient_id", 1), ("seq", -1)], unique=True)
+
+    def _update(self, entries, stamp, extra=None):
+        # An update pipeline, so a missing ledger_seq can leave seq 1 free for
+        # the opening entry.
+        cost = sum(entry["cost"] for entry in entries)
+        paid = sum(entry["paid"] for entry in entries)
+        return [{"$set": {
+            **(extra or {}),
+            "ledger_seq": {"$add": [{"$ifNull": ["$ledger_seq", 1]}, len(entries)]},
+            "total_cost": added("total_cost", cost),
+            "total_paid": added("total_paid", paid),
+            "balance": added("balance", cost - paid),
+            **{field: {"$literal": value} for field, value in stamp.items()},
+        }}]
+
+    def _number(self, patient_id, before, entries):
+        # Entry documents, given the patient as they were before the update,
+        # and the seq of the snapshot they cross, if any.
+        if before.get("ledger_seq") is None:
+            entries = [opening_entry(patient_id, before), *entries]
+            start = 0
+        else:
+            start = before["ledger_seq"]
+        documents = [
+            {**entry, "patient_id": patient_id, "seq": start + offset}
+            for offset, entry in enumerate(entries, 1)
+        ]
+        crossed = (start + len(entries)) // self.snapshot_every * self.snapshot_every
+        return documents, crossed if crossed > start else None
+
+    async def append(self, patient_id, entries):
+        # Returns the patient's updated totals, or None if there is no such patient.
+        stamp = await self.change_feed.stamp() if self.change_feed is not None else {}
+        before = await self.db.patients.find_one_and_update(
+            {"id": patient_id},
+            self._update(entries, stamp),
+            projection={"_id": 0, "ledger_seq": 1, "total_cost": 1, "total_paid": 1, "balance": 1},
+            return_document=ReturnDocument.BEFORE,
+        )
+        if before is None:
+            return None
+        documents, crossed = self._number(patient_id, before, entries)
+        await self.entries.insert_many(documents, ordered=False)
+        if crossed:
+            await self.snapshot(patient_id, crossed)
+        cost = sum(entry["cost"] for entry in entries)
+        paid = sum(entry["paid"] for entry in entries)
+        return {
+            "ledger_seq": documents[-1]["seq"],
+            "total_cost": (before.get("total_cost") or 0.0) + cost,
+            "total_paid": (before.get("total_paid") or 0.0) + paid,
+            "balance": (before.get("balance") or 0.0) + cost - paid,
+        }
+
+    async def append_many(self, batches):
+        # append() for many patients, {patient_id: entries}, in a fixed number
+        # of round trips. A bulk write doesn't return the documents, so each
+        # patient's update also copies what append() reads from the returned
+        # document under a key unique to this call; the key is read back to
+        # number the entries and then removed. Unknown patients are skipped.
+        if not batches:
+            return
+        token = uuid.uuid4().hex
+        key = f"ledger_pending.{token}"
+        stamp = await self.change_feed.stamp() if self.change_feed is not None else {}
+        before = {"ledger_seq": "$ledger_seq", "total_cost": "$total_cost", "total_paid": "$total_paid"}
+        await self.db.patients.bulk_write([
+            UpdateOne({"id": patient_id}, self._update(entries, stamp, {key: before}))
+            for patient_id, entries in batches.items()
+        ], ordered=False)
+        patients = await self.db.patients.find(
+            {"id": {"$in": list(batches)}, key: {"$exists": True}}, {"_id": 0, "id": 1, key: 1}
+        ).to_list(None)
+        documents, crossed = [], []
+        for patient in patients:
+            patient_documents, seq = self._number(patient["id"], patient["ledger_pending"][token], batches[patient["id"]])
+            documents.extend(patient_documents)
+            if seq:
+                crossed.append((patient["id"], seq))
+        if documents:
+            await self.entries.insert_many(documents, ordered=False)
+        await self.db.patients.update_many({"id": {"$in": list(batches)}}, {"$unset": {key: ""}})
+        await asyncio.gather(*(self.snapshot(patient_id, seq) for patient_id, seq in crossed))
+
+    async def snapshot(self, patient_id, seq):
+        base = await self.latest_snapshot(patient_id, seq)
+        base_seq = base["seq"] if base else 0
+        tail = await self.entries.find(
+            {"patient_id": patient_id, "seq": {"$gt": base_seq, "$lte": seq}},
+            {"_id": 0, "seq": 1, "cost": 1, "paid": 1},
+        ).to_list(None)
+        if len(tail) != seq - base_seq:
+            # A concurrent append hasn't written its entries yet; a later
+            # snapshot will cover this range instead.
+            return None
+        snapshot = {"patient_id": patient_id, "seq": seq, **totals(tail, base),
+                    "created_at": datetime.now(timezone.utc).isoformat()}
+        await self.snapshots.replace_one({"patient_id": patient_id, "seq": seq}, snapshot, upsert=True)
+        return snapshot
+
+    async def latest_snapshot(self, patient_id, at_or_before=None):
+        query = {"patient_id": patient_id}
+        if at_or_before is not None:
+            query["seq"] = {"$lte": at_or_before}
+        return await self.snapshots.find_one(query, {"_id": 0}, sort=[("seq", -1)])
+
+    async def balance(self, patient_id):
+        snapshot = await self.latest_snapshot(patient_id)
+        snapshot_seq = snapshot["seq"] if snapshot else 0
+        tail = await self.entries.find(
+            {"patient_id": patient_id, "seq": {"$gt": snapshot_seq}},
+            {"_id": 0, "seq": 1, "cost": 1, "paid": 1},
+        ).sort("seq", 1).to_list(None)
+        return {
+            "patient_id": patient_id,
+            **totals(tail, snapshot),
+            "seq": tail[-1]["seq"] if tail else snapshot_seq,
+            "snapshot_seq": snapshot_seq,
+            "tail_entries": len(tail),
+        }
+
+    async def history(self, patient_id, before_seq=None, limit=100):
+        query = {"patient_id": patient_id}
+        if before_seq is not None:
+            query["seq"] = {"$lt": before_seq}
+        return await self.entries.find(query, {"_id": 0}).sort("seq", -1).to_list(limit)
@@ -0,0 +1,141 @@
+import asyncio
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+class LoopLagMonitor:
+    def __init__(self, interval_ms=250, warn_ms=100, block_ms=0, window=1200, max_block_samples=50):
+        self.interval = interval_ms / 1000
+        self.warn = warn_ms / 1000
+        self.block = block_ms / 1000
+        self.samples = collections.deque(maxlen=window)
+        self.block_samples = collections.deque(maxlen=max_block_samples)
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_samples = 0
+        self.warnings = 0
+        self.blocks_detected = 0
+        self.active_requests = {}
+        self._task = None
+        self._loop = None
+        self._loop_thread_id = None
+        self._heartbeat = time.monotonic()
+        self._watchdog = None
+        self._stopped = threading.Event()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            interval_ms=int(os.environ.get("LOOP_MONITOR_INTERVAL_MS", "250")),
+            warn_ms=int(os.environ.get("LOOP_LAG_WARN_MS", "100")),
+            block_ms=int(os.environ.get("LOOP_BLOCK_DETECT_MS", "0")),
+        )
+
+    @property
+    def detecting_blocks(self):
+        return self.block > 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure())
+        if self.detecting_blocks:
+            self._beat()
+            self._watchdog = threading.Thread(target=self._watch, name="loop-block-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def stop(self):
+        self._stopped.set()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _measure(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.samples.append(lag)
+            self.total_samples += 1
+            if lag >= self.warn:
+                self.warnings += 1
+                logger.warning(
+                    "Event loop lag %.1f ms (in flight: %s)", lag * 1000, ", ".join(self.in_flight()) or "none"
+                )
+
+    def _beat(self):
+        # Heartbeats are loop callbacks: if any other callback holds the loop, they stop.
+        self._heartbeat = time.monotonic()
+        if not self._stopped.is_set():
+            self._loop.call_later(self.block / 2, self._beat)
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stopped.wait(self.block / 2):
+            heartbeat = self._heartbeat
+            blocked_for = time.monotonic() - heartbeat
+            if blocked_for < self.block or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            stack = "".join(traceback.format_stack(frame))
+            sample = {
+                "detected_at": datetime.now(timezone.utc).isoformat(),
+                "blocked_ms": round(blocked_for * 1000, 1),
+                "in_flight": self.in_flight(),
+                "stack": stack,
+            }
+            self.blocks_detected += 1
+            self.block_samples.append(sample)
+            logger.warning(
+                "Event loop blocked for %.1f ms (in flight: %s)\n%s",
+                sample["blocked_ms"], ", ".join(sample["in_flight"]) or "none", stack,
+            )
+
+    def request_started(self, key, method, path):
+        self.active_requests[key] = f"{method} {path}"
+
+    def request_finished(self, key):
+        self.active_requests.pop(key, None)
+
+    def in_flight(self):
+        return list(self.active_requests.values())
+
+    def stats(self):
+        ordered = sorted(self.samples)
+        return {
+            "interval_ms": self.interval * 1000,
+            "last_lag_ms": round(self.last_lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "p50_lag_ms": round(_percentile(ordered, 0.5) * 1000, 2),
+            "p99_lag_ms": round(_percentile(ordered, 0.99) * 1000, 2),
+            "samples": self.total_samples,
+            "warnings": self.warnings,
+            "block_detection_ms": self.block * 1000 if self.detecting_blocks else None,
+            "blocks_detected": self.blocks_detected,
+        }
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+import random
+import resource
+import socket
+import tracemalloc
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+CONTROL_ID = "tracemalloc"
+# Allocations made by tracemalloc itself and the import machinery are noise.
+NOISE = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak rather than current, but the best there is off Linux.
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+
+def top_sites(snapshot, previous, limit):
+    # Largest allocation sites, by growth since `previous` when there is one.
+    key_type = "traceback" if tracemalloc.get_traceback_limit() > 1 else "lineno"
+    if previous is not None:
+        stats = snapshot.compare_to(previous, key_type)
+    else:
+        stats = snapshot.statistics(key_type)
+    return [
+        {
+            "site": f"{stat.traceback[-1].filename}:{stat.traceback[-1].lineno}",
+            "size_kb": round(stat.size / 1024, 1),
+            "size_diff_kb": round(getattr(stat, "size_diff", stat.size) / 1024, 1),
+            "count": stat.count,
+            "count_diff": getattr(stat, "count_diff", stat.count),
+            **({"traceback": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback]}
+               if key_type == "traceback" else {}),
+        }
+        for stat in stats[:limit]
+    ]
+
+
+class MemoryDiagnostics:
+    # Heap tracing for all API workers without a restart. Admins switch
+    # tracemalloc on and off and ask for snapshots through one control
+    # document; every worker polls it, applies it to its own process, and
+    # writes a report (top allocation sites diffed against its previous
+    # snapshot, plus per-endpoint peaks) to diagnostics_reports.
+    #
+    # While tracing, a sample of requests also records how far the traced
+    # heap peaked above where it was when the request started. The peak is
+    # process-wide, so requests running at the same time count towards it;
+    # only one request is sampled at a time, and over many samples the
+    # heavy endpoints still stand out.
+    def __init__(self, db, poll_interval=10, sample_rate=0.05, top=25, report_ttl_hours=24):
+        self.control = db.diagnostics
+        self.reports = db.diagnostics_reports
+        self.poll_interval = poll_interval
+        self.sample_rate = sample_rate
+        self.top = top
+        self.report_ttl_hours = report_ttl_hours
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.endpoints = {}
+        self.snapshot = None
+        self.snapshot_seq = None
+        self.sampling = False
+        self._task = None
+
+    @classmethod
+    def from_env(cls, db):
+        return cls(
+            db,
+            poll_interval=float(os.environ.get("MEMORY_DIAG_POLL_SECONDS", "10")),
+            sample_rate=float(os.environ.get("MEMORY_SAMPLE_RATE", "0.05")),
+            top=int(os.environ.get("MEMORY_DIAG_TOP", "25")),
+        )
+
+    async def ensure_indexes(self):
+        await self.reports.create_index("taken_at", expireAfterSeconds=int(self.report_ttl_hours * 3600))
+
+    def start(self):
+        self._task = asyncio.create_task(self._poll())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def set_tracing(self, enabled, frames=1):
+        await self.control.update_one(
+            {"_id": CONTROL_ID},
+            {"$set": {"enabled": enabled, "frames": frames, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+        return await self.status()
+
+    async def request_snapshot(self):
+        await self.control.update_one({"_id": CONTROL_ID}, {"$inc": {"snapshot_seq": 1}}, upsert=True)
+        return await self.status()
+
+    async def status(self):
+        control = await self.control.find_one({"_id": CONTROL_ID}, {"_id": 0}) or {"enabled": False}
+        workers = await self.reports.find({}, {"_id": 0}).sort("worker", 1).to_list(None)
+        return {"control": control, "this_worker": self.stats(), "workers": workers}
+
+    def stats(self):
+        traced, peak = tracemalloc.get_traced_memory()
+        return {
+            "worker": self.worker_id,
+            "pid": os.getpid(),
+            "rss_mb": round(rss_bytes() / 2**20, 1),
+            "tracing": tracemalloc.is_tracing(),
+            "traced_mb": round(traced / 2**20, 1),
+            "endpoints": {
+                endpoint: {
+                    "samples": stats["samples"],
+                    "max_peak_kb": round(stats["max_peak"] / 1024, 1),
+                    "avg_peak_kb": round(stats["total_peak"] / stats["samples"] / 1024, 1),
+                }
+                for endpoint, stats in sorted(self.endpoints.items(), key=lambda item: -item[1]["max_peak"])
+            },
+        }
+
+    async def _poll(self):
+        while True:
+            try:
+                await self.apply(await self.control.find_one({"_id": CONTROL_ID}))
+            except Exception:
+                logger.exception("Applying memory diagnostics settings failed")
+            await asyncio.sleep(self.poll_interval)
+
+    async def apply(self, control):
+        control = control or {}
+        enabled = bool(control.get("enabled"))
+        seq = control.get("snapshot_seq", 0)
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start(control.get("frames", 1))
+            self.snapshot = None
+            self.endpoints.clear()
+            logger.info("tracemalloc started (%d frames)", control.get("frames", 1))
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self.snapshot = None
+            logger.info("tracemalloc stopped")
+        if self.snapshot_seq is None:
+            # Requests from before this worker started aren't for it.
+            self.snapshot_seq = seq
+        if seq != self.snapshot_seq:
+            self.snapshot_seq = seq
+            if tracemalloc.is_tracing():
+                await self.report()
+
+    async def report(self):
+        # Snapshots of a large heap take a while; keep them off the loop thread.
+        snapshot = await asyncio.to_thread(lambda: tracemalloc.take_snapshot().filter_traces(NOISE))
+        previous, self.snapshot = self.snapshot, snapshot
+        top = await asyncio.to_thread(top_sites, snapshot, previous, self.top)
+        await self.reports.replace_one({"_id": self.worker_id}, {
+            **self.stats(),
+            "snapshot_seq": self.snapshot_seq,
+            "compared_to_previous": previous is not None,
+            "top": top,
+            "taken_at": datetime.now(timezone.utc),
+        }, upsert=True)
+
+    def begin_sample(self):
+        if self.sampling or not tracemalloc.is_tracing() or random.random() >= self.sample_rate:
+            return None
+        self.sampling = True
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def end_sample(self, started, endpoint):
+        self.sampling = False
+        if not tracemalloc.is_tracing():
+            return
+        stats = self.endpoints.setdefault(endpoint, {"samples": 0, "max_peak": 0, "total_peak": 0})
+        peak = max(0, tracemalloc.get_traced_memory()[1] - started)
+        stats["samples"] += 1
+        stats["max_peak"] = max(stats["max_peak"], peak)
+        stats["total_peak"] += peak
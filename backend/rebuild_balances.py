@@ -0,0 +1,203 @@
+"""Recompute patient balances after a bug or an import.
+
+Usage (from the backend/ directory):
+
+    python rebuild_balances.py                  # totals and snapshots from the ledger
+    python rebuild_balances.py --from-source    # rebuild the ledger itself first
+
+By default every patient's total_cost, total_paid, balance and ledger_seq are
+recomputed from their ledger entries, and their snapshots are rewritten.
+--from-source also regenerates the charge and payment entries from
+patient_history, appointments and payments, archived ones included (keeping
+manual adjustments), which is also how a database from before the ledger
+existed gets a full one. Without it, patients from before the ledger keep
+the opening entry their first append wrote, and ones never appended to are
+left alone.
+
+Patients are processed in batches, several batches at a time. Run it while
+nothing else is writing to the database; balance changes made during a
+rebuild can be overwritten.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+
+from archive import Archiver
+from ledger import SNAPSHOT_EVERY, entries_from_sources, number_entries
+from sync import ChangeFeed
+
+logger = logging.getLogger("rebuild_balances")
+
+ENTRY_FIELDS = {"_id", "patient_id", "seq"}
+
+
+def group_by_patient(docs):
+    groups = {}
+    for doc in docs:
+        groups.setdefault(doc["patient_id"], []).append(doc)
+    return groups
+
+
+class BalanceRebuilder:
+    def __init__(self, db, args, prices):
+        self.db = db
+        self.args = args
+        self.prices = prices
+        self.change_feed = ChangeFeed(db)
+        self.archiver = Archiver.from_env(db)
+        self.patients = 0
+        self.entries = 0
+
+    async def load_ledger(self, patient_ids):
+        entries = await self.db.ledger.find(
+            {"patient_id": {"$in": patient_ids}}, {"_id": 0}
+        ).sort([("patient_id", 1), ("seq", 1)]).to_list(None)
+        return {
+            patient_id: [{k: v for k, v in entry.items() if k not in ENTRY_FIELDS} for entry in patient_entries]
+            for patient_id, patient_entries in group_by_patient(entries).items()
+        }
+
+    async def load_sources(self, patient_ids):
+        query = {"patient_id": {"$in": patient_ids}}
+        history, appointments, payments, adjustments = await asyncio.gather(
+            self.find_all("patient_history", query, {"_id": 0, "id": 1, "patient_id": 1, "doctor_id": 1, "date": 1, "total_cost": 1}),
+            self.find_all(
+                "appointments",
+                {**query, "procedures.0": {"$exists": True}},
+                {"_id": 0, "id": 1, "patient_id": 1, "procedures": 1, "created_at": 1},
+            ),
+            self.find_all("payments", query, {"_id": 0, "archived_at": 0}),
+            self.db.ledger.find({**query, "type": "adjustment"}, {"_id": 0}).to_list(None),
+        )
+        history, appointments = group_by_patient(history), group_by_patient(appointments)
+        payments, adjustments = group_by_patient(payments), group_by_patient(adjustments)
+        ledgers = {}
+        for patient_id in patient_ids:
+            entries = entries_from_sources(
+                history.get(patient_id, []), appointments.get(patient_id, []), payments.get(patient_id, []), self.prices
+            )
+            entries += [{k: v for k, v in entry.items() if k not in ENTRY_FIELDS} for entry in adjustments.get(patient_id, [])]
+            entries.sort(key=lambda entry: (str(entry["created_at"]), entry["id"]))
+            ledgers[patient_id] = entries
+        return ledgers
+
+    async def find_all(self, name, query, fields):
+        # Archived records still count towards the balance. A record caught
+        # mid-archive can be in both collections; it's counted once.
+        hot, archived = await asyncio.gather(
+            self.db[name].find(query, fields).to_list(None),
+            self.archiver.archive(self.db, name).find(query, fields).to_list(None),
+        )
+        ids = {doc["id"] for doc in hot}
+        return hot + [doc for doc in archived if doc["id"] not in ids]
+
+    async def rebuild_batch(self, patient_ids):
+        if self.args.from_source:
+            ledgers = await self.load_sources(patient_ids)
+        else:
+            ledgers = await self.load_ledger(patient_ids)
+
+        documents, snapshots, results = [], [], {}
+        for patient_id in patient_ids:
+            entries, patient_snapshots, result = number_entries(patient_id, ledgers.get(patient_id, []), self.args.snapshot_every)
+            documents.extend(entries)
+            snapshots.extend(patient_snapshots)
+            results[patient_id] = {**result, "ledger_seq": len(entries)}
+
+        if self.args.dry_run:
+            self.patients += len(patient_ids)
+            self.entries += len(documents)
+            return
+        # New sync versions, so clients pick up the corrected balances.
+        first_version = await self.change_feed.allocate(len(patient_ids))
+        updated_at = datetime.now(timezone.utc).isoformat()
+        updates = [
+            UpdateOne({"id": patient_id}, {"$set": {**result, "version": first_version + offset, "updated_at": updated_at}})
+            for offset, (patient_id, result) in enumerate(results.items())
+        ]
+        if self.args.from_source:
+            await self.db.ledger.delete_many({"patient_id": {"$in": patient_ids}})
+            if documents:
+                await self.db.ledger.insert_many(documents, ordered=False)
+        await self.db.ledger_snapshots.delete_many({"patient_id": {"$in": patient_ids}})
+        if snapshots:
+            await self.db.ledger_snapshots.insert_many(snapshots, ordered=False)
+        await self.db.patients.bulk_write(updates, ordered=False)
+        self.patients += len(patient_ids)
+        self.entries += len(documents)
+
+
+async def rebuild(args):
+    client = AsyncIOMotorClient(args.mongo_url)
+    db = client[args.db_name]
+    catalog = await db.procedures.find({}, {"_id": 0, "id": 1, "price": 1}).to_list(None)
+    rebuilder = BalanceRebuilder(db, args, {proc["id"]: proc["price"] for proc in catalog})
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    tasks = []
+
+    async def run(batch):
+        try:
+            await rebuilder.rebuild_batch(batch)
+        finally:
+            semaphore.release()
+
+    async def submit(batch):
+        # Acquiring before spawning bounds the number of batches in flight.
+        await semaphore.acquire()
+        tasks.append(asyncio.create_task(run(batch)))
+
+    started = time.monotonic()
+    query = {"id": {"$in": args.patient}} if args.patient else {}
+    if not args.from_source:
+        # Patients from before the ledger that were never appended to have
+        # nothing to rebuild from; their cached totals are all there is.
+        query["ledger_seq"] = {"$exists": True}
+    batch, submitted = [], 0
+    async for patient in db.patients.find(query, {"_id": 0, "id": 1}):
+        batch.append(patient["id"])
+        if len(batch) >= args.batch_size:
+            await submit(batch)
+            batch = []
+            submitted += 1
+            if submitted % 20 == 0:
+                logger.info("Rebuilt %d patients (%.1fs)", rebuilder.patients, time.monotonic() - started)
+    if batch:
+        await submit(batch)
+    # A failed batch fails the run, after the other batches have finished.
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if errors:
+        client.close()
+        raise errors[0]
+
+    logger.info(
+        "%s %d patients and %d ledger entries in %.1fs",
+        "Checked" if args.dry_run else "Rebuilt", rebuilder.patients, rebuilder.entries, time.monotonic() - started,
+    )
+    client.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute patient balances from the ledger.")
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--db-name", default=os.environ.get("DB_NAME", "test_database"))
+    parser.add_argument("--from-source", action="store_true",
+                        help="regenerate ledger entries from history, appointments and payments first")
+    parser.add_argument("--patient", action="append", help="only rebuild this patient id (repeatable)")
+    parser.add_argument("--batch-size", type=int, default=500, help="patients per batch")
+    parser.add_argument("--concurrency", type=int, default=8, help="batches in flight")
+    parser.add_argument("--snapshot-every", type=int, default=SNAPSHOT_EVERY)
+    parser.add_argument("--dry-run", action="store_true", help="compute everything but write nothing")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(rebuild(parse_args()))
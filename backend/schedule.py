@@ -0,0 +1,159 @@
+import bisect
+import calendar
+import os
+import time
+from datetime import date, timedelta
+
+FREQUENCIES = ("daily", "weekly", "monthly")
+
+CLINIC_OPENS = os.environ.get("CLINIC_OPENS", "09:00")
+CLINIC_CLOSES = os.environ.get("CLINIC_CLOSES", "17:00")
+SLOT_MINUTES = int(os.environ.get("SLOT_MINUTES", "30"))
+DEFAULT_APPOINTMENT_MINUTES = int(os.environ.get("DEFAULT_APPOINTMENT_MINUTES", "30"))
+
+
+def to_minutes(time_str):
+    hours, minutes = time_str.split(":")[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def from_minutes(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def appointment_interval(day, time_str, duration_minutes):
+    # Appointments are stored with "YYYY-MM-DDTHH:MM" start/end strings in
+    # clinic-local time; they sort lexicographically, so range queries work.
+    start = to_minutes(time_str)
+    end = start + duration_minutes
+    return f"{day}T{from_minutes(start)}", f"{day}T{from_minutes(end)}"
+
+
+def legacy_time_range(time_str, duration_minutes):
+    # Appointments booked before start_at/end_at existed only carry "time" until
+    # the backfill job reaches them. They count as DEFAULT_APPOINTMENT_MINUTES
+    # long (as in build_day_index), so one overlaps when it starts in this range.
+    start = to_minutes(time_str)
+    return {
+        "$gte": from_minutes(max(start - DEFAULT_APPOINTMENT_MINUTES + 1, 0)),
+        "$lt": from_minutes(start + duration_minutes),
+    }
+
+
+def interval_minutes(start_at, end_at):
+    return to_minutes(start_at.split("T")[1]), to_minutes(end_at.split("T")[1])
+
+
+class DayScheduleIndex:
+    # Intervals sorted by start with a running maximum of end times. Any interval
+    # overlapping [start, end) must begin before `end`, so one bisect plus the
+    # running maximum answers "is there an overlap?" in O(log n).
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        self.ids = []
+        self.max_ends = []
+        for interval in sorted(intervals):
+            self.add(*interval)
+
+    def add(self, start, end, appt_id=None):
+        position = bisect.bisect_right(self.starts, start)
+        self.starts.insert(position, start)
+        self.ends.insert(position, end)
+        self.ids.insert(position, appt_id)
+        running = self.max_ends[position - 1] if position else 0
+        self.max_ends[position:] = []
+        for index in range(position, len(self.starts)):
+            running = max(running, self.ends[index])
+            self.max_ends.append(running)
+
+    def overlaps(self, start, end):
+        before_end = bisect.bisect_left(self.starts, end)
+        return bool(before_end) and self.max_ends[before_end - 1] > start
+
+    def conflicting_id(self, start, end):
+        index = bisect.bisect_left(self.starts, end) - 1
+        while index >= 0 and self.max_ends[index] > start:
+            if self.ends[index] > start:
+                return self.ids[index]
+            index -= 1
+        return None
+
+    def __len__(self):
+        return len(self.starts)
+
+
+def build_day_index(appointments):
+    index = DayScheduleIndex()
+    for appt in appointments:
+        if appt.get('start_at') and appt.get('end_at'):
+            start, end = interval_minutes(appt['start_at'], appt['end_at'])
+        else:
+            start = to_minutes(appt['time'])
+            end = start + appt.get('duration_minutes', DEFAULT_APPOINTMENT_MINUTES)
+        index.add(start, end, appt.get('id'))
+    return index
+
+
+class ScheduleCache:
+    # Per-(doctor, day) interval indexes for conflict previews. The cache is
+    # per worker: writes invalidate their day only in the worker that handled
+    # them, so with several workers a preview can miss bookings made elsewhere
+    # in the last `ttl` seconds. Booking itself always re-checks the database.
+    def __init__(self, ttl=30.0, max_entries=5000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = {}
+
+    async def get(self, doctor_id, day, load):
+        key = (doctor_id, day)
+        entry = self.entries.get(key)
+        now = time.monotonic()
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        index = build_day_index(await load())
+        if len(self.entries) >= self.max_entries:
+            self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+        self.entries[key] = (now + self.ttl, index)
+        return index
+
+    def invalidate(self, doctor_id, day):
+        self.entries.pop((doctor_id, day), None)
+
+
+def add_months(day, months):
+    # Clamp to the last day of the month, so a series starting on the 31st
+    # lands on the 30th (or 28th/29th) in shorter months.
+    month_index = day.month - 1 + months
+    year, month = day.year + month_index // 12, month_index % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+def expand_recurrence(start_date, frequency, interval, count):
+    start = date.fromisoformat(start_date)
+    if frequency == "daily":
+        days = [start + timedelta(days=interval * n) for n in range(count)]
+    elif frequency == "weekly":
+        days = [start + timedelta(weeks=interval * n) for n in range(count)]
+    elif frequency == "monthly":
+        days = [add_months(start, interval * n) for n in range(count)]
+    else:
+        raise ValueError(f"Unknown frequency: {frequency}")
+    return [day.isoformat() for day in days]
+
+
+def clinic_slots():
+    return [from_minutes(m) for m in range(to_minutes(CLINIC_OPENS), to_minutes(CLINIC_CLOSES), SLOT_MINUTES)]
+
+
+def suggest_alternatives(requested_time, duration_minutes, day_index, limit=3):
+    # Free slots on the same day, closest to the requested time first.
+    requested = to_minutes(requested_time)
+    closes = to_minutes(CLINIC_CLOSES)
+    free = [
+        slot for slot in clinic_slots()
+        if to_minutes(slot) + duration_minutes <= closes
+        and not day_index.overlaps(to_minutes(slot), to_minutes(slot) + duration_minutes)
+    ]
+    free.sort(key=lambda slot: (abs(to_minutes(slot) - requested), slot))
+    return free[:limit]
@@ -1,25 +1,63 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Query
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, UploadFile, File, Query, Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import re
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional
+from typing import List, Literal, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
 from passlib.context import CryptContext
 from jose import JWTError, jwt
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 import base64
+from admission import AdmissionController
+from archive import Archiver
+from audit import AuditLogger, partition_name
+from batch import dispatch
+from blobstore import BlobStore
+from cache import SingleFlightCache
+from fieldsets import parse_fields, projection, sparse_response
+from jobs import JobQueue
+from database import MongoManager, startup_lock
+from dicom import DICOM_CONTENT_TYPE, HEADER_BYTES, header_available, parse_header, preview_available, render_preview
+from ledger import Ledger, ledger_entry
+from loop_monitor import LoopLagMonitor
+from memory_diagnostics import MemoryDiagnostics
+from uploads import FINALIZE_LEASE_SECONDS, SESSION_HOURS, UploadSessions
+from sync import ChangeFeed
+from static_files import FrontendFiles
+from schedule import (
+    DEFAULT_APPOINTMENT_MINUTES, FREQUENCIES, ScheduleCache, appointment_interval, build_day_index,
+    expand_recurrence, legacy_time_range, suggest_alternatives, to_minutes
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+mongo = MongoManager.from_env()
+db = mongo.db
+reporting_db = mongo.reporting_db
+loop_monitor = LoopLagMonitor.from_env()
+admission_control = AdmissionController.from_env(lambda: loop_monitor.last_lag, mongo.pool_waits.current)
+dashboard_cache = SingleFlightCache(ttl=float(os.environ.get('DASHBOARD_STATS_TTL_SECONDS', '5')))
+schedule_cache = ScheduleCache(ttl=float(os.environ.get('SCHEDULE_CACHE_SECONDS', '30')))
+audit_log = AuditLogger.from_env(db)
+job_queue = JobQueue.from_env(db)
+change_feed = ChangeFeed.from_env(db)
+ledger = Ledger(db, change_feed)
+archiver = Archiver.from_env(db)
+memory_diagnostics = MemoryDiagnostics.from_env(db)
+blob_store = BlobStore(db)
+upload_sessions = UploadSessions(db, blob_store)
+# Coalesces concurrent first views of the same DICOM file into one render.
+dicom_previews = SingleFlightCache(ttl=60)
 
 app = FastAPI()
 api_router = APIRouter(prefix="/api")
@@ -69,6 +107,7 @@ class Procedure(BaseModel):
     name_en: str
     name_ar: str
     price: float
+    duration_minutes: int = DEFAULT_APPOINTMENT_MINUTES
     description_en: Optional[str] = ""
     description_ar: Optional[str] = ""
 
@@ -76,6 +115,7 @@ class ProcedureCreate(BaseModel):
     name_en: str
     name_ar: str
     price: float
+    duration_minutes: int = DEFAULT_APPOINTMENT_MINUTES
     description_en: Optional[str] = ""
     description_ar: Optional[str] = ""
 
@@ -83,6 +123,7 @@ class ProcedureUpdate(BaseModel):
     name_en: Optional[str] = None
     name_ar: Optional[str] = None
     price: Optional[float] = None
+    duration_minutes: Optional[int] = None
     description_en: Optional[str] = None
     description_ar: Optional[str] = None
 
@@ -115,6 +156,11 @@ class Appointment(BaseModel):
     status: str
     procedures: List[str] = []
     notes: Optional[str] = ""
+    duration_minutes: int = DEFAULT_APPOINTMENT_MINUTES
+    start_at: Optional[str] = None
+    end_at: Optional[str] = None
+    planned_procedures: List[str] = []
+    series_id: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class AppointmentCreate(BaseModel):
@@ -123,12 +169,53 @@ class AppointmentCreate(BaseModel):
     date: str
     time: str
     status: str = "confirmed"
+    duration_minutes: Optional[int] = Field(None, ge=5, le=480)
+    planned_procedures: List[str] = []
 
 class AppointmentUpdate(BaseModel):
     status: Optional[str] = None
     procedures: Optional[List[str]] = None
     notes: Optional[str] = None
 
+class AppointmentSeriesCreate(BaseModel):
+    patient_id: str
+    doctor_id: str
+    start_date: str
+    time: str
+    frequency: str = "monthly"
+    interval: int = Field(1, ge=1, le=12)
+    count: int = Field(..., ge=1, le=104)
+    status: str = "confirmed"
+    duration_minutes: Optional[int] = Field(None, ge=5, le=480)
+    planned_procedures: List[str] = []
+    dry_run: bool = False
+
+class SeriesConflict(BaseModel):
+    date: str
+    time: str
+    alternatives: List[str] = []
+
+class AppointmentSeriesResult(BaseModel):
+    series_id: Optional[str] = None
+    created: List[Appointment]
+    conflicts: List[SeriesConflict]
+
+class AppointmentBulkItem(AppointmentUpdate):
+    id: str
+
+class AppointmentBulkRequest(BaseModel):
+    items: List[AppointmentBulkItem] = Field(..., min_length=1, max_length=500)
+
+class AppointmentBulkResult(BaseModel):
+    id: str
+    status: str
+    detail: Optional[str] = None
+
+class AppointmentBulkResponse(BaseModel):
+    updated: int
+    failed: int
+    results: List[AppointmentBulkResult]
+
 class PatientHistory(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -138,6 +225,7 @@ class PatientHistory(BaseModel):
     notes: str
     xray_images: List[str] = []
     procedures: List[str] = []
+    procedure_names: List[str] = []
     total_cost: float = 0.0
 
 class PatientHistoryCreate(BaseModel):
@@ -145,6 +233,17 @@ class PatientHistoryCreate(BaseModel):
     notes: str
     procedures: List[str] = []
 
+class XrayUploadCreate(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    size: int = Field(..., gt=0)
+
+class XrayUploadFinalize(BaseModel):
+    sha256: Optional[str] = Field(None, description="Optional checksum of the whole file")
+
+class BalanceAdjustmentCreate(BaseModel):
+    amount: float = Field(..., description="Added to the patient's total cost; negative for discounts or write-offs")
+    reason: str = Field(..., min_length=1)
+
 class Payment(BaseModel):
     model_config = ConfigDict(extra="ignore")
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -161,6 +260,57 @@ class PaymentCreate(BaseModel):
     amount: float
     notes: Optional[str] = ""
 
+class BatchRequestItem(BaseModel):
+    method: Literal["GET"] = "GET"
+    path: str = Field(..., description="API path with an optional query string, e.g. /api/appointments?fields=id,date")
+
+class BatchRequest(BaseModel):
+    requests: List[BatchRequestItem] = Field(..., min_length=1, max_length=20)
+
+class ParquetExportRequest(BaseModel):
+    full: bool = Field(False, description="Replace the exported data instead of adding changes since the last export")
+
+class TracemallocSettings(BaseModel):
+    enabled: bool
+    frames: int = Field(1, ge=1, le=50, description="Stack frames kept per allocation; more is slower")
+
+DEFAULT_PROCEDURES = [
+    {"name_en": "Dental Cleaning", "name_ar": "تنظيف الأسنان", "price": 100.0, "duration_minutes": 30, "description_en": "Professional teeth cleaning", "description_ar": "تنظيف احترافي للأسنان"},
+    {"name_en": "Tooth Filling", "name_ar": "حشو الأسنان", "price": 150.0, "duration_minutes": 45, "description_en": "Cavity filling", "description_ar": "حشو تسوس الأسنان"},
+    {"name_en": "Tooth Extraction", "name_ar": "خلع الأسنان", "price": 200.0, "duration_minutes": 45, "description_en": "Tooth removal", "description_ar": "إزالة السن"},
+    {"name_en": "Root Canal", "name_ar": "علاج الجذور", "price": 500.0, "duration_minutes": 60, "description_en": "Root canal treatment", "description_ar": "علاج قناة الجذر"},
+    {"name_en": "Dental Crown", "name_ar": "تاج الأسنان", "price": 800.0, "duration_minutes": 60, "description_en": "Tooth crown placement", "description_ar": "تركيب تاج الأسنان"},
+    {"name_en": "Teeth Whitening", "name_ar": "تبييض الأسنان", "price": 300.0, "duration_minutes": 60, "description_en": "Professional whitening", "description_ar": "تبييض احترافي"},
+    {"name_en": "Dental Implant", "name_ar": "زراعة الأسنان", "price": 2000.0, "duration_minutes": 90, "description_en": "Tooth implant surgery", "description_ar": "جراحة زراعة الأسنان"},
+    {"name_en": "Orthodontic Braces", "name_ar": "تقويم الأسنان", "price": 3000.0, "duration_minutes": 60, "description_en": "Braces installation", "description_ar": "تركيب التقويم"},
+    {"name_en": "X-Ray", "name_ar": "أشعة سينية", "price": 50.0, "duration_minutes": 15, "description_en": "Dental X-ray imaging", "description_ar": "تصوير الأسنان بالأشعة"},
+    {"name_en": "Consultation", "name_ar": "استشارة", "price": 75.0, "duration_minutes": 30, "description_en": "Initial consultation", "description_ar": "استشارة أولية"}
+]
+
+# Fields each role may select with ?fields=; roles that aren't listed may select
+# any field of the model. Requests without ?fields= return the full model.
+# Receptionists get what the front desk needs to find patients, book them in
+# and take payments, but no clinical details. Balances are included: the
+# receptionist dashboard shows them and /balance and /ledger return them.
+# Fields added to Patient later stay hidden from receptionists until listed.
+FIELD_ALLOW_LISTS = {
+    Patient: {
+        "receptionist": [
+            "id", "name", "phone", "doctor_id", "doctor_name", "created_at", "total_cost", "total_paid", "balance"
+        ]
+    },
+    Appointment: {
+        # Planned procedures are clinical; the rest is what a booking needs.
+        "receptionist": [
+            "id", "patient_id", "patient_name", "doctor_id", "doctor_name", "date", "time", "status",
+            "duration_minutes", "start_at", "end_at", "series_id", "created_at"
+        ]
+    }
+}
+
+def allowed_fields(model, role):
+    return FIELD_ALLOW_LISTS.get(model, {}).get(role, model.model_fields.keys())
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -174,7 +324,11 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def get_current_user(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    # Requests inside a batch reuse the user the batch authenticated.
+    batch_user = getattr(request.state, "batch_user", None)
+    if batch_user is not None:
+        return batch_user
     try:
         token = credentials.credentials
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -196,6 +350,16 @@ def require_admin(current_user: User = Depends(get_current_user)):
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+def admit(route_class):
+    # Booking and payment routes are "critical", expensive reads are "reports";
+    # the per-user token bucket is keyed off the authenticated user.
+    async def dependency(request: Request, current_user: User = Depends(get_current_user)):
+        route = request.scope.get("route")
+        route_key = route.path if route is not None else request.url.path
+        async with admission_control.admit(route_class, route_key, current_user.id):
+            yield
+    return dependency
+
 @api_router.post("/auth/register", response_model=Token)
 async def register(user_data: UserCreate):
     existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 0})
@@ -207,8 +371,10 @@ async def register(user_data: UserCreate):
     user_dict['created_at'] = datetime.now(timezone.utc).isoformat()
     password = user_dict.pop('password')
     user_dict['password_hash'] = get_password_hash(password)
+    user_dict.update(await change_feed.stamp())
     
     await db.users.insert_one(user_dict)
+    dashboard_cache.invalidate()
     
     access_token = create_access_token(data={"sub": user_dict['id']})
     user_obj = User(**{k: v for k, v in user_dict.items() if k != 'password_hash'})
@@ -233,15 +399,15 @@ async def login(credentials: UserLogin):
 async def get_me(current_user: User = Depends(get_current_user)):
     return current_user
 
-@api_router.get("/users", response_model=List[User])
+@api_router.get("/users", response_model=List[User], dependencies=[Depends(admit("standard"))])
 async def get_users(current_user: User = Depends(require_admin)):
-    users = await db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
+    users = await reporting_db.users.find({}, {"_id": 0, "password_hash": 0}).to_list(1000)
     for user in users:
         if isinstance(user.get('created_at'), str):
             user['created_at'] = datetime.fromisoformat(user['created_at'])
     return [User(**user) for user in users]
 
-@api_router.post("/users", response_model=User)
+@api_router.post("/users", response_model=User, dependencies=[Depends(admit("standard"))])
 async def create_user(user_data: UserCreate, current_user: User = Depends(require_admin)):
     existing_user = await db.users.find_one({"email": user_data.email}, {"_id": 0})
     if existing_user:
@@ -252,13 +418,15 @@ async def create_user(user_data: UserCreate, current_user: User = Depends(requir
     user_dict['created_at'] = datetime.now(timezone.utc).isoformat()
     password = user_dict.pop('password')
     user_dict['password_hash'] = get_password_hash(password)
+    user_dict.update(await change_feed.stamp())
     
     await db.users.insert_one(user_dict)
+    dashboard_cache.invalidate()
     user_obj = User(**{k: v for k, v in user_dict.items() if k != 'password_hash'})
     user_obj.created_at = datetime.fromisoformat(user_dict['created_at'])
     return user_obj
 
-@api_router.put("/users/{user_id}", response_model=User)
+@api_router.put("/users/{user_id}", response_model=User, dependencies=[Depends(admit("standard"))])
 async def update_user(user_id: str, update_data: UserUpdate, current_user: User = Depends(require_admin)):
     user = await db.users.find_one({"id": user_id}, {"_id": 0})
     if not user:
@@ -274,81 +442,112 @@ async def update_user(user_id: str, update_data: UserUpdate, current_user: User
         if existing:
             raise HTTPException(status_code=400, detail="Email already in use")
     
-    await db.users.update_one({"id": user_id}, {"$set": update_dict})
+    await db.users.update_one({"id": user_id}, {"$set": {**update_dict, **await change_feed.stamp()}})
+    dashboard_cache.invalidate()
+    if user['role'] == "doctor" and update_dict.get('role', "doctor") != "doctor":
+        await change_feed.tombstone("doctors", user_id)
+    if 'name' in update_dict and update_dict['name'] != user.get('name'):
+        await job_queue.enqueue(
+            "propagate_user_name", {"user_id": user_id}, dedupe_key=f"propagate_user_name:{user_id}"
+        )
     
     updated_user = await db.users.find_one({"id": user_id}, {"_id": 0, "password_hash": 0})
     if isinstance(updated_user.get('created_at'), str):
         updated_user['created_at'] = datetime.fromisoformat(updated_user['created_at'])
     return User(**updated_user)
 
-@api_router.delete("/users/{user_id}")
+@job_queue.handler("propagate_user_name")
+async def propagate_user_name(user_id):
+    # Copies the user's current name into the documents that denormalize it.
+    user = await db.users.find_one({"id": user_id}, {"_id": 0, "name": 1})
+    if not user:
+        return
+    name = user['name']
+    stamp = await change_feed.stamp()
+    await asyncio.gather(
+        db.patients.update_many({"doctor_id": user_id, "doctor_name": {"$ne": name}}, {"$set": {"doctor_name": name, **stamp}}),
+        db.appointments.update_many({"doctor_id": user_id, "doctor_name": {"$ne": name}}, {"$set": {"doctor_name": name, **stamp}}),
+        db.payments.update_many({"recorded_by": user_id, "recorded_by_name": {"$ne": name}}, {"$set": {"recorded_by_name": name, **stamp}}),
+    )
+
+@api_router.delete("/users/{user_id}", dependencies=[Depends(admit("standard"))])
 async def delete_user(user_id: str, current_user: User = Depends(require_admin)):
     if user_id == current_user.id:
         raise HTTPException(status_code=400, detail="Cannot delete yourself")
     
-    result = await db.users.delete_one({"id": user_id})
-    if result.deleted_count == 0:
+    deleted = await db.users.find_one_and_delete({"id": user_id}, {"_id": 0, "role": 1})
+    dashboard_cache.invalidate()
+    if deleted is None:
         raise HTTPException(status_code=404, detail="User not found")
+    if deleted['role'] == "doctor":
+        await change_feed.tombstone("doctors", user_id)
     return {"message": "User deleted successfully"}
 
-@api_router.get("/procedures", response_model=List[Procedure])
+@api_router.get("/procedures", response_model=List[Procedure], dependencies=[Depends(admit("standard"))])
 async def get_procedures(current_user: User = Depends(get_current_user)):
-    procedures = await db.procedures.find({}, {"_id": 0}).to_list(1000)
+    procedures = await reporting_db.procedures.find({}, {"_id": 0}).to_list(1000)
     return procedures
 
-@api_router.post("/procedures", response_model=Procedure)
+@api_router.post("/procedures", response_model=Procedure, dependencies=[Depends(admit("standard"))])
 async def create_procedure(procedure_data: ProcedureCreate, current_user: User = Depends(require_admin)):
     procedure_dict = procedure_data.model_dump()
     procedure_dict['id'] = str(uuid.uuid4())
+    procedure_dict.update(await change_feed.stamp())
     await db.procedures.insert_one(procedure_dict)
     return Procedure(**procedure_dict)
 
-@api_router.put("/procedures/{procedure_id}", response_model=Procedure)
+@api_router.put("/procedures/{procedure_id}", response_model=Procedure, dependencies=[Depends(admit("standard"))])
 async def update_procedure(procedure_id: str, update_data: ProcedureUpdate, current_user: User = Depends(require_admin)):
     procedure = await db.procedures.find_one({"id": procedure_id}, {"_id": 0})
     if not procedure:
         raise HTTPException(status_code=404, detail="Procedure not found")
     
     update_dict = {k: v for k, v in update_data.model_dump().items() if v is not None}
-    await db.procedures.update_one({"id": procedure_id}, {"$set": update_dict})
+    await db.procedures.update_one({"id": procedure_id}, {"$set": {**update_dict, **await change_feed.stamp()}})
     
     updated_procedure = await db.procedures.find_one({"id": procedure_id}, {"_id": 0})
     return Procedure(**updated_procedure)
 
-@api_router.delete("/procedures/{procedure_id}")
+@api_router.delete("/procedures/{procedure_id}", dependencies=[Depends(admit("standard"))])
 async def delete_procedure(procedure_id: str, current_user: User = Depends(require_admin)):
     result = await db.procedures.delete_one({"id": procedure_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Procedure not found")
+    await change_feed.tombstone("procedures", procedure_id)
     return {"message": "Procedure deleted successfully"}
 
-@api_router.get("/patients/search")
+@api_router.get("/patients/search", dependencies=[Depends(admit("standard"))])
 async def search_patients(name: str = Query(..., min_length=1), current_user: User = Depends(get_current_user)):
     if current_user.role == "receptionist":
-        patients = await db.patients.find(
+        patients = await reporting_db.patients.find(
             {"name": {"$regex": name, "$options": "i"}},
             {"_id": 0, "id": 1, "name": 1, "phone": 1}
         ).to_list(10)
     else:
-        patients = await db.patients.find(
+        patients = await reporting_db.patients.find(
             {"name": {"$regex": name, "$options": "i"}},
             {"_id": 0}
         ).to_list(10)
     return patients
 
-@api_router.get("/patients", response_model=List[Patient])
-async def get_patients(current_user: User = Depends(get_current_user)):
+@api_router.get("/patients", response_model=List[Patient], dependencies=[Depends(admit("standard"))])
+async def get_patients(fields: Optional[str] = Query(None, description="Comma-separated fields to return"), current_user: User = Depends(get_current_user)):
     query = {}
     if current_user.role == "doctor":
         query["doctor_id"] = current_user.id
     
-    patients = await db.patients.find(query, {"_id": 0}).to_list(1000)
+    selected = parse_fields(fields, allowed_fields(Patient, current_user.role))
+    if selected:
+        patients = await reporting_db.patients.find(query, projection(selected)).to_list(1000)
+        return sparse_response(Patient, selected, patients)
+    
+    patients = await reporting_db.patients.find(query, {"_id": 0}).to_list(1000)
     for patient in patients:
         if isinstance(patient.get('created_at'), str):
             patient['created_at'] = datetime.fromisoformat(patient['created_at'])
     return patients
 
-@api_router.post("/patients", response_model=Patient)
+@api_router.post("/patients", response_model=Patient, dependencies=[Depends(admit("critical"))])
 async def create_patient(patient_data: PatientCreate, current_user: User = Depends(get_current_user)):
     patient_dict = patient_data.model_dump()
     patient_dict['id'] = str(uuid.uuid4())
@@ -356,65 +555,126 @@ async def create_patient(patient_data: PatientCreate, current_user: User = Depen
     patient_dict['total_cost'] = 0.0
     patient_dict['total_paid'] = 0.0
     patient_dict['balance'] = 0.0
+    patient_dict['ledger_seq'] = 0
     
     doctor = await db.users.find_one({"id": patient_dict['doctor_id']}, {"_id": 0})
     if doctor:
         patient_dict['doctor_name'] = doctor['name']
+    patient_dict.update(await change_feed.stamp())
     
     await db.patients.insert_one(patient_dict)
+    dashboard_cache.invalidate()
     patient_obj = Patient(**patient_dict)
     patient_obj.created_at = datetime.fromisoformat(patient_dict['created_at'])
     return patient_obj
 
-@api_router.get("/patients/{patient_id}", response_model=Patient)
-async def get_patient(patient_id: str, current_user: User = Depends(get_current_user)):
-    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
+@api_router.get("/patients/{patient_id}", response_model=Patient, dependencies=[Depends(admit("standard"))])
+async def get_patient(patient_id: str, fields: Optional[str] = Query(None, description="Comma-separated fields to return"), current_user: User = Depends(get_current_user)):
+    selected = parse_fields(fields, allowed_fields(Patient, current_user.role))
+    patient = await db.patients.find_one(
+        {"id": patient_id},
+        projection(selected, extra=("doctor_id",)) if selected else {"_id": 0}
+    )
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found")
     
     if current_user.role == "doctor" and patient['doctor_id'] != current_user.id:
         raise HTTPException(status_code=403, detail="Access denied")
+    await audit_log.record(current_user, "view", "patient", patient_id)
+    
+    if selected:
+        return sparse_response(Patient, selected, patient, many=False)
     
     if isinstance(patient.get('created_at'), str):
         patient['created_at'] = datetime.fromisoformat(patient['created_at'])
     return Patient(**patient)
 
-@api_router.get("/appointments", response_model=List[Appointment])
-async def get_appointments(current_user: User = Depends(get_current_user)):
+@api_router.get("/appointments", response_model=List[Appointment], dependencies=[Depends(admit("standard"))])
+async def get_appointments(
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    include_archived: bool = Query(False, description="Also read archived records; implied by a date_from inside the archived period"),
+    current_user: User = Depends(get_current_user)
+):
     query = {}
     if current_user.role == "doctor":
         query["doctor_id"] = current_user.id
     
-    appointments = await db.appointments.find(query, {"_id": 0}).to_list(1000)
+    selected = parse_fields(fields, allowed_fields(Appointment, current_user.role))
+    if selected:
+        appointments = await archiver.find(reporting_db, "appointments", query, projection(selected), date_from, date_to, include_archived=include_archived)
+        return sparse_response(Appointment, selected, appointments)
+    
+    appointments = await archiver.find(reporting_db, "appointments", query, {"_id": 0}, date_from, date_to, include_archived=include_archived)
     for appt in appointments:
         if isinstance(appt.get('created_at'), str):
             appt['created_at'] = datetime.fromisoformat(appt['created_at'])
     return appointments
 
-@api_router.get("/appointments/check-conflict")
+def parse_slot(date_str, time_str):
+    try:
+        datetime.strptime(date_str, "%Y-%m-%d")
+        minutes = to_minutes(time_str)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="date must be YYYY-MM-DD and time HH:MM")
+    if not 0 <= minutes < 24 * 60:
+        raise HTTPException(status_code=400, detail="time must be HH:MM")
+    return minutes
+
+async def load_procedures(procedure_ids):
+    # One query for a list of procedure ids, keyed by id.
+    procs = await db.procedures.find({"id": {"$in": list(set(procedure_ids))}}, {"_id": 0}).to_list(None)
+    return {proc['id']: proc for proc in procs}
+
+async def appointment_duration(duration_minutes, procedure_ids):
+    # An explicit duration wins; otherwise the planned procedures' defaults add up.
+    if duration_minutes:
+        return duration_minutes
+    if procedure_ids:
+        procs = await db.procedures.find({"id": {"$in": procedure_ids}}, {"_id": 0, "duration_minutes": 1}).to_list(len(procedure_ids))
+        total = sum(proc.get('duration_minutes', DEFAULT_APPOINTMENT_MINUTES) for proc in procs)
+        if total:
+            return total
+    return DEFAULT_APPOINTMENT_MINUTES
+
+async def load_day_schedule(doctor_id, date):
+    return await db.appointments.find(
+        {"doctor_id": doctor_id, "date": date, "status": {"$ne": "cancelled"}},
+        {"_id": 0, "id": 1, "time": 1, "start_at": 1, "end_at": 1, "duration_minutes": 1}
+    ).to_list(None)
+
+@api_router.get("/appointments/check-conflict", dependencies=[Depends(admit("critical"))])
 async def check_appointment_conflict(
     doctor_id: str = Query(...),
     date: str = Query(...),
     time: str = Query(...),
+    duration_minutes: int = Query(DEFAULT_APPOINTMENT_MINUTES, ge=5, le=480),
     current_user: User = Depends(get_current_user)
 ):
-    existing = await db.appointments.find_one({
-        "doctor_id": doctor_id,
-        "date": date,
-        "time": time,
-        "status": {"$ne": "cancelled"}
-    }, {"_id": 0})
-    
-    return {"has_conflict": existing is not None}
+    start = parse_slot(date, time)
+    day_index = await schedule_cache.get(doctor_id, date, lambda: load_day_schedule(doctor_id, date))
+    conflicting_id = day_index.conflicting_id(start, start + duration_minutes)
+    return {"has_conflict": conflicting_id is not None, "conflicting_appointment_id": conflicting_id}
 
-@api_router.post("/appointments", response_model=Appointment)
+@api_router.post("/appointments", response_model=Appointment, dependencies=[Depends(admit("critical"))])
 async def create_appointment(appt_data: AppointmentCreate, current_user: User = Depends(get_current_user)):
+    parse_slot(appt_data.date, appt_data.time)
+    duration = await appointment_duration(appt_data.duration_minutes, appt_data.planned_procedures)
+    start_at, end_at = appointment_interval(appt_data.date, appt_data.time, duration)
+    
+    # Interval overlap on the (doctor_id, date, start_at) index; this is the
+    # authoritative check, the in-memory schedule cache only serves previews.
+    # Appointments the backfill hasn't reached yet are matched on their time.
     conflict = await db.appointments.find_one({
         "doctor_id": appt_data.doctor_id,
         "date": appt_data.date,
-        "time": appt_data.time,
-        "status": {"$ne": "cancelled"}
-    }, {"_id": 0})
+        "status": {"$ne": "cancelled"},
+        "$or": [
+            {"start_at": {"$lt": end_at}, "end_at": {"$gt": start_at}},
+            {"start_at": {"$exists": False}, "time": legacy_time_range(appt_data.time, duration)}
+        ]
+    }, {"_id": 0, "id": 1})
     
     if conflict:
         raise HTTPException(status_code=400, detail="Time slot already booked")
@@ -424,6 +684,9 @@ async def create_appointment(appt_data: AppointmentCreate, current_user: User =
     appt_dict['created_at'] = datetime.now(timezone.utc).isoformat()
     appt_dict['procedures'] = []
     appt_dict['notes'] = ""
+    appt_dict['duration_minutes'] = duration
+    appt_dict['start_at'] = start_at
+    appt_dict['end_at'] = end_at
     
     patient = await db.patients.find_one({"id": appt_dict['patient_id']}, {"_id": 0})
     if patient:
@@ -432,13 +695,98 @@ async def create_appointment(appt_data: AppointmentCreate, current_user: User =
     doctor = await db.users.find_one({"id": appt_dict['doctor_id']}, {"_id": 0})
     if doctor:
         appt_dict['doctor_name'] = doctor['name']
+    appt_dict.update(await change_feed.stamp())
     
     await db.appointments.insert_one(appt_dict)
+    dashboard_cache.invalidate()
+    schedule_cache.invalidate(appt_dict['doctor_id'], appt_dict['date'])
     appt_obj = Appointment(**appt_dict)
     appt_obj.created_at = datetime.fromisoformat(appt_dict['created_at'])
     return appt_obj
 
-@api_router.put("/appointments/{appointment_id}", response_model=Appointment)
+@api_router.post("/appointments/series", response_model=AppointmentSeriesResult, dependencies=[Depends(admit("critical"))])
+async def create_appointment_series(series_data: AppointmentSeriesCreate, current_user: User = Depends(get_current_user)):
+    if series_data.frequency not in FREQUENCIES:
+        raise HTTPException(status_code=400, detail=f"frequency must be one of: {', '.join(FREQUENCIES)}")
+    try:
+        dates = expand_recurrence(series_data.start_date, series_data.frequency, series_data.interval, series_data.count)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start_date must be YYYY-MM-DD")
+    
+    start = parse_slot(dates[0], series_data.time)
+    duration = await appointment_duration(series_data.duration_minutes, series_data.planned_procedures)
+    
+    # One query covers every candidate day; each day's interval index answers
+    # the overlap check and feeds the alternative-slot suggestions.
+    existing = await db.appointments.find({
+        "doctor_id": series_data.doctor_id,
+        "date": {"$in": dates},
+        "status": {"$ne": "cancelled"}
+    }, {"_id": 0, "id": 1, "date": 1, "time": 1, "start_at": 1, "end_at": 1, "duration_minutes": 1}).to_list(None)
+    by_day = {}
+    for appt in existing:
+        by_day.setdefault(appt['date'], []).append(appt)
+    day_indexes = {day: build_day_index(appts) for day, appts in by_day.items()}
+    
+    accepted = []
+    conflicts = []
+    for day in dates:
+        day_index = day_indexes.get(day)
+        if day_index is not None and day_index.overlaps(start, start + duration):
+            conflicts.append(SeriesConflict(
+                date=day, time=series_data.time,
+                alternatives=suggest_alternatives(series_data.time, duration, day_index)
+            ))
+        else:
+            accepted.append(day)
+    
+    def planned_appointment(day, **extra):
+        start_at, end_at = appointment_interval(day, series_data.time, duration)
+        return {
+            "patient_id": series_data.patient_id,
+            "doctor_id": series_data.doctor_id,
+            "date": day,
+            "time": series_data.time,
+            "status": series_data.status,
+            "duration_minutes": duration,
+            "start_at": start_at,
+            "end_at": end_at,
+            "planned_procedures": series_data.planned_procedures,
+            **extra
+        }
+    
+    if series_data.dry_run or not accepted:
+        planned = [Appointment(**planned_appointment(day)) for day in accepted] if series_data.dry_run else []
+        return AppointmentSeriesResult(created=planned, conflicts=conflicts)
+    
+    patient = await db.patients.find_one({"id": series_data.patient_id}, {"_id": 0, "name": 1})
+    doctor = await db.users.find_one({"id": series_data.doctor_id}, {"_id": 0, "name": 1})
+    series_id = str(uuid.uuid4())
+    created_at = datetime.now(timezone.utc).isoformat()
+    stamp = await change_feed.stamp()
+    appt_dicts = [planned_appointment(
+        day,
+        id=str(uuid.uuid4()),
+        patient_name=patient['name'] if patient else "",
+        doctor_name=doctor['name'] if doctor else "",
+        procedures=[],
+        notes="",
+        series_id=series_id,
+        created_at=created_at,
+        **stamp
+    ) for day in accepted]
+    
+    await db.appointments.insert_many(appt_dicts)
+    dashboard_cache.invalidate()
+    for day in accepted:
+        schedule_cache.invalidate(series_data.doctor_id, day)
+    return AppointmentSeriesResult(
+        series_id=series_id,
+        created=[Appointment(**appt) for appt in appt_dicts],
+        conflicts=conflicts
+    )
+
+@api_router.put("/appointments/{appointment_id}", response_model=Appointment, dependencies=[Depends(admit("critical"))])
 async def update_appointment(appointment_id: str, update_data: AppointmentUpdate, current_user: User = Depends(get_current_user)):
     appointment = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
     if not appointment:
@@ -448,39 +796,172 @@ async def update_appointment(appointment_id: str, update_data: AppointmentUpdate
     
     if update_dict.get('procedures'):
         total_cost = 0.0
+        procs = await load_procedures(update_dict['procedures'])
         for proc_id in update_dict['procedures']:
-            proc = await db.procedures.find_one({"id": proc_id}, {"_id": 0})
+            proc = procs.get(proc_id)
             if proc:
                 total_cost += proc['price']
         
-        patient = await db.patients.find_one({"id": appointment['patient_id']}, {"_id": 0})
-        new_total_cost = (patient.get('total_cost', 0.0) + total_cost)
-        new_balance = new_total_cost - patient.get('total_paid', 0.0)
-        
-        await db.patients.update_one(
-            {"id": appointment['patient_id']},
-            {"$set": {"total_cost": new_total_cost, "balance": new_balance}}
-        )
+        if total_cost:
+            await ledger.append(appointment['patient_id'], [ledger_entry(
+                "charge", cost=total_cost, source="appointment", source_id=appointment_id, recorded_by=current_user.id
+            )])
     
-    await db.appointments.update_one({"id": appointment_id}, {"$set": update_dict})
+    await db.appointments.update_one({"id": appointment_id}, {"$set": {**update_dict, **await change_feed.stamp()}})
+    dashboard_cache.invalidate()
+    if 'status' in update_dict:
+        schedule_cache.invalidate(appointment['doctor_id'], appointment['date'])
     
     updated_appointment = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
     if isinstance(updated_appointment.get('created_at'), str):
         updated_appointment['created_at'] = datetime.fromisoformat(updated_appointment['created_at'])
     return Appointment(**updated_appointment)
 
-@api_router.get("/patients/{patient_id}/history", response_model=List[PatientHistory])
-async def get_patient_history(patient_id: str, current_user: User = Depends(get_current_user)):
+@api_router.post("/appointments/bulk", response_model=AppointmentBulkResponse, dependencies=[Depends(admit("critical"))])
+async def bulk_update_appointments(bulk_data: AppointmentBulkRequest, current_user: User = Depends(get_current_user)):
+    results = [AppointmentBulkResult(id=item.id, status="updated") for item in bulk_data.items]
+    seen = set()
+    for item, result in zip(bulk_data.items, results):
+        if item.id in seen:
+            result.status, result.detail = "failed", "Duplicate appointment id in request"
+        seen.add(item.id)
+    
+    appointments = await db.appointments.find(
+        {"id": {"$in": list(seen)}}, {"_id": 0, "id": 1, "patient_id": 1, "doctor_id": 1, "date": 1}
+    ).to_list(len(seen))
+    patient_ids = {appt['id']: appt['patient_id'] for appt in appointments}
+    schedule_days = {appt['id']: (appt['doctor_id'], appt['date']) for appt in appointments}
+    
+    proc_ids = {proc_id for item in bulk_data.items for proc_id in (item.procedures or [])}
+    catalog = await db.procedures.find({"id": {"$in": list(proc_ids)}}, {"_id": 0, "id": 1, "price": 1}).to_list(len(proc_ids))
+    prices = {proc['id']: proc['price'] for proc in catalog}
+    
+    operations = []
+    pending = []
+    stamp = await change_feed.stamp()
+    for item, result in zip(bulk_data.items, results):
+        if result.status == "failed":
+            continue
+        if item.id not in patient_ids:
+            result.status, result.detail = "not_found", "Appointment not found"
+            continue
+        update_dict = {k: v for k, v in item.model_dump(exclude={"id"}).items() if v is not None}
+        if not update_dict:
+            result.status, result.detail = "skipped", "Nothing to update"
+            continue
+        operations.append(UpdateOne({"id": item.id}, {"$set": {**update_dict, **stamp}}))
+        pending.append((item, result))
+    
+    if operations:
+        try:
+            await db.appointments.bulk_write(operations, ordered=False)
+        except BulkWriteError as exc:
+            for error in exc.details.get("writeErrors", []):
+                _, result = pending[error["index"]]
+                result.status, result.detail = "failed", error.get("errmsg", "Write failed")
+    
+    # Procedure charges are grouped per patient and appended in one batch, so
+    # the ledger costs the same few round trips however many patients.
+    charges = {}
+    for item, result in pending:
+        if result.status == "updated" and item.procedures:
+            cost = sum(prices.get(proc_id, 0.0) for proc_id in item.procedures)
+            if cost:
+                charges.setdefault(patient_ids[item.id], []).append(ledger_entry(
+                    "charge", cost=cost, source="appointment", source_id=item.id, recorded_by=current_user.id
+                ))
+    if charges:
+        await ledger.append_many(charges)
+    
+    if pending:
+        dashboard_cache.invalidate()
+    for item, result in pending:
+        if item.status is not None:
+            schedule_cache.invalidate(*schedule_days[item.id])
+    return AppointmentBulkResponse(
+        updated=sum(1 for result in results if result.status == "updated"),
+        failed=sum(1 for result in results if result.status in ("failed", "not_found")),
+        results=results
+    )
+
+def procedure_search_names(proc):
+    return [name for name in (proc.get('name_en'), proc.get('name_ar')) if name]
+
+def search_terms(q):
+    # Plain words from a $text search string, ignoring negations and quotes.
+    return [term.strip('"').lower() for term in q.split() if term.strip('"') and not term.startswith('-')]
+
+def note_snippet(notes, terms, width=160):
+    # A window of the note around the first matching term.
+    lowered = notes.lower()
+    positions = [pos for pos in (lowered.find(term) for term in terms) if pos >= 0]
+    start = max(0, min(positions) - width // 3) if positions and len(notes) > width else 0
+    end = min(len(notes), start + width)
+    return ("…" if start else "") + notes[start:end].strip() + ("…" if end < len(notes) else "")
+
+@api_router.get("/patient-history/search", dependencies=[Depends(admit("standard"))])
+async def search_patient_history(
+    q: str = Query(..., min_length=2, max_length=200),
+    doctor_id: Optional[str] = Query(None, description="Doctor to search (admins only)"),
+    page: int = Query(1, ge=1, le=100),
+    page_size: int = Query(20, ge=1, le=100),
+    current_user: User = Depends(get_current_user)
+):
     if current_user.role == "receptionist":
         raise HTTPException(status_code=403, detail="Receptionists cannot access patient history")
+    if current_user.role == "doctor":
+        doctor_id = current_user.id
+    elif not doctor_id:
+        raise HTTPException(status_code=400, detail="doctor_id is required")
+    
+    query = {"doctor_id": doctor_id, "$text": {"$search": q}}
+    score = {"$meta": "textScore"}
+    total = await reporting_db.patient_history.count_documents(query)
+    records = await reporting_db.patient_history.find(
+        query,
+        {"_id": 0, "id": 1, "patient_id": 1, "date": 1, "notes": 1, "procedure_names": 1, "score": score}
+    ).sort([("score", score)]).skip((page - 1) * page_size).limit(page_size).to_list(page_size)
     
-    history = await db.patient_history.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+    patient_ids = list({record['patient_id'] for record in records})
+    patients = await reporting_db.patients.find(
+        {"id": {"$in": patient_ids}}, {"_id": 0, "id": 1, "name": 1}
+    ).to_list(len(patient_ids))
+    patient_names = {patient['id']: patient['name'] for patient in patients}
+    
+    terms = search_terms(q)
+    results = [
+        {
+            "id": record['id'],
+            "patient_id": record['patient_id'],
+            "patient_name": patient_names.get(record['patient_id']),
+            "date": record.get('date'),
+            "score": round(record.get('score', 0.0), 3),
+            "snippet": note_snippet(record.get('notes', ''), terms),
+            "procedure_names": record.get('procedure_names', []),
+        }
+        for record in records
+    ]
+    return {"query": q, "page": page, "page_size": page_size, "total": total, "results": results}
+
+@api_router.get("/patients/{patient_id}/history", response_model=List[PatientHistory], dependencies=[Depends(admit("standard"))])
+async def get_patient_history(
+    patient_id: str,
+    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    include_archived: bool = Query(False, description="Also read archived records; implied by a date_from inside the archived period"),
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role == "receptionist":
+        raise HTTPException(status_code=403, detail="Receptionists cannot access patient history")
+    await audit_log.record(current_user, "view", "history", patient_id)
+    
+    history = await archiver.find(db, "patient_history", {"patient_id": patient_id}, {"_id": 0}, date_from, date_to, include_archived=include_archived)
     for record in history:
         if isinstance(record.get('date'), str):
             record['date'] = datetime.fromisoformat(record['date'])
     return history
 
-@api_router.post("/patients/{patient_id}/history", response_model=PatientHistory)
+@api_router.post("/patients/{patient_id}/history", response_model=PatientHistory, dependencies=[Depends(admit("standard"))])
 async def add_patient_history(patient_id: str, history_data: PatientHistoryCreate, current_user: User = Depends(get_current_user)):
     if current_user.role != "doctor" and current_user.role != "admin":
         raise HTTPException(status_code=403, detail="Only doctors and admins can add patient history")
@@ -492,72 +973,425 @@ async def add_patient_history(patient_id: str, history_data: PatientHistoryCreat
     history_dict['xray_images'] = []
     
     total_cost = 0.0
+    procedure_names = []
+    procs = await load_procedures(history_dict['procedures'])
     for proc_id in history_dict['procedures']:
-        proc = await db.procedures.find_one({"id": proc_id}, {"_id": 0})
+        proc = procs.get(proc_id)
         if proc:
             total_cost += proc['price']
+            procedure_names.extend(procedure_search_names(proc))
     history_dict['total_cost'] = total_cost
+    # Denormalized so the history text index covers procedure names too.
+    history_dict['procedure_names'] = procedure_names
+    history_dict.update(await change_feed.stamp())
     
-    patient = await db.patients.find_one({"id": patient_id}, {"_id": 0})
-    new_total_cost = (patient.get('total_cost', 0.0) + total_cost)
-    new_balance = new_total_cost - patient.get('total_paid', 0.0)
-    
-    await db.patients.update_one(
-        {"id": patient_id},
-        {"$set": {"total_cost": new_total_cost, "balance": new_balance}}
-    )
+    if total_cost:
+        await ledger.append(patient_id, [ledger_entry(
+            "charge", cost=total_cost, source="history", source_id=history_dict['id'], recorded_by=current_user.id
+        )])
     
     await db.patient_history.insert_one(history_dict)
+    dashboard_cache.invalidate()
     history_obj = PatientHistory(**history_dict)
     history_obj.date = datetime.fromisoformat(history_dict['date'])
     return history_obj
 
-@api_router.post("/patients/{patient_id}/xray")
+@api_router.post("/patients/{patient_id}/xray", dependencies=[Depends(admit("standard"))])
 async def upload_xray(patient_id: str, file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
     if current_user.role not in ["doctor", "admin"]:
         raise HTTPException(status_code=403, detail="Only doctors and admins can upload X-rays")
     
-    contents = await file.read()
-    base64_image = base64.b64encode(contents).decode('utf-8')
-    image_data = f"data:{file.content_type};base64,{base64_image}"
-    
+    stored = await blob_store.put_upload(file)
+    image_record = await insert_xray_record(patient_id, current_user.id, stored, file.filename)
+    return {
+        "id": image_record['id'],
+        "filename": file.filename,
+        "uploaded_at": image_record['uploaded_at'],
+        "blob_id": stored['blob_id'],
+        "deduplicated": stored['deduplicated']
+    }
+
+async def insert_xray_record(patient_id, doctor_id, stored, filename):
     image_record = {
         "id": str(uuid.uuid4()),
         "patient_id": patient_id,
-        "doctor_id": current_user.id,
-        "image_data": image_data,
-        "filename": file.filename,
+        "doctor_id": doctor_id,
+        "blob_id": stored['blob_id'],
+        "content_type": stored['content_type'],
+        "size": stored['size'],
+        "filename": filename,
         "uploaded_at": datetime.now(timezone.utc).isoformat()
     }
+    if stored['content_type'] == DICOM_CONTENT_TYPE:
+        # Known files reuse their parsed header; new ones are indexed by a worker.
+        blob = await blob_store.get(stored['blob_id'])
+        if 'dicom' in blob:
+            image_record.update(blob['dicom'])
+        else:
+            image_record['processing'] = "pending"
+    try:
+        await db.xray_images.insert_one(image_record)
+    except Exception:
+        await blob_store.release(stored['blob_id'])
+        raise
+    image_record.pop('_id', None)
+    if image_record.get('processing') == "pending":
+        await job_queue.enqueue("index_xray", {"xray_id": image_record['id']})
+    return image_record
+
+@job_queue.handler("index_xray")
+async def index_xray(xray_id):
+    xray = await db.xray_images.find_one({"id": xray_id}, {"_id": 0, "blob_id": 1, "content_type": 1})
+    if not xray or xray.get('content_type') != DICOM_CONTENT_TYPE:
+        return
+    # Header fields only; previews are rendered when someone first views one.
+    metadata = await dicom_metadata(xray['blob_id'])
+    await db.xray_images.update_one({"id": xray_id}, {"$set": metadata, "$unset": {"processing": ""}})
+
+async def dicom_metadata(blob_id):
+    # Header fields are parsed once per distinct file and kept on the blob, so
+    # re-uploads of the same study reuse them.
+    blob = await blob_store.get(blob_id)
+    if 'dicom' in blob:
+        return blob['dicom']
+    if not header_available():
+        logger.info("pydicom is not installed; storing DICOM upload %s without metadata", blob_id)
+        return {}
+    
+    loop = asyncio.get_running_loop()
+    head = await blob_store.read(blob, HEADER_BYTES)
+    try:
+        metadata = await loop.run_in_executor(None, parse_header, head)
+    except Exception:
+        try:
+            # The header didn't fit in the first chunk; parse the whole file.
+            metadata = await loop.run_in_executor(None, parse_header, await blob_store.read(blob))
+        except Exception:
+            logger.warning("Could not parse DICOM header of %s", blob_id, exc_info=True)
+            metadata = {}
+    await blob_store.set_metadata(blob_id, 'dicom', metadata)
+    return metadata
+
+def upload_session_status(session):
+    return {
+        key: session[key]
+        for key in ("id", "patient_id", "filename", "size", "offset", "status", "expires_at", "xray_id")
+        if key in session
+    }
+
+def upload_session_owner(current_user):
+    if current_user.role not in ["doctor", "admin"]:
+        raise HTTPException(status_code=403, detail="Only doctors and admins can upload X-rays")
+    return None if current_user.role == "admin" else current_user.id
+
+@api_router.post("/patients/{patient_id}/xray/uploads", dependencies=[Depends(admit("standard"))])
+async def create_xray_upload(patient_id: str, upload: XrayUploadCreate, current_user: User = Depends(get_current_user)):
+    upload_session_owner(current_user)
+    session = await upload_sessions.create(patient_id, current_user.id, upload.filename, upload.size)
+    await job_queue.enqueue(
+        "expire_upload_session", {"session_id": session['id'], "file_id": session['file_id']}, delay=SESSION_HOURS * 3600
+    )
+    return upload_session_status(session)
+
+@job_queue.handler("expire_upload_session")
+async def expire_upload_session(session_id, file_id):
+    if not await upload_sessions.expire(session_id, file_id):
+        await job_queue.enqueue(
+            "expire_upload_session", {"session_id": session_id, "file_id": file_id}, delay=FINALIZE_LEASE_SECONDS
+        )
+
+@api_router.get("/xray-uploads/{session_id}", dependencies=[Depends(admit("standard"))])
+async def get_xray_upload(session_id: str, current_user: User = Depends(get_current_user)):
+    session = await upload_sessions.get(session_id, upload_session_owner(current_user))
+    return upload_session_status(session)
+
+@api_router.put("/xray-uploads/{session_id}", dependencies=[Depends(admit("standard"))])
+async def append_xray_upload(
+    session_id: str,
+    request: Request,
+    offset: int = Query(..., ge=0, description="Byte offset of this chunk; must equal the session's current offset"),
+    current_user: User = Depends(get_current_user)
+):
+    session = await upload_sessions.get(session_id, upload_session_owner(current_user))
+    session = await upload_sessions.append(session, offset, request.stream())
+    return upload_session_status(session)
+
+@api_router.post("/xray-uploads/{session_id}/finalize", dependencies=[Depends(admit("standard"))])
+async def finalize_xray_upload(session_id: str, finalize: XrayUploadFinalize, current_user: User = Depends(get_current_user)):
+    session = await upload_sessions.get(session_id, upload_session_owner(current_user))
+    if session['status'] == "completed":
+        xray = await db.xray_images.find_one({"id": session['xray_id']}, {"_id": 0, "image_data": 0})
+        if xray:
+            return xray
     
-    await db.xray_images.insert_one(image_record)
-    return {"id": image_record['id'], "filename": file.filename, "uploaded_at": image_record['uploaded_at']}
+    stored = await upload_sessions.finalize(session, finalize.sha256)
+    image_record = await insert_xray_record(session['patient_id'], session['doctor_id'], stored, session['filename'])
+    await upload_sessions.complete(session_id, image_record['id'])
+    return image_record
+
+@api_router.delete("/xray-uploads/{session_id}", dependencies=[Depends(admit("standard"))])
+async def abort_xray_upload(session_id: str, current_user: User = Depends(get_current_user)):
+    session = await upload_sessions.get(session_id, upload_session_owner(current_user))
+    await upload_sessions.abort(session)
+    return {"message": "Upload cancelled"}
+
+async def blob_data_url(blob_id):
+    blob = await blob_store.get(blob_id)
+    if blob is None:
+        return None
+    data = await blob_store.read(blob)
+    return f"data:{blob['content_type']};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def xray_filters(modality, body_part, device, study_from, study_to):
+    query = {}
+    if modality:
+        query['modality'] = modality.upper()
+    if body_part:
+        query['body_part'] = body_part.upper()
+    if device:
+        query['device'] = {"$regex": re.escape(device), "$options": "i"}
+    if study_from or study_to:
+        query['study_date'] = {}
+        if study_from:
+            query['study_date']['$gte'] = study_from
+        if study_to:
+            query['study_date']['$lte'] = study_to
+    return query
+
+def add_xray_urls(xray):
+    xray['image_url'] = f"/api/xrays/{xray['id']}/image"
+    if xray.get('content_type') == DICOM_CONTENT_TYPE:
+        xray['preview_url'] = f"/api/xrays/{xray['id']}/preview"
+    return xray
 
-@api_router.get("/patients/{patient_id}/xrays")
-async def get_patient_xrays(patient_id: str, current_user: User = Depends(get_current_user)):
+@api_router.get("/patients/{patient_id}/xrays", dependencies=[Depends(admit("reports"))])
+async def get_patient_xrays(
+    patient_id: str,
+    include_data: bool = Query(True, description="Embed image_data; pass false and fetch image_url instead"),
+    modality: Optional[str] = None,
+    body_part: Optional[str] = None,
+    device: Optional[str] = None,
+    study_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    study_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    current_user: User = Depends(get_current_user)
+):
     if current_user.role == "receptionist":
         raise HTTPException(status_code=403, detail="Receptionists cannot access X-rays")
+    await audit_log.record(current_user, "view", "xrays", patient_id)
     
-    xrays = await db.xray_images.find({"patient_id": patient_id}, {"_id": 0}).to_list(1000)
+    query = {"patient_id": patient_id, **xray_filters(modality, body_part, device, study_from, study_to)}
+    xrays = await db.xray_images.find(
+        query, {"_id": 0} if include_data else {"_id": 0, "image_data": 0}
+    ).to_list(1000)
+    for xray in xrays:
+        add_xray_urls(xray)
+    
+    if include_data:
+        # Records sharing a blob only read it once. DICOM files can't be shown
+        # inline, so those are left to preview_url.
+        def needs_data(xray):
+            return xray.get('blob_id') and 'image_data' not in xray and xray.get('content_type') != DICOM_CONTENT_TYPE
+        
+        blob_ids = list({xray['blob_id'] for xray in xrays if needs_data(xray)})
+        data_urls = dict(zip(blob_ids, await asyncio.gather(*(blob_data_url(blob_id) for blob_id in blob_ids))))
+        for xray in xrays:
+            if needs_data(xray):
+                xray['image_data'] = data_urls.get(xray['blob_id'])
     return xrays
 
-@api_router.get("/payments")
-async def get_payments(current_user: User = Depends(get_current_user)):
-    payments = await db.payments.find({}, {"_id": 0}).sort("payment_date", -1).to_list(1000)
+@api_router.get("/xrays", dependencies=[Depends(admit("reports"))])
+async def search_xrays(
+    modality: Optional[str] = None,
+    body_part: Optional[str] = None,
+    device: Optional[str] = None,
+    study_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    study_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    limit: int = Query(100, ge=1, le=500),
+    current_user: User = Depends(get_current_user)
+):
+    # Imaging metadata across patients; no image data is read.
+    if current_user.role == "receptionist":
+        raise HTTPException(status_code=403, detail="Receptionists cannot access X-rays")
+    
+    query = xray_filters(modality, body_part, device, study_from, study_to)
+    if current_user.role == "doctor":
+        query['doctor_id'] = current_user.id
+    xrays = await reporting_db.xray_images.find(
+        query, {"_id": 0, "image_data": 0}
+    ).sort([("study_date", -1), ("uploaded_at", -1)]).to_list(limit)
+    return [add_xray_urls(xray) for xray in xrays]
+
+def blob_response(blob, request):
+    headers = {"ETag": f'"{blob["_id"]}"', "Cache-Control": "private, max-age=86400"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    
+    async def chunks():
+        stream = await blob_store.open(blob)
+        while True:
+            chunk = await stream.readchunk()
+            if not chunk:
+                break
+            yield chunk
+    
+    headers["Content-Length"] = str(blob['size'])
+    return StreamingResponse(chunks(), media_type=blob['content_type'], headers=headers)
+
+@api_router.get("/xrays/{xray_id}/image", dependencies=[Depends(admit("standard"))])
+async def get_xray_image(xray_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    if current_user.role == "receptionist":
+        raise HTTPException(status_code=403, detail="Receptionists cannot access X-rays")
+    
+    xray = await db.xray_images.find_one({"id": xray_id}, {"_id": 0})
+    if not xray:
+        raise HTTPException(status_code=404, detail="X-ray not found")
+    
+    if not xray.get('blob_id'):
+        # Uploaded before blob storage; the bytes are embedded as a data URL.
+        header, _, encoded = xray['image_data'].partition(',')
+        return Response(content=base64.b64decode(encoded), media_type=header[5:].split(';')[0])
+    
+    blob = await blob_store.get(xray['blob_id'])
+    if blob is None:
+        raise HTTPException(status_code=404, detail="X-ray image not found")
+    return blob_response(blob, request)
+
+async def render_dicom_preview(blob):
+    data = await blob_store.read(blob)
+    try:
+        png = await asyncio.get_running_loop().run_in_executor(None, render_preview, data)
+    except Exception:
+        logger.warning("Could not render DICOM preview of %s", blob['_id'], exc_info=True)
+        raise HTTPException(status_code=422, detail="Could not render a preview of this DICOM file")
+    stored = await blob_store.put_bytes(png)
+    if not await blob_store.set_preview(blob['_id'], stored['blob_id']):
+        # Another worker rendered it first; keep theirs.
+        await blob_store.release(stored['blob_id'])
+        blob = await blob_store.get(blob['_id'])
+        return await blob_store.get(blob['preview_blob_id'])
+    return await blob_store.get(stored['blob_id'])
+
+@api_router.get("/xrays/{xray_id}/preview", dependencies=[Depends(admit("standard"))])
+async def get_xray_preview(xray_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    if current_user.role == "receptionist":
+        raise HTTPException(status_code=403, detail="Receptionists cannot access X-rays")
+    
+    xray = await db.xray_images.find_one({"id": xray_id}, {"_id": 0, "image_data": 0})
+    if not xray:
+        raise HTTPException(status_code=404, detail="X-ray not found")
+    if xray.get('content_type') != DICOM_CONTENT_TYPE:
+        return await get_xray_image(xray_id, request, current_user)
+    if not preview_available():
+        raise HTTPException(status_code=501, detail="DICOM previews are not available on this server")
+    
+    blob = await blob_store.get(xray['blob_id'])
+    if blob is None:
+        raise HTTPException(status_code=404, detail="X-ray image not found")
+    preview = await blob_store.get(blob['preview_blob_id']) if blob.get('preview_blob_id') else None
+    if preview is None:
+        # Rendered on first view only, then kept as a blob of its own.
+        preview = await dicom_previews.get_or_compute(blob['_id'], lambda: render_dicom_preview(blob))
+    return blob_response(preview, request)
+
+@api_router.delete("/xrays/{xray_id}", dependencies=[Depends(admit("standard"))])
+async def delete_xray(xray_id: str, current_user: User = Depends(get_current_user)):
+    if current_user.role not in ["doctor", "admin"]:
+        raise HTTPException(status_code=403, detail="Only doctors and admins can delete X-rays")
+    
+    xray = await db.xray_images.find_one_and_delete({"id": xray_id}, {"_id": 0, "blob_id": 1})
+    if not xray:
+        raise HTTPException(status_code=404, detail="X-ray not found")
+    if xray.get('blob_id'):
+        await blob_store.release(xray['blob_id'])
+    return {"message": "X-ray deleted successfully"}
+
+@api_router.get("/payments", dependencies=[Depends(admit("reports"))])
+async def get_payments(
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    include_archived: bool = Query(False, description="Also read archived records; implied by a date_from inside the archived period"),
+    current_user: User = Depends(get_current_user)
+):
+    selected = parse_fields(fields, allowed_fields(Payment, current_user.role))
+    if selected:
+        payments = await archiver.find(reporting_db, "payments", {}, projection(selected), date_from, date_to, sort=-1, include_archived=include_archived)
+        return sparse_response(Payment, selected, payments)
+    
+    payments = await archiver.find(reporting_db, "payments", {}, {"_id": 0}, date_from, date_to, sort=-1, include_archived=include_archived)
     for payment in payments:
         if isinstance(payment.get('payment_date'), str):
             payment['payment_date'] = datetime.fromisoformat(payment['payment_date'])
     return payments
 
-@api_router.get("/patients/{patient_id}/payments")
-async def get_patient_payments(patient_id: str, current_user: User = Depends(get_current_user)):
-    payments = await db.payments.find({"patient_id": patient_id}, {"_id": 0}).sort("payment_date", -1).to_list(1000)
+@api_router.get("/patients/{patient_id}/payments", dependencies=[Depends(admit("standard"))])
+async def get_patient_payments(
+    patient_id: str,
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    date_from: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    date_to: Optional[str] = Query(None, description="YYYY-MM-DD"),
+    include_archived: bool = Query(False, description="Also read archived records; implied by a date_from inside the archived period"),
+    current_user: User = Depends(get_current_user)
+):
+    selected = parse_fields(fields, allowed_fields(Payment, current_user.role))
+    await audit_log.record(current_user, "view", "payments", patient_id)
+    query = {"patient_id": patient_id}
+    if selected:
+        payments = await archiver.find(db, "payments", query, projection(selected), date_from, date_to, sort=-1, include_archived=include_archived)
+        return sparse_response(Payment, selected, payments)
+    
+    payments = await archiver.find(db, "payments", query, {"_id": 0}, date_from, date_to, sort=-1, include_archived=include_archived)
     for payment in payments:
         if isinstance(payment.get('payment_date'), str):
             payment['payment_date'] = datetime.fromisoformat(payment['payment_date'])
     return payments
 
-@api_router.post("/payments", response_model=Payment)
+@api_router.get("/patients/{patient_id}/balance", dependencies=[Depends(admit("standard"))])
+async def get_patient_balance(patient_id: str, current_user: User = Depends(get_current_user)):
+    patient = await db.patients.find_one(
+        {"id": patient_id}, {"_id": 0, "doctor_id": 1, "ledger_seq": 1, "total_cost": 1, "total_paid": 1, "balance": 1}
+    )
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    if current_user.role == "doctor" and patient['doctor_id'] != current_user.id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    if 'ledger_seq' not in patient:
+        # No ledger yet (created before the ledger existed and not rebuilt);
+        # the first append opens one with these totals.
+        return {
+            "patient_id": patient_id,
+            "total_cost": patient.get('total_cost', 0.0),
+            "total_paid": patient.get('total_paid', 0.0),
+            "balance": patient.get('balance', 0.0),
+            "seq": 0,
+            "snapshot_seq": 0,
+            "tail_entries": 0
+        }
+    return await ledger.balance(patient_id)
+
+@api_router.get("/patients/{patient_id}/ledger", dependencies=[Depends(admit("standard"))])
+async def get_patient_ledger(
+    patient_id: str,
+    before_seq: Optional[int] = Query(None, ge=1),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(get_current_user)
+):
+    if current_user.role not in ["admin", "receptionist"]:
+        raise HTTPException(status_code=403, detail="Only admins and receptionists can view the ledger")
+    return await ledger.history(patient_id, before_seq, limit)
+
+@api_router.post("/patients/{patient_id}/adjustments", dependencies=[Depends(admit("critical"))])
+async def add_balance_adjustment(patient_id: str, adjustment: BalanceAdjustmentCreate, current_user: User = Depends(require_admin)):
+    entry = ledger_entry(
+        "adjustment", cost=adjustment.amount, source="adjustment", note=adjustment.reason, recorded_by=current_user.id
+    )
+    patient = await ledger.append(patient_id, [entry])
+    if patient is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    dashboard_cache.invalidate()
+    return {**entry, "patient_id": patient_id, "seq": patient['ledger_seq']}
+
+@api_router.post("/payments", response_model=Payment, dependencies=[Depends(admit("critical"))])
 async def record_payment(payment_data: PaymentCreate, current_user: User = Depends(get_current_user)):
     if current_user.role not in ["admin", "receptionist"]:
         raise HTTPException(status_code=403, detail="Only admins and receptionists can record payments")
@@ -573,51 +1407,72 @@ async def record_payment(payment_data: PaymentCreate, current_user: User = Depen
         raise HTTPException(status_code=404, detail="Patient not found")
     
     payment_dict['patient_name'] = patient['name']
+    payment_dict.update(await change_feed.stamp())
     
-    new_total_paid = (patient.get('total_paid', 0.0) + payment_dict['amount'])
-    new_balance = patient.get('total_cost', 0.0) - new_total_paid
-    
-    await db.patients.update_one(
-        {"id": payment_dict['patient_id']},
-        {"$set": {"total_paid": new_total_paid, "balance": new_balance}}
-    )
+    await ledger.append(payment_dict['patient_id'], [ledger_entry(
+        "payment", paid=payment_dict['amount'], source="payment", source_id=payment_dict['id'],
+        note=payment_dict.get('notes') or "", recorded_by=current_user.id
+    )])
     
     await db.payments.insert_one(payment_dict)
+    dashboard_cache.invalidate()
     payment_obj = Payment(**payment_dict)
     payment_obj.payment_date = datetime.fromisoformat(payment_dict['payment_date'])
     return payment_obj
 
-@api_router.get("/doctors", response_model=List[User])
+def sync_feeds(current_user):
+    # The same scoping as the list endpoints: doctors see their own patients
+    # and appointments, receptionists only their allowed fields.
+    scope = {"doctor_id": current_user.id} if current_user.role == "doctor" else {}
+    def fields(model):
+        if model not in FIELD_ALLOW_LISTS or current_user.role not in FIELD_ALLOW_LISTS[model]:
+            return {"_id": 0}
+        return projection(allowed_fields(model, current_user.role), extra=("version", "updated_at"))
+    return {
+        "patients": (db.patients, scope, fields(Patient)),
+        "appointments": (db.appointments, scope, fields(Appointment)),
+        "payments": (db.payments, {}, {"_id": 0}),
+        "procedures": (db.procedures, {}, {"_id": 0}),
+        "doctors": (db.users, {"role": "doctor"}, {"_id": 0, "password_hash": 0}),
+    }
+
+@api_router.get("/sync", dependencies=[Depends(admit("standard"))])
+async def sync_changes(
+    since: Optional[str] = Query(None, description="Token from the previous response; omit for a full sync"),
+    limit: int = Query(500, ge=1, le=5000),
+    current_user: User = Depends(get_current_user)
+):
+    position = change_feed.decode_token(since) if since else None
+    return await change_feed.changes(sync_feeds(current_user), position, limit)
+
+@api_router.get("/doctors", response_model=List[User], dependencies=[Depends(admit("standard"))])
 async def get_doctors(current_user: User = Depends(get_current_user)):
-    doctors = await db.users.find({"role": "doctor"}, {"_id": 0, "password_hash": 0}).to_list(1000)
+    doctors = await reporting_db.users.find({"role": "doctor"}, {"_id": 0, "password_hash": 0}).to_list(1000)
     for doctor in doctors:
         if isinstance(doctor.get('created_at'), str):
             doctor['created_at'] = datetime.fromisoformat(doctor['created_at'])
     return [User(**doctor) for doctor in doctors]
 
-@api_router.get("/dashboard/stats")
-async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    
-    if current_user.role == "doctor":
-        appointments_today = await db.appointments.count_documents({
-            "doctor_id": current_user.id,
+async def compute_dashboard_stats(role, doctor_id, today):
+    if role == "doctor":
+        appointments_today = await reporting_db.appointments.count_documents({
+            "doctor_id": doctor_id,
             "date": today,
             "status": {"$in": ["confirmed", "done"]}
         })
         
-        total_patients = await db.patients.count_documents({"doctor_id": current_user.id})
+        total_patients = await reporting_db.patients.count_documents({"doctor_id": doctor_id})
         
         return {
             "appointments_today": appointments_today,
             "total_patients": total_patients
         }
-    elif current_user.role == "admin":
-        total_patients = await db.patients.count_documents({})
-        total_appointments = await db.appointments.count_documents({"date": today})
-        total_doctors = await db.users.count_documents({"role": "doctor"})
+    elif role == "admin":
+        total_patients = await reporting_db.patients.count_documents({})
+        total_appointments = await reporting_db.appointments.count_documents({"date": today})
+        total_doctors = await reporting_db.users.count_documents({"role": "doctor"})
         
-        patients_list = await db.patients.find({}, {"_id": 0, "total_cost": 1, "total_paid": 1, "balance": 1}).to_list(10000)
+        patients_list = await reporting_db.patients.find({}, {"_id": 0, "total_cost": 1, "total_paid": 1, "balance": 1}).to_list(10000)
         
         total_revenue = sum(p.get('total_cost', 0.0) for p in patients_list)
         total_collected = sum(p.get('total_paid', 0.0) for p in patients_list)
@@ -632,16 +1487,165 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
             "total_pending": round(total_pending, 2)
         }
     else:
-        total_patients = await db.patients.count_documents({})
-        total_appointments = await db.appointments.count_documents({"date": today})
+        total_patients = await reporting_db.patients.count_documents({})
+        total_appointments = await reporting_db.appointments.count_documents({"date": today})
         
         return {
             "total_patients": total_patients,
             "appointments_today": total_appointments
         }
 
+@api_router.get("/dashboard/stats", dependencies=[Depends(admit("reports"))])
+async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    # Admins and receptionists see clinic-wide numbers, so they share one entry
+    # per role; doctors get one per doctor.
+    doctor_id = current_user.id if current_user.role == "doctor" else None
+    return await dashboard_cache.get_or_compute(
+        (current_user.role, doctor_id, today),
+        lambda: compute_dashboard_stats(current_user.role, doctor_id, today)
+    )
+
+@api_router.post("/batch")
+async def run_batch(batch: BatchRequest, request: Request, current_user: User = Depends(get_current_user)):
+    # No admission class of its own: each sub-request is admitted and rate
+    # limited like a separate call, and a batch holding a slot while its
+    # sub-requests queue for more could deadlock.
+    async def run(item):
+        path = item.path
+        if not path.startswith(api_router.prefix + "/") or path.split("?", 1)[0].rstrip("/") == f"{api_router.prefix}/batch":
+            return {"path": path, "status": 400, "body": {"detail": "Path must be an API endpoint other than /batch"}}
+        status_code, body = await dispatch(api_router, request, path, {"batch_user": current_user})
+        return {"path": path, "status": status_code, "body": body}
+    
+    return {"results": await asyncio.gather(*(run(item) for item in batch.requests))}
+
+@api_router.get("/admin/metrics")
+async def get_metrics(current_user: User = Depends(require_admin)):
+    return {
+        "pid": os.getpid(),
+        "event_loop": loop_monitor.stats(),
+        "mongo_pool": mongo.pool_waits.stats(),
+        "admission": admission_control.stats(),
+        "dashboard_cache": dashboard_cache.stats(),
+        "audit_log": audit_log.stats(),
+        "db_calls": mongo.db_calls.stats()
+    }
+
+@job_queue.handler("archive_records")
+async def archive_records():
+    # Reschedules itself, so there's always one run queued while archiving is on.
+    if not archiver.after_days:
+        return
+    try:
+        await archiver.run()
+    finally:
+        await job_queue.enqueue("archive_records", delay=archiver.interval_hours * 3600, dedupe_key="archive_records")
+
+@api_router.post("/admin/archive")
+async def run_archive(current_user: User = Depends(require_admin)):
+    if not archiver.after_days:
+        raise HTTPException(status_code=409, detail="Archiving is disabled (ARCHIVE_AFTER_DAYS=0)")
+    # Not deduplicated against the scheduled run, which may be hours away.
+    return {"job_id": await job_queue.enqueue("archive_records")}
+
+async def run_exclusive(name, payload, run, retry_seconds=300):
+    # Maintenance jobs that must not overlap with themselves. A run that finds
+    # another one going queues itself for later instead of failing.
+    async with startup_lock(db, name) as acquired:
+        if not acquired:
+            await job_queue.enqueue(name, payload, delay=retry_seconds)
+            return
+        await run()
+
+@job_queue.handler("export_parquet")
+async def export_parquet_job(full=False):
+    # pyarrow is only loaded by the workers that run exports.
+    import export_parquet
+    argv = ["--out", os.environ["PARQUET_EXPORT_DIR"], *(["--full"] if full else [])]
+    await run_exclusive("export_parquet", {"full": full}, lambda: export_parquet.export(export_parquet.parse_args(argv)))
+
+@api_router.post("/admin/exports/parquet")
+async def queue_parquet_export(export: ParquetExportRequest, current_user: User = Depends(require_admin)):
+    if not os.environ.get("PARQUET_EXPORT_DIR"):
+        raise HTTPException(status_code=409, detail="Parquet exports are not configured (PARQUET_EXPORT_DIR)")
+    return {"job_id": await job_queue.enqueue("export_parquet", export.model_dump())}
+
+@api_router.get("/admin/jobs")
+async def get_job_stats(current_user: User = Depends(require_admin)):
+    return await job_queue.stats()
+
+@api_router.get("/admin/jobs/failed")
+async def get_failed_jobs(limit: int = Query(50, ge=1, le=500), current_user: User = Depends(require_admin)):
+    return await job_queue.jobs.find({"status": "failed"}, {"_id": 0}).sort("finished_at", -1).to_list(limit)
+
+@api_router.post("/admin/jobs/{job_id}/retry")
+async def retry_job(job_id: str, current_user: User = Depends(require_admin)):
+    if not await job_queue.retry(job_id):
+        raise HTTPException(status_code=404, detail="No failed job with that id")
+    return {"message": "Job queued for retry"}
+
+@api_router.get("/admin/audit")
+async def get_audit_log(
+    month: Optional[str] = Query(None, description="YYYY-MM; defaults to the current month"),
+    patient_id: Optional[str] = None,
+    user_id: Optional[str] = None,
+    limit: int = Query(200, ge=1, le=1000),
+    current_user: User = Depends(require_admin)
+):
+    try:
+        when = datetime.strptime(month, "%Y-%m") if month else datetime.now(timezone.utc)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="month must be YYYY-MM")
+    query = {}
+    if patient_id:
+        query['patient_id'] = patient_id
+    if user_id:
+        query['user_id'] = user_id
+    return await db[partition_name(audit_log.prefix, when)].find(query, {"_id": 0}).sort("ts", -1).to_list(limit)
+
+@api_router.get("/admin/diagnostics/memory")
+async def get_memory_diagnostics(current_user: User = Depends(require_admin)):
+    return await memory_diagnostics.status()
+
+@api_router.post("/admin/diagnostics/tracemalloc")
+async def set_tracemalloc(settings: TracemallocSettings, current_user: User = Depends(require_admin)):
+    # Every worker applies this within MEMORY_DIAG_POLL_SECONDS.
+    return await memory_diagnostics.set_tracing(settings.enabled, settings.frames)
+
+@api_router.post("/admin/diagnostics/snapshot")
+async def request_heap_snapshot(current_user: User = Depends(require_admin)):
+    # Workers that are tracing write a report; read them from GET /admin/diagnostics/memory.
+    return await memory_diagnostics.request_snapshot()
+
+@api_router.get("/admin/metrics/blocking")
+async def get_blocking_samples(current_user: User = Depends(require_admin)):
+    if not loop_monitor.detecting_blocks:
+        raise HTTPException(status_code=404, detail="Blocking-call detection is disabled (set LOOP_BLOCK_DETECT_MS)")
+    return list(loop_monitor.block_samples)
+
+@api_router.get("/health/live")
+async def liveness():
+    return {"status": "ok"}
+
+@api_router.get("/health/ready")
+async def readiness():
+    try:
+        await mongo.ping()
+    except Exception as exc:
+        logger.warning("Readiness check failed: %s", exc)
+        raise HTTPException(status_code=503, detail="Database unavailable")
+    return {"status": "ready"}
+
 app.include_router(api_router)
 
+# Optional: serve the production frontend build from this process too.
+frontend_files = FrontendFiles.from_env()
+if frontend_files:
+    @app.get("/{path:path}", include_in_schema=False)
+    async def serve_frontend(path: str, request: Request):
+        return frontend_files.response(request, path)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -650,6 +1654,42 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+def endpoint_label(request):
+    # The route template, so /patients/{patient_id} is one endpoint.
+    route = request.scope.get("route")
+    return f"{request.method} {route.path if route else 'unmatched'}"
+
+@app.middleware("http")
+async def count_db_calls(request, call_next):
+    if not mongo.db_calls.enabled:
+        return await call_next(request)
+    calls, token = mongo.db_calls.start()
+    try:
+        response = await call_next(request)
+    finally:
+        mongo.db_calls.finish(token, calls, endpoint_label(request))
+    response.headers["X-DB-Calls"] = str(calls.total)
+    return response
+
+@app.middleware("http")
+async def sample_request_memory(request, call_next):
+    started = memory_diagnostics.begin_sample()
+    if started is None:
+        return await call_next(request)
+    try:
+        return await call_next(request)
+    finally:
+        memory_diagnostics.end_sample(started, endpoint_label(request))
+
+@app.middleware("http")
+async def track_in_flight_requests(request, call_next):
+    key = object()
+    loop_monitor.request_started(key, request.method, request.url.path)
+    try:
+        return await call_next(request)
+    finally:
+        loop_monitor.request_finished(key)
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
@@ -657,38 +1697,164 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 @app.on_event("startup")
-async def startup_seed_data():
-    existing_procedures = await db.procedures.count_documents({})
-    if existing_procedures == 0:
-        default_procedures = [
-            {"id": str(uuid.uuid4()), "name_en": "Dental Cleaning", "name_ar": "تنظيف الأسنان", "price": 100.0, "description_en": "Professional teeth cleaning", "description_ar": "تنظيف احترافي للأسنان"},
-            {"id": str(uuid.uuid4()), "name_en": "Tooth Filling", "name_ar": "حشو الأسنان", "price": 150.0, "description_en": "Cavity filling", "description_ar": "حشو تسوس الأسنان"},
-            {"id": str(uuid.uuid4()), "name_en": "Tooth Extraction", "name_ar": "خلع الأسنان", "price": 200.0, "description_en": "Tooth removal", "description_ar": "إزالة السن"},
-            {"id": str(uuid.uuid4()), "name_en": "Root Canal", "name_ar": "علاج الجذور", "price": 500.0, "description_en": "Root canal treatment", "description_ar": "علاج قناة الجذر"},
-            {"id": str(uuid.uuid4()), "name_en": "Dental Crown", "name_ar": "تاج الأسنان", "price": 800.0, "description_en": "Tooth crown placement", "description_ar": "تركيب تاج الأسنان"},
-            {"id": str(uuid.uuid4()), "name_en": "Teeth Whitening", "name_ar": "تبييض الأسنان", "price": 300.0, "description_en": "Professional whitening", "description_ar": "تبييض احترافي"},
-            {"id": str(uuid.uuid4()), "name_en": "Dental Implant", "name_ar": "زراعة الأسنان", "price": 2000.0, "description_en": "Tooth implant surgery", "description_ar": "جراحة زراعة الأسنان"},
-            {"id": str(uuid.uuid4()), "name_en": "Orthodontic Braces", "name_ar": "تقويم الأسنان", "price": 3000.0, "description_en": "Braces installation", "description_ar": "تركيب التقويم"},
-            {"id": str(uuid.uuid4()), "name_en": "X-Ray", "name_ar": "أشعة سينية", "price": 50.0, "description_en": "Dental X-ray imaging", "description_ar": "تصوير الأسنان بالأشعة"},
-            {"id": str(uuid.uuid4()), "name_en": "Consultation", "name_ar": "استشارة", "price": 75.0, "description_en": "Initial consultation", "description_ar": "استشارة أولية"}
+async def startup_loop_monitor():
+    loop_monitor.start()
+
+@app.on_event("startup")
+async def startup_audit_log():
+    audit_log.start()
+
+@app.on_event("startup")
+async def startup_memory_diagnostics():
+    memory_diagnostics.start()
+
+@app.on_event("startup")
+async def startup_upload_sweep():
+    upload_sessions.start()
+
+@app.on_event("startup")
+async def startup_warm_up_db():
+    await mongo.warm_up()
+
+async def ensure_indexes():
+    await db.appointments.create_index(
+        [("doctor_id", 1), ("date", 1), ("start_at", 1)], name="doctor_day_schedule"
+    )
+    # History search is always scoped to one doctor, so doctor_id is an equality
+    # prefix and a search only walks that doctor's text keys. No stemming
+    # language: notes mix English and Arabic.
+    await db.patient_history.create_index(
+        [("doctor_id", 1), ("notes", "text"), ("procedure_names", "text")],
+        name="doctor_history_text",
+        default_language="none",
+        weights={"notes": 1, "procedure_names": 2},
+    )
+    await blob_store.ensure_indexes()
+    await upload_sessions.ensure_indexes()
+    await ledger.ensure_indexes()
+    await job_queue.ensure_indexes()
+    await archiver.ensure_indexes()
+    await memory_diagnostics.ensure_indexes()
+    # Leases past their expiry are dead weight; takeover already ignores them.
+    await db.startup_locks.create_index("expires_at", expireAfterSeconds=0)
+    await change_feed.ensure_indexes([
+        (db.patients, ("doctor_id",)),
+        (db.appointments, ("doctor_id",)),
+        (db.payments, ()),
+        (db.procedures, ()),
+        (db.users, ("role",)),
+        (db.patient_history, ()),
+    ])
+    await db.xray_images.create_index([("patient_id", 1), ("study_date", -1)], name="patient_studies")
+    await db.xray_images.create_index(
+        [("doctor_id", 1), ("modality", 1), ("study_date", -1)], name="doctor_studies"
+    )
+
+async def backfill_appointment_intervals(batch_size=1000):
+    # Appointments booked before durations existed get the default duration.
+    while True:
+        batch = await db.appointments.find(
+            {"start_at": {"$exists": False}},
+            {"_id": 0, "id": 1, "date": 1, "time": 1, "duration_minutes": 1}
+        ).to_list(batch_size)
+        if not batch:
+            return
+        operations = []
+        stamp = await change_feed.stamp()
+        for appt in batch:
+            duration = appt.get('duration_minutes', DEFAULT_APPOINTMENT_MINUTES)
+            try:
+                start_at, end_at = appointment_interval(appt['date'], appt['time'], duration)
+            except (KeyError, ValueError):
+                start_at = end_at = None
+            operations.append(UpdateOne(
+                {"id": appt['id']},
+                {"$set": {"duration_minutes": duration, "start_at": start_at, "end_at": end_at, **stamp}}
+            ))
+        await db.appointments.bulk_write(operations, ordered=False)
+        logger.info("Backfilled start/end times for %d appointments", len(operations))
+
+async def backfill_history_procedure_names(batch_size=1000):
+    catalog = {
+        proc['id']: procedure_search_names(proc)
+        for proc in await db.procedures.find({}, {"_id": 0}).to_list(1000)
+    }
+    while True:
+        batch = await db.patient_history.find(
+            {"procedure_names": {"$exists": False}},
+            {"_id": 0, "id": 1, "procedures": 1}
+        ).to_list(batch_size)
+        if not batch:
+            return
+        operations = [
+            UpdateOne(
+                {"id": record['id']},
+                {"$set": {"procedure_names": [
+                    name for proc_id in record.get('procedures', []) for name in catalog.get(proc_id, [])
+                ]}}
+            )
+            for record in batch
         ]
-        await db.procedures.insert_many(default_procedures)
-        logger.info("Seeded default dental procedures")
-    
-    admin_count = await db.users.count_documents({"role": "admin"})
-    if admin_count == 0:
-        admin_user = {
-            "id": str(uuid.uuid4()),
-            "email": "admin@clinic.com",
-            "name": "Admin",
-            "phone": "+962-000-0000",
-            "role": "admin",
-            "password_hash": get_password_hash("admin123"),
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        await db.users.insert_one(admin_user)
-        logger.info("Created default admin user: admin@clinic.com / admin123")
+        await db.patient_history.bulk_write(operations, ordered=False)
+        logger.info("Backfilled procedure names for %d history records", len(operations))
+
+async def backfill_sync_versions():
+    for collection in (db.patients, db.appointments, db.payments, db.procedures, db.users, db.patient_history):
+        stamped = await change_feed.backfill(collection)
+        if stamped:
+            logger.info("Assigned sync versions to %d %s", stamped, collection.name)
+
+@job_queue.handler("backfill_legacy_records")
+async def backfill_legacy_records():
+    # Full-collection scans for records from before a field existed. Run by a
+    # job worker after each deploy, so API workers don't scan on startup.
+    await backfill_appointment_intervals()
+    await backfill_history_procedure_names()
+    await backfill_sync_versions()
+
+@app.on_event("startup")
+async def startup_seed_data():
+    # Every worker runs startup; the lock makes the count-then-insert below
+    # happen once instead of racing and duplicating the seed data. Workers
+    # that don't get it start serving straight away.
+    async with startup_lock(db, "seed_data") as acquired:
+        if not acquired:
+            return
+        existing_procedures = await db.procedures.count_documents({})
+        if existing_procedures == 0:
+            stamp = await change_feed.stamp()
+            default_procedures = [{"id": str(uuid.uuid4()), **proc, **stamp} for proc in DEFAULT_PROCEDURES]
+            await db.procedures.insert_many(default_procedures)
+            logger.info("Seeded default dental procedures")
+        
+        await ensure_indexes()
+        await job_queue.enqueue("backfill_legacy_records", dedupe_key="backfill_legacy_records")
+        if archiver.after_days:
+            await job_queue.enqueue("archive_records", dedupe_key="archive_records")
+        
+        admin_count = await db.users.count_documents({"role": "admin"})
+        if admin_count == 0:
+            admin_user = {
+                "id": str(uuid.uuid4()),
+                "name": "Admin",
+                "phone": "+962-000-0000",
+                "role": "admin",
+                "password_hash": get_password_hash("admin123"),
+                "created_at": datetime.now(timezone.utc).isoformat(),
+                **await change_feed.stamp()
+            }
+            result = await db.users.update_one(
+                {"email": "admin@clinic.com"},
+                {"$setOnInsert": admin_user},
+                upsert=True
+            )
+            if result.upserted_id is not None:
+                logger.info("Created default admin user: admin@clinic.com / admin123")
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    await loop_monitor.stop()
+    await audit_log.stop()
+    await memory_diagnostics.stop()
+    await upload_sessions.stop()
+    mongo.close()
\ No newline at end of file
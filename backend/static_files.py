@@ -0,0 +1,173 @@
+"""Serve the production frontend build from the API process.
+
+Usage (from the backend/ directory, after `yarn build` in frontend/):
+
+    python static_files.py compress ../frontend/build    # write .br and .gz next to each asset
+
+Then start the API with FRONTEND_BUILD_DIR=../frontend/build. Requests that
+aren't for /api are answered from the build: the precompressed copy the
+browser accepts (brotli, then gzip, then the original), content-hashed
+assets with a one-year immutable Cache-Control, and index.html with short
+caching so a deploy shows up within a minute. Paths without a file
+extension that don't match a file get index.html, so client-side routes
+survive a reload.
+
+The build is indexed once at startup. A new build needs a restart.
+"""
+import argparse
+import gzip
+import logging
+import mimetypes
+import os
+import re
+import sys
+
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# CRA puts an 8+ hex character content hash in built asset names
+# (main.3f2a1b4c.js, logo.5d5d9eef.svg).
+HASHED = re.compile(r"\.[0-9a-f]{8,}\.(?:chunk\.)?[a-z0-9]+$")
+IMMUTABLE = "public, max-age=31536000, immutable"
+INDEX_CACHE = "public, max-age=60, must-revalidate"
+OTHER_CACHE = "public, max-age=3600"
+# Suffixes in order of preference, with the Content-Encoding each stands for.
+ENCODINGS = [(".br", "br"), (".gz", "gzip")]
+COMPRESSIBLE = {".js", ".css", ".html", ".json", ".svg", ".map", ".txt", ".xml", ".ico", ".webmanifest"}
+MIN_COMPRESS_BYTES = 1024
+
+
+def accepted_encodings(header):
+    accepted = set()
+    for part in header.split(","):
+        name, _, params = part.partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+class FrontendFiles:
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.files = {}
+        self.index()
+
+    @classmethod
+    def from_env(cls):
+        directory = os.environ.get("FRONTEND_BUILD_DIR")
+        return cls(directory) if directory else None
+
+    def index(self):
+        # path -> (media type, Cache-Control, {encoding: (file, stat)}), built
+        # once so a request costs a dict lookup and no filesystem calls.
+        if not os.path.isfile(os.path.join(self.directory, "index.html")):
+            raise RuntimeError(f"FRONTEND_BUILD_DIR {self.directory} has no index.html; run `yarn build` first")
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith((".br", ".gz")):
+                    continue
+                full = os.path.join(root, name)
+                path = os.path.relpath(full, self.directory).replace(os.sep, "/")
+                variants = {None: (full, os.stat(full))}
+                for suffix, encoding in ENCODINGS:
+                    if os.path.isfile(full + suffix):
+                        variants[encoding] = (full + suffix, os.stat(full + suffix))
+                if path == "index.html":
+                    cache_control = INDEX_CACHE
+                elif HASHED.search(name):
+                    cache_control = IMMUTABLE
+                else:
+                    cache_control = OTHER_CACHE
+                media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                self.files[path] = (media_type, cache_control, variants)
+        compressed = sum(len(variants) > 1 for _, _, variants in self.files.values())
+        logger.info("Serving frontend from %s (%d files, %d precompressed)", self.directory, len(self.files), compressed)
+
+    def response(self, request, path):
+        entry = self.files.get(path)
+        if entry is None:
+            if path.startswith("api/") or "." in path.rsplit("/", 1)[-1]:
+                raise HTTPException(status_code=404, detail="Not Found")
+            # A client-side route; the app works out what to show.
+            entry = self.files["index.html"]
+        media_type, cache_control, variants = entry
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        encoding = next((encoding for _, encoding in ENCODINGS if encoding in variants and encoding in accepted), None)
+        full, stat = variants[encoding]
+
+        # One validator for every encoding of the file, so a cached copy is
+        # reused whichever encoding it was fetched in.
+        original = variants[None][1]
+        etag = f'W/"{original.st_size:x}-{original.st_mtime_ns:x}"'
+        headers = {"Cache-Control": cache_control, "ETag": etag}
+        if len(variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers=headers)
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        return FileResponse(full, media_type=media_type, headers=headers, stat_result=stat)
+
+
+def compress_file(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    written = []
+    outputs = [(".gz", lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        outputs.insert(0, (".br", lambda raw: brotli.compress(raw, quality=11)))
+    for suffix, compress in outputs:
+        packed = compress(data)
+        # Not worth serving if it barely saves anything.
+        if len(packed) < len(data) * 0.9:
+            with open(path + suffix + ".tmp", "wb") as f:
+                f.write(packed)
+            os.replace(path + suffix + ".tmp", path + suffix)
+            written.append(suffix)
+    return written
+
+
+def compress(args):
+    if brotli is None:
+        logger.warning("brotli is not installed; writing .gz files only (pip install brotli)")
+    files = 0
+    saved = {".br": 0, ".gz": 0}
+    for root, _, names in os.walk(args.directory):
+        for name in names:
+            path = os.path.join(root, name)
+            extension = os.path.splitext(name)[1].lower()
+            if extension not in COMPRESSIBLE or os.path.getsize(path) < MIN_COMPRESS_BYTES:
+                continue
+            files += 1
+            for suffix in compress_file(path):
+                saved[suffix] += 1
+    logger.info("Compressed %d files (%d .br, %d .gz)", files, saved[".br"], saved[".gz"])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Prepare the frontend build for serving from the API.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compress_parser = commands.add_parser("compress", help="write .br and .gz copies of compressible files")
+    compress_parser.add_argument("directory", help="frontend build directory")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    arguments = parse_args()
+    if not os.path.isdir(arguments.directory):
+        sys.exit(f"{arguments.directory} is not a directory")
+    compress(arguments)
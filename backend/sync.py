@@ -0,0 +1,157 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+from pymongo import ReturnDocument, UpdateOne
+
+
+def parse_time(value):
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    try:
+        parsed = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+class ChangeFeed:
+    # Every write to a synced collection stamps the document with a `version`
+    # from one shared counter and an `updated_at` time; deletes leave a
+    # tombstone with a version of its own. A client's sync token is the
+    # (version, id) position it has seen up to, so "what changed" is a range
+    # scan on each collection's (version, id) index.
+    #
+    # Versions are handed out before the write lands, so a lower version can
+    # become visible after a higher one. The token therefore only advances
+    # past changes older than `settle_seconds`; newer ones are sent again on
+    # the next pull (clients upsert by id), and a slow write is still picked
+    # up as long as it lands within the settle window.
+    def __init__(self, db, settle_seconds=5, tombstone_days=90, counter="sync_version"):
+        self.counters = db.counters
+        self.tombstones = db.sync_tombstones
+        self.counter = counter
+        self.settle_seconds = settle_seconds
+        self.tombstone_days = tombstone_days
+
+    @classmethod
+    def from_env(cls, db):
+        return cls(
+            db,
+            settle_seconds=float(os.environ.get("SYNC_SETTLE_SECONDS", "5")),
+            tombstone_days=int(os.environ.get("SYNC_TOMBSTONE_DAYS", "90")),
+        )
+
+    async def ensure_indexes(self, collections):
+        for collection, scope in collections:
+            await collection.create_index([("version", 1), ("id", 1)])
+            if scope:
+                await collection.create_index([*((field, 1) for field in scope), ("version", 1), ("id", 1)])
+        await self.tombstones.create_index([("version", 1), ("id", 1)])
+        await self.tombstones.create_index("deleted_at", expireAfterSeconds=self.tombstone_days * 86400)
+
+    async def allocate(self, count=1):
+        # Reserves `count` consecutive versions and returns the first.
+        counter = await self.counters.find_one_and_update(
+            {"_id": self.counter},
+            {"$inc": {"value": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter["value"] - count + 1
+
+    async def stamp(self):
+        return {"version": await self.allocate(), "updated_at": datetime.now(timezone.utc).isoformat()}
+
+    async def tombstone(self, feed, doc_id):
+        now = datetime.now(timezone.utc)
+        await self.tombstones.insert_one({
+            "feed": feed,
+            "id": doc_id,
+            "version": await self.allocate(),
+            "updated_at": now.isoformat(),
+            "deleted_at": now,
+        })
+
+    async def backfill(self, collection, batch_size=1000):
+        # Documents written before versioning (or by bulk tools) get a version.
+        stamped = 0
+        while True:
+            batch = await collection.find({"version": {"$exists": False}}, {"_id": 1}).to_list(batch_size)
+            if not batch:
+                return stamped
+            first = await self.allocate(len(batch))
+            now = datetime.now(timezone.utc).isoformat()
+            await collection.bulk_write([
+                UpdateOne({"_id": doc["_id"], "version": {"$exists": False}},
+                          {"$set": {"version": first + offset, "updated_at": now}})
+                for offset, doc in enumerate(batch)
+            ], ordered=False)
+            stamped += len(batch)
+
+    def encode_token(self, version, doc_id):
+        raw = json.dumps({"v": version, "id": doc_id, "t": int(time.time())}, separators=(",", ":"))
+        return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+    def decode_token(self, token):
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+            data = json.loads(raw)
+            position = (int(data["v"]), str(data["id"]), int(data["t"]))
+        except (ValueError, KeyError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid sync token")
+        if time.time() - position[2] > self.tombstone_days * 86400:
+            # Deletes older than this have been forgotten.
+            raise HTTPException(status_code=410, detail="Sync token expired; start a full sync")
+        return position[:2]
+
+    async def changes(self, feeds, since=None, limit=500):
+        # `feeds` maps a feed name to (collection, query, projection). Without
+        # `since` this is a full snapshot, paged in version order.
+        version, doc_id = since or (0, "")
+        after = {"$or": [{"version": {"$gt": version}}, {"version": version, "id": {"$gt": doc_id}}]}
+        order = [("version", 1), ("id", 1)]
+        names = list(feeds)
+        reads = [
+            collection.find({"$and": [query, after]}, projection).sort(order).to_list(limit + 1)
+            for collection, query, projection in feeds.values()
+        ]
+        if since is not None:
+            reads.append(self.tombstones.find(
+                {"$and": [{"feed": {"$in": names}}, after]}, {"_id": 0, "feed": 1, "id": 1, "version": 1, "updated_at": 1}
+            ).sort(order).to_list(limit + 1))
+        results = await asyncio.gather(*reads)
+
+        items = [(doc["version"], doc["id"], name, doc) for name, docs in zip(names, results) for doc in docs]
+        if since is not None:
+            items += [(doc["version"], doc["id"], None, doc) for doc in results[-1]]
+        items.sort(key=lambda item: item[:2])
+        overflow = len(items) > limit
+        page = items[:limit]
+
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.settle_seconds)
+        position = (version, doc_id)
+        for item_version, item_id, _, doc in page:
+            updated_at = parse_time(doc.get("updated_at"))
+            if updated_at is not None and updated_at > cutoff:
+                break
+            position = (item_version, item_id)
+
+        changes = {name: [] for name in names}
+        deleted = {name: [] for name in names}
+        for _, item_id, name, doc in page:
+            if name is None:
+                deleted[doc["feed"]].append(item_id)
+            else:
+                changes[name].append(doc)
+        return {
+            "changes": changes,
+            "deleted": deleted,
+            "next": self.encode_token(*position),
+            # Only worth fetching again right away if the token moved.
+            "has_more": overflow and position != (version, doc_id),
+        }
@@ -0,0 +1,261 @@
+import asyncio
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+
+from blobstore import SNIFF_BYTES, sniff_content_type
+
+logger = logging.getLogger(__name__)
+
+MAX_RESUMABLE_BYTES = int(os.environ.get("XRAY_MAX_RESUMABLE_MB", "1024")) * 1024 * 1024
+SESSION_HOURS = float(os.environ.get("XRAY_UPLOAD_SESSION_HOURS", "24"))
+SWEEP_MINUTES = float(os.environ.get("XRAY_UPLOAD_SWEEP_MINUTES", "10"))
+# How long a session document outlives abandon_at before the TTL index drops
+# it, so the sweep always sees it (and its file id) first.
+SESSION_RETENTION = timedelta(days=7)
+FINALIZE_LEASE_SECONDS = 300
+WRITE_LEASE_SECONDS = 300
+
+
+class UploadSessions:
+    # Resumable uploads: a session document tracks how many bytes have been
+    # received, and the bytes go straight into the blob store's GridFS chunks
+    # under a file id picked when the session is created. Finalize reads them
+    # once to hash them and then adopts them as a file, so nothing is copied.
+    # Everything lives in MongoDB, so a client can resume against any worker.
+    # Uploads not finished by abandon_at are removed, chunks included, by an
+    # expire job queued at creation and, in case no job worker is running, by
+    # a sweep every API process runs. A TTL index drops the session documents
+    # a week later.
+    #
+    # One request writes to a session at a time: a PUT takes a lease on the
+    # session for its offset, and a concurrent PUT gets 409.
+    def __init__(self, db, blob_store, sweep_minutes=SWEEP_MINUTES):
+        self.sessions = db.xray_upload_sessions
+        self.blob_store = blob_store
+        self.sweep_interval = sweep_minutes * 60
+        self._task = None
+
+    async def ensure_indexes(self):
+        await self.sessions.create_index("id", unique=True)
+        await self.sessions.create_index("abandon_at")
+        await self.sessions.create_index("expires_at", expireAfterSeconds=0)
+
+    def start(self):
+        if self.sweep_interval > 0:
+            self._task = asyncio.create_task(self._sweep_periodically())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def create(self, patient_id, doctor_id, filename, size):
+        if size > MAX_RESUMABLE_BYTES:
+            raise HTTPException(status_code=413, detail=f"File exceeds the {MAX_RESUMABLE_BYTES // (1024 * 1024)} MB limit")
+        now = datetime.now(timezone.utc)
+        abandon_at = now + timedelta(hours=SESSION_HOURS)
+        session = {
+            "id": str(uuid.uuid4()),
+            "patient_id": patient_id,
+            "doctor_id": doctor_id,
+            "filename": filename,
+            "size": size,
+            "offset": 0,
+            "file_id": str(uuid.uuid4()),
+            "status": "open",
+            "created_at": now.isoformat(),
+            "abandon_at": abandon_at,
+            "expires_at": abandon_at + SESSION_RETENTION,
+        }
+        await self.sessions.insert_one(session)
+        session.pop("_id", None)
+        return session
+
+    async def get(self, session_id, doctor_id=None):
+        query = {"id": session_id}
+        if doctor_id is not None:
+            query["doctor_id"] = doctor_id
+        session = await self.sessions.find_one(query, {"_id": 0})
+        if session is None:
+            raise HTTPException(status_code=404, detail="Upload session not found or expired")
+        return session
+
+    def _offset_mismatch(self, session):
+        return HTTPException(
+            status_code=409,
+            detail=f"Upload is at offset {session['offset']}",
+            headers={"Upload-Offset": str(session["offset"])},
+        )
+
+    def _missing_data(self):
+        return HTTPException(status_code=409, detail="Upload is missing data; start a new upload")
+
+    async def append(self, session, offset, stream):
+        if session["status"] != "open":
+            raise HTTPException(status_code=409, detail="Upload is no longer open")
+        if offset != session["offset"]:
+            raise self._offset_mismatch(session)
+
+        token = str(uuid.uuid4())
+        now = datetime.now(timezone.utc)
+        claimed = await self.sessions.update_one(
+            {
+                "id": session["id"],
+                "offset": offset,
+                "status": "open",
+                "$or": [{"writer": {"$exists": False}}, {"writer_until": {"$lt": now}}],
+            },
+            {"$set": {"writer": token, "writer_until": now + timedelta(seconds=WRITE_LEASE_SECONDS)}},
+        )
+        if not claimed.matched_count:
+            current = await self.get(session["id"])
+            if current["offset"] != offset:
+                raise self._offset_mismatch(current)
+            raise HTTPException(
+                status_code=409,
+                detail="Another request is uploading to this session",
+                headers={"Upload-Offset": str(current["offset"])},
+            )
+        try:
+            position = await self._write(session, offset, stream)
+        except BaseException:
+            await self.sessions.update_one({"id": session["id"], "writer": token}, {"$unset": {"writer": "", "writer_until": ""}})
+            raise
+
+        result = await self.sessions.update_one(
+            {"id": session["id"], "writer": token},
+            {"$set": {"offset": position}, "$unset": {"writer": "", "writer_until": ""}},
+        )
+        if not result.matched_count:
+            # The lease ran out and another request took over.
+            raise self._offset_mismatch(await self.get(session["id"]))
+        return {**session, "offset": position}
+
+    async def _write(self, session, offset, stream):
+        file_id = session["file_id"]
+        chunk_size = self.blob_store.chunk_size
+        n, partial = divmod(offset, chunk_size)
+        buffer = bytearray()
+        if partial:
+            # The last request ended mid-chunk, so that chunk is written again
+            # with this request's bytes appended.
+            previous = await self.blob_store.get_chunk(file_id, n)
+            if previous is None or len(previous) < partial:
+                raise self._missing_data()
+            buffer += previous[:partial]
+        # Leftovers from an interrupted request past this offset are
+        # discarded, so retrying a chunk is always safe.
+        await self.blob_store.discard_chunks(file_id, from_n=n + 1 if partial else n)
+        async for data in stream:
+            if n * chunk_size + len(buffer) + len(data) > session["size"]:
+                raise HTTPException(status_code=413, detail="Chunk runs past the declared upload size")
+            buffer += data
+            while len(buffer) >= chunk_size:
+                await self.blob_store.put_chunk(file_id, n, bytes(buffer[:chunk_size]))
+                n += 1
+                del buffer[:chunk_size]
+        if buffer:
+            await self.blob_store.put_chunk(file_id, n, bytes(buffer))
+        return n * chunk_size + len(buffer)
+
+    async def finalize(self, session, expected_sha256=None):
+        if session["offset"] != session["size"]:
+            raise self._offset_mismatch(session)
+        now = datetime.now(timezone.utc)
+        claimed = await self.sessions.find_one_and_update(
+            {
+                "id": session["id"],
+                "$or": [
+                    {"status": "open"},
+                    {"status": "finalizing", "lease_until": {"$lt": now}},
+                ],
+            },
+            {"$set": {"status": "finalizing", "lease_until": now + timedelta(seconds=FINALIZE_LEASE_SECONDS)}},
+            projection={"_id": 0},
+        )
+        if claimed is None:
+            raise HTTPException(status_code=409, detail="Upload is already being finalized")
+
+        try:
+            hasher = hashlib.sha256()
+            head = b""
+            position = 0
+            async for chunk in self.blob_store.iter_chunks(session["file_id"]):
+                if chunk["n"] * self.blob_store.chunk_size != position:
+                    raise self._missing_data()
+                hasher.update(chunk["data"])
+                if len(head) < SNIFF_BYTES:
+                    head += chunk["data"][:SNIFF_BYTES - len(head)]
+                position += len(chunk["data"])
+            if position != session["size"]:
+                raise self._missing_data()
+            if expected_sha256 and hasher.hexdigest() != expected_sha256.lower():
+                raise HTTPException(status_code=422, detail="Checksum mismatch")
+            content_type = sniff_content_type(head)
+            if content_type is None:
+                raise HTTPException(status_code=415, detail="Unsupported file type")
+            return await self.blob_store.adopt(
+                session["file_id"], position, content_type, hasher.hexdigest(), session["filename"]
+            )
+        except BaseException:
+            await self.sessions.update_one({"id": session["id"]}, {"$set": {"status": "open"}, "$unset": {"lease_until": ""}})
+            raise
+
+    async def complete(self, session_id, xray_id):
+        # The chunks now belong to the stored file.
+        await self.sessions.update_one(
+            {"id": session_id},
+            {"$set": {"status": "completed", "xray_id": xray_id}, "$unset": {"lease_until": ""}},
+        )
+
+    async def abort(self, session):
+        if session["status"] == "finalizing":
+            raise HTTPException(status_code=409, detail="Upload is already being finalized")
+        await self.sessions.delete_one({"id": session["id"]})
+        await self.blob_store.discard_chunks(session["file_id"])
+
+    async def expire(self, session_id, file_id):
+        # Run when a session's time is up. Returns False if it is being
+        # finalized and should be checked again later.
+        finalizing = await self.sessions.find_one(
+            {"id": session_id, "status": "finalizing", "lease_until": {"$gt": datetime.now(timezone.utc)}}, {"_id": 1}
+        )
+        if finalizing:
+            return False
+        await self.sessions.delete_one({"id": session_id, "status": {"$ne": "completed"}})
+        if not await self.blob_store.has_file(file_id):
+            await self.blob_store.discard_chunks(file_id)
+        return True
+
+    async def sweep(self, limit=100):
+        # Expires up to `limit` unfinished sessions past abandon_at. Every API
+        # process runs this; expiring a session twice is harmless.
+        stale = await self.sessions.find(
+            {"abandon_at": {"$lt": datetime.now(timezone.utc)}, "status": {"$ne": "completed"}},
+            {"_id": 0, "id": 1, "file_id": 1},
+        ).to_list(limit)
+        expired = 0
+        for session in stale:
+            expired += await self.expire(session["id"], session["file_id"])
+        return expired
+
+    async def _sweep_periodically(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                expired = await self.sweep()
+            except Exception:
+                logger.exception("Sweeping abandoned uploads failed")
+                continue
+            if expired:
+                logger.info("Removed %d abandoned uploads", expired)
@@ -0,0 +1,72 @@
+"""Run background jobs from the `jobs` collection.
+
+Usage (from the backend/ directory):
+
+    python -m worker --processes 4 --concurrency 8
+
+Each process claims jobs independently, so workers can run on any number of
+machines against the same database. SIGINT/SIGTERM let running jobs finish
+before exiting; a job whose worker is killed outright is retried once its
+lease (JOB_VISIBILITY_TIMEOUT_SECONDS) runs out.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import signal
+
+logger = logging.getLogger("worker")
+
+
+def run_worker(concurrency, poll_interval):
+    # Imported in the child so every process gets its own client and event loop.
+    import server
+    from jobs import Worker
+
+    async def main():
+        worker = Worker(server.job_queue, concurrency=concurrency, poll_interval=poll_interval)
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, worker.stop)
+        try:
+            await worker.run()
+        finally:
+            server.mongo.close()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run background jobs.")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--concurrency", type=int, default=4, help="jobs in flight per process")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="seconds between polls when idle")
+    return parser.parse_args(argv)
+
+
+def main(args):
+    if args.processes == 1:
+        run_worker(args.concurrency, args.poll_interval)
+        return
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(args.concurrency, args.poll_interval), name=f"worker-{index}")
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # children get SIGINT from the terminal themselves
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main(parse_args())
@@ -45,7 +45,7 @@ export default function PatientDetailPage() {
       const [patientRes, proceduresRes, paymentsRes] = await Promise.all([
         axios.get(`${API}/patients/${patientId}`),
         axios.get(`${API}/procedures`),
-        axios.get(`${API}/patients/${patientId}/payments`)
+        axios.get(`${API}/patients/${patientId}/payments`, { params: { include_archived: true } })
       ]);
       setPatient(patientRes.data);
       setProcedures(proceduresRes.data);
@@ -53,7 +53,7 @@ export default function PatientDetailPage() {
 
       if (isDoctor || isAdmin) {
         const [historyRes, xraysRes] = await Promise.all([
-          axios.get(`${API}/patients/${patientId}/history`),
+          axios.get(`${API}/patients/${patientId}/history`, { params: { include_archived: true } }),
           axios.get(`${API}/patients/${patientId}/xrays`)
         ]);
         setHistory(historyRes.data);
@@ -0,0 +1,149 @@
+"""Shared fixtures for API tests.
+
+The tests run the real app against the MongoDB in MONGO_URL / DB_NAME (or
+backend/.env), so point them at a throwaway database. When that database
+can't be reached they run against an in-memory mongomock-motor database
+instead (pip install mongomock-motor), and are skipped if that isn't
+installed either.
+
+    def test_patient_list_query_count(client, admin_headers, db_call_budget):
+        response = client.get("/api/patients", headers=admin_headers)
+        db_call_budget(response, 3)
+"""
+import os
+import sys
+import threading
+import uuid
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# The command each mongomock collection method stands for, for the db call
+# counter. Methods mongomock implements on top of these count once.
+MOCK_COMMANDS = {
+    "find": "find", "find_one": "find", "count_documents": "aggregate", "estimated_document_count": "count",
+    "distinct": "distinct", "aggregate": "aggregate", "insert_one": "insert", "insert_many": "insert",
+    "update_one": "update", "update_many": "update", "replace_one": "update", "bulk_write": "bulkWrite",
+    "delete_one": "delete", "delete_many": "delete", "find_one_and_update": "findAndModify",
+    "find_one_and_replace": "findAndModify", "find_one_and_delete": "findAndModify", "create_index": "createIndexes",
+}
+
+
+def mongo_reachable():
+    try:
+        MongoClient(os.environ["MONGO_URL"], serverSelectionTimeoutMS=2000).admin.command("ping")
+    except PyMongoError:
+        return False
+    return True
+
+
+def use_mongomock():
+    # Swaps the Motor client for mongomock-motor before server is imported, and
+    # reports mongomock's collection calls to the command listeners the way
+    # pymongo's command monitoring would, so db call budgets still apply.
+    mongomock_motor = pytest.importorskip("mongomock_motor", reason="MongoDB is not reachable and mongomock-motor is not installed")
+    from mongomock.collection import Collection
+    from mongomock.gridfs import enable_gridfs_integration
+    from pymongo import monitoring
+
+    import database
+
+    listeners = []
+    nested = threading.local()
+
+    class MockClient(mongomock_motor.AsyncMongoMockClient):
+        def __init__(self, *args, event_listeners=(), **kwargs):
+            super().__init__(*args, **kwargs)
+            listeners.extend(listener for listener in event_listeners if isinstance(listener, monitoring.CommandListener))
+
+    def counted(method, command_name):
+        def call(self, *args, **kwargs):
+            if getattr(nested, "depth", 0) == 0:
+                event = SimpleNamespace(command_name=command_name, command={command_name: self.name})
+                for listener in listeners:
+                    listener.started(event)
+            nested.depth = getattr(nested, "depth", 0) + 1
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                nested.depth -= 1
+        return call
+
+    for name, command_name in MOCK_COMMANDS.items():
+        setattr(Collection, name, counted(getattr(Collection, name), command_name))
+    enable_gridfs_integration()
+    database.AsyncIOMotorClient = MockClient
+
+
+@pytest.fixture(scope="session")
+def app_module():
+    load_dotenv(BACKEND_DIR / ".env")
+    if not mongo_reachable():
+        use_mongomock()
+    import server
+
+    return server
+
+
+@pytest.fixture(scope="session")
+def client(app_module):
+    from fastapi.testclient import TestClient
+
+    with TestClient(app_module.app) as client:
+        yield client
+
+
+@pytest.fixture(scope="session")
+def run_in_app(client):
+    # Runs a coroutine function on the app's event loop, where its database
+    # client lives, e.g. to set up records the API can't create.
+    return lambda function, *args: client.portal.call(function, *args)
+
+
+def login(client, email, password):
+    response = client.post("/api/auth/login", json={"email": email, "password": password})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+@pytest.fixture(scope="session")
+def admin_headers(client):
+    return login(client, "admin@clinic.com", "admin123")
+
+
+@pytest.fixture(scope="session")
+def headers_for(client, admin_headers):
+    # headers_for("receptionist") creates a user with that role and logs in as them.
+    def create(role):
+        email = f"{role}-{uuid.uuid4().hex[:8]}@test.clinic"
+        response = client.post(
+            "/api/users",
+            json={"email": email, "password": "test-password", "name": f"Test {role}", "phone": "000", "role": role},
+            headers=admin_headers,
+        )
+        assert response.status_code == 200, response.text
+        return login(client, email, "test-password")
+
+    return create
+
+
+@pytest.fixture
+def db_call_budget(app_module, monkeypatch):
+    # Turns on per-request counting and returns a check that fails the test
+    # when a response took more database calls than allowed.
+    monkeypatch.setattr(app_module.mongo.db_calls, "enabled", True)
+
+    def check(response, limit):
+        calls = int(response.headers["X-DB-Calls"])
+        request = response.request
+        assert calls <= limit, f"{request.method} {request.url.path} made {calls} database calls (budget {limit})"
+        return calls
+
+    return check
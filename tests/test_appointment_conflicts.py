@@ -0,0 +1,53 @@
+import uuid
+
+import pytest
+
+DAY = "2031-02-03"
+
+
+@pytest.fixture
+def booking(client, admin_headers, headers_for):
+    # A fresh doctor per test, so bookings from other tests don't collide.
+    doctor = client.get("/api/auth/me", headers=headers_for("doctor")).json()
+    patient = client.post(
+        "/api/patients", json={"name": "Conflict Test", "phone": "0790000002", "doctor_id": doctor["id"]}, headers=admin_headers
+    ).json()
+
+    def book(time, duration_minutes=None):
+        payload = {"patient_id": patient["id"], "doctor_id": doctor["id"], "date": DAY, "time": time}
+        if duration_minutes:
+            payload["duration_minutes"] = duration_minutes
+        return client.post("/api/appointments", json=payload, headers=admin_headers)
+
+    book.doctor_id = doctor["id"]
+    return book
+
+
+def test_overlapping_booking_is_rejected(booking):
+    assert booking("10:00", 60).status_code == 200
+    rejected = booking("10:30")
+    assert rejected.status_code == 400
+    assert rejected.json()["detail"] == "Time slot already booked"
+    assert booking("09:30").status_code == 200
+    assert booking("11:00").status_code == 200
+
+
+def test_booking_checks_appointments_without_intervals(booking, app_module, run_in_app):
+    # Appointments from before durations existed only have a time until the
+    # backfill job reaches them; they count as the default duration.
+    run_in_app(app_module.db.appointments.insert_one, {
+        "id": str(uuid.uuid4()), "patient_id": "legacy", "doctor_id": booking.doctor_id,
+        "date": DAY, "time": "14:00", "status": "confirmed",
+    })
+    assert booking("14:00").status_code == 400
+    assert booking("14:15").status_code == 400
+    assert booking("13:45").status_code == 400
+    assert booking("14:30").status_code == 200
+
+
+def test_conflict_preview_reports_the_overlapping_appointment(client, admin_headers, booking):
+    booked = booking("15:00", 45).json()
+    response = client.get("/api/appointments/check-conflict", params={
+        "doctor_id": booking.doctor_id, "date": DAY, "time": "15:30", "duration_minutes": 30,
+    }, headers=admin_headers)
+    assert response.json() == {"has_conflict": True, "conflicting_appointment_id": booked["id"]}
@@ -0,0 +1,45 @@
+import pytest
+
+# Calls per request with procedures. They must not grow with the number of
+# procedures (the catalog is read with one $in query), so each endpoint is
+# checked with one procedure and with several.
+UPDATE_APPOINTMENT_CALLS = 9
+ADD_HISTORY_CALLS = 7
+
+
+@pytest.fixture(scope="module")
+def setup(client, admin_headers, headers_for):
+    doctor_headers = headers_for("doctor")
+    doctor = client.get("/api/auth/me", headers=doctor_headers).json()
+    patient = client.post(
+        "/api/patients", json={"name": "Budget Test", "phone": "0790000001", "doctor_id": doctor["id"]}, headers=admin_headers
+    ).json()
+    procedures = [proc["id"] for proc in client.get("/api/procedures", headers=admin_headers).json()]
+    assert len(procedures) >= 5
+    return {"doctor": doctor, "doctor_headers": doctor_headers, "patient": patient, "procedures": procedures}
+
+
+@pytest.mark.parametrize("procedure_count", [1, 5])
+def test_update_appointment_calls(client, admin_headers, db_call_budget, setup, procedure_count):
+    appointment = client.post("/api/appointments", json={
+        "patient_id": setup["patient"]["id"], "doctor_id": setup["doctor"]["id"], "date": "2031-01-15", "time": f"{9 + procedure_count}:00",
+    }, headers=admin_headers).json()
+    response = client.put(
+        f"/api/appointments/{appointment['id']}",
+        json={"status": "done", "procedures": setup["procedures"][:procedure_count]},
+        headers=admin_headers,
+    )
+    assert response.status_code == 200, response.text
+    db_call_budget(response, UPDATE_APPOINTMENT_CALLS)
+
+
+@pytest.mark.parametrize("procedure_count", [1, 5])
+def test_add_patient_history_calls(client, db_call_budget, setup, procedure_count):
+    patient_id = setup["patient"]["id"]
+    response = client.post(
+        f"/api/patients/{patient_id}/history",
+        json={"patient_id": patient_id, "notes": "Budget check", "procedures": setup["procedures"][:procedure_count]},
+        headers=setup["doctor_headers"],
+    )
+    assert response.status_code == 200, response.text
+    db_call_budget(response, ADD_HISTORY_CALLS)
@@ -0,0 +1,35 @@
+import pytest
+
+
+@pytest.mark.parametrize("field", ["notes", "procedures", "planned_procedures"])
+def test_receptionist_cannot_select_restricted_fields(client, headers_for, field):
+    response = client.get("/api/appointments", params={"fields": f"id,{field}"}, headers=headers_for("receptionist"))
+    assert response.status_code == 400
+    assert field in response.json()["detail"]
+
+
+def test_receptionist_gets_only_selected_fields(client, admin_headers, headers_for):
+    doctor = client.get("/api/doctors", headers=admin_headers).json()
+    doctor_id = doctor[0]["id"] if doctor else "unassigned"
+    created = client.post(
+        "/api/patients", json={"name": "Fieldset Test", "phone": "0790000000", "doctor_id": doctor_id}, headers=admin_headers
+    )
+    assert created.status_code == 200, created.text
+
+    response = client.get("/api/patients", params={"fields": "name,phone"}, headers=headers_for("receptionist"))
+    assert response.status_code == 200
+    patient = next(p for p in response.json() if p["id"] == created.json()["id"])
+    assert patient == {"id": created.json()["id"], "name": "Fieldset Test", "phone": "0790000000"}
+
+
+def test_receptionist_may_select_financial_fields(client, headers_for):
+    # The receptionist dashboard shows these for every patient.
+    response = client.get("/api/patients", params={"fields": "total_cost,total_paid,balance"}, headers=headers_for("receptionist"))
+    assert response.status_code == 200
+
+
+def test_receptionist_may_select_booking_fields(client, headers_for):
+    response = client.get(
+        "/api/appointments", params={"fields": "start_at,end_at,duration_minutes,series_id"}, headers=headers_for("receptionist")
+    )
+    assert response.status_code == 200
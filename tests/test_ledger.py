@@ -0,0 +1,71 @@
+import pytest
+
+import rebuild_balances
+from rebuild_balances import BalanceRebuilder
+
+
+@pytest.fixture
+def patient(client, admin_headers, headers_for):
+    doctor_headers = headers_for("doctor")
+    doctor = client.get("/api/auth/me", headers=doctor_headers).json()
+    created = client.post(
+        "/api/patients", json={"name": "Ledger Test", "phone": "0790000003", "doctor_id": doctor["id"]}, headers=admin_headers
+    ).json()
+    return {**created, "doctor_headers": doctor_headers}
+
+
+@pytest.fixture(scope="module")
+def procedures(client, admin_headers):
+    return client.get("/api/procedures", headers=admin_headers).json()[:2]
+
+
+def balance(client, admin_headers, patient_id):
+    response = client.get(f"/api/patients/{patient_id}/balance", headers=admin_headers)
+    assert response.status_code == 200, response.text
+    return {key: response.json()[key] for key in ("total_cost", "total_paid", "balance")}
+
+
+def charge_and_pay(client, admin_headers, patient, procedures, amount):
+    history = client.post(f"/api/patients/{patient['id']}/history", json={
+        "patient_id": patient["id"], "notes": "Ledger check", "procedures": [proc["id"] for proc in procedures],
+    }, headers=patient["doctor_headers"])
+    assert history.status_code == 200, history.text
+    payment = client.post("/api/payments", json={"patient_id": patient["id"], "amount": amount}, headers=admin_headers)
+    assert payment.status_code == 200, payment.text
+
+
+def test_charges_and_payments_are_recorded_in_the_ledger(client, admin_headers, patient, procedures):
+    charge_and_pay(client, admin_headers, patient, procedures, 50.0)
+    cost = sum(proc["price"] for proc in procedures)
+
+    assert balance(client, admin_headers, patient["id"]) == {"total_cost": cost, "total_paid": 50.0, "balance": cost - 50.0}
+    entries = client.get(f"/api/patients/{patient['id']}/ledger", headers=admin_headers).json()
+    assert [entry["type"] for entry in entries] == ["payment", "charge"]
+
+
+def test_legacy_patient_ledger_opens_with_cached_totals(client, admin_headers, app_module, run_in_app, patient):
+    # A patient from before the ledger: cached totals, no entries.
+    run_in_app(app_module.db.patients.update_one, {"id": patient["id"]}, {
+        "$set": {"total_cost": 100.0, "total_paid": 40.0, "balance": 60.0}, "$unset": {"ledger_seq": ""},
+    })
+    client.post("/api/payments", json={"patient_id": patient["id"], "amount": 10.0}, headers=admin_headers)
+
+    assert balance(client, admin_headers, patient["id"]) == {"total_cost": 100.0, "total_paid": 50.0, "balance": 50.0}
+    entries = client.get(f"/api/patients/{patient['id']}/ledger", headers=admin_headers).json()
+    assert [entry["type"] for entry in entries] == ["payment", "opening"]
+
+
+@pytest.mark.parametrize("from_source", [False, True])
+def test_rebuild_restores_totals(client, admin_headers, app_module, run_in_app, patient, procedures, from_source):
+    charge_and_pay(client, admin_headers, patient, procedures, 30.0)
+    expected = balance(client, admin_headers, patient["id"])
+    run_in_app(app_module.db.patients.update_one, {"id": patient["id"]}, {"$set": {"total_cost": 0.0, "balance": -30.0}})
+
+    args = rebuild_balances.parse_args(["--patient", patient["id"], *(["--from-source"] if from_source else [])])
+    rebuilder = BalanceRebuilder(app_module.db, args, {proc["id"]: proc["price"] for proc in procedures})
+    run_in_app(rebuilder.rebuild_batch, [patient["id"]])
+
+    assert balance(client, admin_headers, patient["id"]) == expected
+    fields = "total_cost,total_paid,balance"
+    cached = client.get(f"/api/patients/{patient['id']}", params={"fields": fields}, headers=admin_headers).json()
+    assert {key: cached[key] for key in fields.split(",")} == expected